@@ -1,2 +1,3 @@
-from . import voc, labelme
-from .builder import build_ds
\ No newline at end of file
+from . import (voc, labelme, manifest, index, columnar, records, cache, store,
+               buckets, service)
+from .builder import build_ds
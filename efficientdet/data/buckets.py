@@ -0,0 +1,203 @@
+"""
+Aspect ratio buckets
+
+Squashing every image into a square input wastes most of the compute of
+wide or tall images on stretched pixels. Instead, images can be grouped
+by aspect ratio into a small fixed set of rectangular shapes (buckets)
+whose area is close to the square model input and whose sides are
+multiples of 128, so they can be downsampled up to the last pyramid
+level. Each image is letterboxed within its bucket, that is resized
+keeping its aspect ratio and padded at the bottom and right sides, and
+each batch contains images of a single bucket.
+
+Since the number of buckets is small, so is the number of distinct input
+shapes the model functions are traced for.
+"""
+
+import math
+import collections
+from typing import Mapping, Sequence, Tuple
+
+import tensorflow as tf
+
+
+# Width / height ratios of the default buckets
+ASPECT_RATIOS = (1 / 4, 1 / 2, 3 / 4, 1., 4 / 3, 16 / 9, 4.)
+SIZE_MULTIPLE = 128
+
+Shape = Tuple[int, int]
+
+
+def bucket_shapes(input_size: int,
+                  aspect_ratios: Sequence[float] = ASPECT_RATIOS,
+                  multiple: int = SIZE_MULTIPLE) -> Sequence[Shape]:
+    """
+    Rectangular input shapes with approximately the same area as the
+    square input
+
+    Parameters
+    ----------
+    input_size: int
+        Square model input size. Refer to efficientdet.config
+    aspect_ratios: Sequence[float], default ASPECT_RATIOS
+        Width / height ratio of each bucket
+    multiple: int, default 128
+        Height and width are rounded to multiples of this number
+
+    Returns
+    -------
+    Sequence[Tuple[int, int]]
+        Unique (height, width) of the buckets sorted by aspect ratio
+    """
+    def round_to_multiple(x: float) -> int:
+        return max(multiple, int(round(x / multiple)) * multiple)
+
+    shapes = set()
+    for ratio in aspect_ratios:
+        h = round_to_multiple(input_size / math.sqrt(ratio))
+        w = round_to_multiple(input_size * math.sqrt(ratio))
+        shapes.add((h, w))
+
+    return sorted(shapes, key=lambda s: s[1] / s[0])
+
+
+def bucket_index(im_shape: tf.Tensor, shapes: Sequence[Shape]) -> tf.Tensor:
+    """
+    Index of the bucket with the closest aspect ratio to the image
+
+    Parameters
+    ----------
+    im_shape: tf.Tensor
+        Image height and width
+    shapes: Sequence[Tuple[int, int]]
+        Buckets shapes
+
+    Returns
+    -------
+    tf.Tensor of type tf.int32
+    """
+    im_shape = tf.cast(im_shape, tf.float32)
+    im_log_ratio = tf.math.log(im_shape[1] / im_shape[0])
+
+    log_ratios = tf.constant([math.log(w / h) for h, w in shapes])
+    distance = tf.abs(log_ratios - im_log_ratio)
+    return tf.argmin(distance, output_type=tf.int32)
+
+
+def letterbox_size(im_shape: tf.Tensor, bucket_shape: tf.Tensor) -> tf.Tensor:
+    """
+    Size of the image resized to fit in the bucket keeping its aspect
+    ratio
+
+    Parameters
+    ----------
+    im_shape: tf.Tensor
+        Image height and width
+    bucket_shape: tf.Tensor
+        Bucket height and width
+
+    Returns
+    -------
+    tf.Tensor of type tf.int32
+        Height and width of the resized image
+    """
+    im_shape = tf.cast(im_shape, tf.float32)
+    bucket_shape = tf.cast(bucket_shape, tf.float32)
+    scale = tf.reduce_min(bucket_shape / im_shape)
+    size = tf.round(im_shape * scale)
+    return tf.cast(tf.minimum(size, bucket_shape), tf.int32)
+
+
+def count_batches(im_shapes: Sequence[Shape],
+                  shapes: Sequence[Shape],
+                  batch_size: int) -> int:
+    """
+    Number of batches when grouping the images by bucket
+
+    Parameters
+    ----------
+    im_shapes: Sequence[Tuple[int, int]]
+        Height and width of every image of the dataset
+    shapes: Sequence[Tuple[int, int]]
+        Buckets shapes
+    batch_size: int
+    """
+    log_ratios = [math.log(w / h) for h, w in shapes]
+
+    def closest(h, w):
+        log_ratio = math.log(w / h)
+        return min(range(len(shapes)),
+                   key=lambda i: abs(log_ratios[i] - log_ratio))
+
+    counts = collections.Counter(closest(h, w) for h, w in im_shapes)
+    return sum(math.ceil(n / batch_size) for n in counts.values())
+
+
+def group_by_bucket(ds: tf.data.Dataset,
+                    shapes: Sequence[Shape],
+                    batch_size: int,
+                    ragged: bool = False) -> tf.data.Dataset:
+    """
+    Batches letterboxed examples of the same bucket together
+
+    Parameters
+    ----------
+    ds: tf.data.Dataset
+        Dataset yielding (image, (labels, boxes)), where the images are
+        letterboxed to one of the buckets
+    shapes: Sequence[Tuple[int, int]]
+        Buckets shapes
+    batch_size: int
+    ragged: bool, default False
+        Batch the labels and boxes as tf.RaggedTensor instead of padding
+        them with -1
+
+    Returns
+    -------
+    tf.data.Dataset
+    """
+    shapes_tensor = tf.constant(shapes, dtype=tf.int32)
+
+    def key_fn(image, annots):
+        # Images already have the shape of their bucket
+        is_bucket = tf.reduce_all(
+            tf.equal(shapes_tensor, tf.shape(image)[:2]), axis=-1)
+        return tf.cast(tf.argmax(is_bucket), tf.int64)
+
+    def to_ragged(images, annots):
+        labels, boxes = annots
+        lengths = tf.reduce_sum(tf.cast(labels >= 0, tf.int32), axis=-1)
+        return images, (tf.RaggedTensor.from_tensor(labels, lengths),
+                        tf.RaggedTensor.from_tensor(boxes, lengths))
+
+    def reduce_fn(key, window):
+        image_dtype = window.element_spec[0].dtype
+        batches = window.padded_batch(
+            batch_size,
+            padded_shapes=((None, None, 3), ((None,), (None, 4))),
+            padding_values=(tf.constant(0, image_dtype), (-1, -1.)))
+
+        # The images of a bucket have the same shape, only the annotations
+        # are ragged
+        return batches.map(to_ragged) if ragged else batches
+
+    return ds.group_by_window(key_func=key_fn,
+                              reduce_func=reduce_fn,
+                              window_size=batch_size)
+
+
+def bucket_anchors(anchors: Mapping[Shape, tf.Tensor],
+                   images: tf.Tensor) -> tf.Tensor:
+    """
+    Selects the anchors of the images bucket within a graph
+
+    Parameters
+    ----------
+    anchors: Mapping[Tuple[int, int], tf.Tensor]
+        Anchors of each bucket shape
+    images: tf.Tensor of shape [BATCH, H, W, C]
+        Batch of images of a single bucket
+    """
+    shapes = list(anchors)
+    idx = bucket_index(tf.shape(images)[1:3], shapes)
+    return tf.switch_case(idx, [lambda s=s: anchors[s] for s in shapes])
@@ -1,11 +1,52 @@
-from typing import Mapping, Sequence, Tuple
+import math
+from functools import partial
+from typing import Mapping, Sequence, Tuple, Union
 
 import tensorflow as tf
 
 import efficientdet
 
 
-AVAILABLE_FORMATS = {'VOC', 'labelme'}
+AVAILABLE_FORMATS = {'VOC', 'labelme', 'tfrecord'}
+
+
+def _assign_batch_anchor_targets(images: tf.Tensor, 
+                                 annots: Tuple[tf.Tensor, tf.Tensor],
+                                 anchors: tf.Tensor,
+                                 num_classes: int,
+                                 matcher: 'IoUMatcher' = None,
+                                 compact: bool = False,
+                                 regression_dtype: tf.DType = tf.float32):
+    labels, boxes = annots
+
+    # Append a padding box so images without boxes can still be matched
+    batch_size = tf.shape(labels)[0]
+    labels = tf.concat([labels, tf.fill([batch_size, 1], -1)], axis=1)
+    boxes = tf.concat([boxes, tf.fill([batch_size, 1, 4], -1.)], axis=1)
+
+    targets = efficientdet.utils.anchors.compute_anchor_targets(
+        anchors, 
+        images,
+        boxes,
+        labels,
+        num_classes,
+        matcher=matcher,
+        compact=compact,
+        regression_dtype=regression_dtype)
+
+    return images, targets
+
+
+def _assign_anchor_targets(image: tf.Tensor, 
+                           annots: Tuple[tf.Tensor, tf.Tensor],
+                           **kwargs):
+    _, targets = _assign_batch_anchor_targets(
+        tf.expand_dims(image, 0),
+        tf.nest.map_structure(lambda t: tf.expand_dims(t, 0), annots),
+        **kwargs)
+
+    # Remove the batch dimension
+    return image, tf.nest.map_structure(lambda t: t[0], targets)
 
 
 def build_ds(format: str,
@@ -14,16 +55,34 @@ def build_ds(format: str,
              batch_size: int,
              class_names: Sequence[str] = [],
              data_augmentation: bool = True,
+             anchors: Union[tf.Tensor, Mapping[Tuple[int, int], 
+                                               tf.Tensor]] = None,
+             matcher: 'IoUMatcher' = None,
+             compact_targets: bool = False,
+             regression_dtype: tf.DType = tf.float32,
+             ragged: bool = False,
+             image_dtype: tf.DType = tf.float32,
+             image_cache: 'ImageCache' = None,
+             packed_images: bool = False,
+             batched_augmentation: bool = False,
+             buckets: Sequence[Tuple[int, int]] = None,
+             data_service: str = None,
              **kwargs) -> Tuple[tf.data.Dataset, Mapping[str, int]]:
     """Build a tf.data.Dataset with an specific preprocessing
     
     This method builds a tf.data.Dataset with different preprocessing steps 
     depending on the specified format.
 
+    The dataset cardinality is exact, so the number of batches can be
+    retrieved with `ds.cardinality()`. It is read from the dataset 
+    manifest, refer to efficientdet.data.manifest
+
     Parameters
     ----------
-    format: str, choice of [VOC, labelme]
-        The format specifies the type of files and dataset structure
+    format: str, choice of [VOC, labelme, tfrecord]
+        The format specifies the type of files and dataset structure.
+        With tfrecord, annots_path is a directory with the shards written
+        by efficientdet.data.records.export_tfrecords
 
     im_size: Tuple[int, int]
         Size of the input images
@@ -31,15 +90,96 @@ def build_ds(format: str,
         Name of labels. When working with research datasets such as VOC
         there is no need to specify it, otherwise, with custom datasets 
         (labelme) it is mandatory.
+    anchors: tf.Tensor of shape [N_ANCHORS, 4], default None
+        If set, the anchor targets are computed for each example within
+        the input pipeline and the dataset yields 
+        (images, (regression_targets, class_targets)) instead of
+        (images, (labels, boxes)). Refer to 
+        efficientdet.utils.anchors.anchor_targets_bbox for the targets
+        format. When using buckets, it must map each bucket shape to its
+        anchors
+    matcher: IoUMatcher, default None
+        Strategy to match anchors with ground truth boxes when computing
+        the anchor targets. Refer to efficientdet.utils.matching
+    compact_targets: bool, default False
+        Emit the anchor targets in the compact format, where class targets
+        are int16 indices along with the int8 anchor states instead of
+        float32 one-hot vectors. Refer to 
+        efficientdet.utils.anchors.compute_anchor_targets
+    regression_dtype: tf.DType, default tf.float32
+        Data type of the compact regression targets
+    ragged: bool, default False
+        Batch the labels and boxes as tf.RaggedTensor instead of padding
+        them with -1. Only used when anchors is None
+    image_dtype: tf.DType, default tf.float32
+        Data type of the images. With tf.uint8 the images are not 
+        normalized, so 4 times fewer bytes go through the shuffle buffers,
+        the batching and the host to device copies. The model normalizes
+        them, refer to efficientdet.models.layers.ImageNormalization
+    image_cache: efficientdet.data.cache.ImageCache, default None
+        Keeps the decoded images in memory, so they are decoded only once
+        as long as they fit in the cache budget. The augmentation is
+        applied after the cache. Not supported with tfrecord
+    packed_images: bool, default False
+        Read the images from the memory mapped store of images packed at
+        `im_size`, which is created the first time. Not supported with 
+        tfrecord. Refer to efficientdet.data.store
+    batched_augmentation: bool, default False
+        When data_augmentation is set, augment whole padded batches with
+        efficientdet.data.preprocess.augment_batch instead of augmenting
+        each example. Not compatible with ragged
+    buckets: Sequence[Tuple[int, int]], default None
+        Batch the images grouped by aspect ratio. Each image is 
+        letterboxed within the bucket shape with the closest aspect ratio
+        instead of being resized to `im_size`, and the batches contain 
+        images of a single bucket. The augmentation is always applied by
+        batches. Refer to efficientdet.data.buckets.bucket_shapes. Not 
+        supported with the image cache, the packed images nor the grid 
+        matcher
+    data_service: str, default None
+        Address of a tf.data service dispatcher, for example
+        grpc://localhost:5050. If set, the examples are read, decoded,
+        augmented and assigned their anchor targets in the service
+        workers, and received over the network. They are batched in this
+        process, so every example is kept and the batches are the same
+        as without the service. Batch level steps, such as the batched
+        augmentation, run in this process too. Not supported with the
+        image cache nor the packed images, which live in this process.
+        Refer to efficientdet.data.service
     kwargs: 
         The extra arguments will be delegated to the correspoding dataset
         builder. Refer to different datasets builders parameters:
         - labelme -> efficientdet.data.labelme.build_dataset
         - VOC -> efficientdet.data.voc.build_datset
+        - tfrecord -> efficientdet.data.records.build_dataset
     """
     assert format in AVAILABLE_FORMATS, \
         'Format must be one of {}'.format(AVAILABLE_FORMATS) 
+    assert data_service is None or (image_cache is None and 
+                                    not packed_images), \
+        'The data service does not support cached nor packed images'
     
+    if buckets is not None:
+        assert image_cache is None and not packed_images, \
+            'Buckets do not support cached nor packed images'
+        assert not isinstance(
+            matcher, efficientdet.utils.matching.GridIoUMatcher), \
+            'Grid matching requires a single input size'
+        # Images of different shapes can only be augmented by batches
+        batched_augmentation = True
+        kwargs['buckets'] = buckets
+
+    # With batched augmentation, the examples are not augmented
+    augment_batches = data_augmentation and batched_augmentation
+    data_augmentation = data_augmentation and not batched_augmentation
+
+    image_store = None
+    if packed_images:
+        assert format != 'tfrecord' and image_cache is None, \
+            'Packed images are not supported with tfrecord nor image cache'
+        image_store = efficientdet.data.store.load_image_store(
+            format, annots_path, im_size, kwargs.get('images_path'))
+
     if format == 'VOC':
         del kwargs['images_path']
         
@@ -48,6 +188,9 @@ def build_ds(format: str,
             annots_path,
             data_augmentation=data_augmentation,
             im_input_size=im_size,
+            image_dtype=image_dtype,
+            image_cache=image_cache,
+            image_store=image_store,
             **kwargs)
 
     elif format == 'labelme':
@@ -62,12 +205,138 @@ def build_ds(format: str,
             class2idx=class2idx,
             im_input_size=im_size,
             data_augmentation=data_augmentation,
+            image_dtype=image_dtype,
+            image_cache=image_cache,
+            image_store=image_store,
             **kwargs)
-        
-    
-    ds = ds.padded_batch(batch_size=batch_size,
-                         padded_shapes=((*im_size, 3), 
-                                       ((None,), (None, 4))),
-                         padding_values=(0., (-1, -1.)))
 
-    return ds, class2idx
\ No newline at end of file
+    elif format == 'tfrecord':
+        assert image_cache is None, \
+            'Images cache is not supported with tfrecord format'
+        kwargs.pop('images_path', None)
+
+        metadata = efficientdet.data.records.load_metadata(annots_path)
+        class2idx = {c: i for i, c in enumerate(metadata['class_names'])}
+        ds = efficientdet.data.records.build_dataset(
+            annots_path,
+            im_input_size=im_size,
+            data_augmentation=data_augmentation,
+            image_dtype=image_dtype,
+            **kwargs)
+
+    # The manifest gives the number of examples without iterating the 
+    # dataset, so the number of steps is known straight away
+    if format == 'tfrecord':
+        num_examples = metadata['num_examples']
+        im_shapes = metadata.get('image_sizes')
+    else:
+        ds_manifest = efficientdet.data.manifest.load_manifest(format, 
+                                                               annots_path)
+        num_examples = ds_manifest['num_examples']
+        im_shapes = [(e['height'], e['width']) 
+                     for e in ds_manifest['examples']]
+
+    targets_params = dict(anchors=anchors, 
+                          num_classes=len(class2idx),
+                          matcher=matcher,
+                          compact=compact_targets,
+                          regression_dtype=regression_dtype)
+
+    # Anchor targets of single examples are assigned along with the rest
+    # of the examples preprocessing
+    assign_example_targets = (buckets is None and not augment_batches and
+                              anchors is not None)
+    if assign_example_targets:
+        assign_targets = partial(_assign_anchor_targets, **targets_params)
+        ds = ds.map(assign_targets, 
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    # The data service workers preprocess the examples, which are batched
+    # in this process, so the batches are the same as without the service
+    if data_service is not None:
+        ds = efficientdet.data.service.distribute(ds, data_service)
+    ds = ds.apply(tf.data.experimental.assert_cardinality(num_examples))
+
+    if buckets is not None:
+        assert im_shapes is not None, \
+            'Export the records again to batch them by buckets'
+
+        # Grouping the examples hides the number of batches, which is 
+        # known from the images sizes
+        num_batches = efficientdet.data.buckets.count_batches(
+            im_shapes, buckets, batch_size)
+        ds = _build_bucketed_ds(ds, buckets, 
+                                batch_size=batch_size,
+                                augment_batches=augment_batches,
+                                anchors=anchors,
+                                ragged=ragged,
+                                targets_params=dict(
+                                    num_classes=len(class2idx),
+                                    matcher=matcher,
+                                    compact=compact_targets,
+                                    regression_dtype=regression_dtype))
+        ds = ds.apply(tf.data.experimental.assert_cardinality(num_batches))
+        return ds, class2idx
+
+    padded_batch = partial(tf.data.Dataset.padded_batch,
+                           batch_size=batch_size,
+                           padded_shapes=((*im_size, 3), 
+                                          ((None,), (None, 4))),
+                           padding_values=(tf.constant(0, image_dtype), 
+                                           (-1, -1.)))
+
+    if augment_batches:
+        assert not ragged, 'Batched augmentation requires padded batches'
+        ds = padded_batch(ds).map(
+            efficientdet.data.preprocess.augment_batch,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        if anchors is not None:
+            ds = ds.map(partial(_assign_batch_anchor_targets, 
+                                **targets_params),
+                        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    elif assign_example_targets:
+        ds = ds.batch(batch_size)
+    elif ragged:
+        ds = ds.apply(
+            tf.data.experimental.dense_to_ragged_batch(batch_size))
+    else:
+        ds = padded_batch(ds)
+
+    ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    num_batches = math.ceil(num_examples / batch_size)
+    ds = ds.apply(tf.data.experimental.assert_cardinality(num_batches))
+    return ds, class2idx
+
+
+def _build_bucketed_ds(ds: tf.data.Dataset,
+                       buckets: Sequence[Tuple[int, int]],
+                       batch_size: int,
+                       augment_batches: bool,
+                       anchors: Mapping[Tuple[int, int], tf.Tensor],
+                       ragged: bool,
+                       targets_params: Mapping) -> tf.data.Dataset:
+    autotune = tf.data.experimental.AUTOTUNE
+
+    ragged = ragged and anchors is None and not augment_batches
+    ds = efficientdet.data.buckets.group_by_bucket(
+        ds, buckets, batch_size, ragged=ragged)
+
+    if augment_batches:
+        ds = ds.map(efficientdet.data.preprocess.augment_batch,
+                    num_parallel_calls=autotune)
+
+    if anchors is not None:
+        assert set(anchors) == set(map(tuple, buckets)), \
+            'Anchors must be generated for every bucket shape'
+
+        def assign_targets(images, annots):
+            bucket_anchors = efficientdet.data.buckets.bucket_anchors(
+                anchors, images)
+            return _assign_batch_anchor_targets(
+                images, annots, anchors=bucket_anchors, **targets_params)
+
+        ds = ds.map(assign_targets, num_parallel_calls=autotune)
+
+    return ds.prefetch(autotune)
@@ -0,0 +1,151 @@
+"""
+Decoded images cache
+
+Decoding the images usually dominates the input pipeline of small and
+medium datasets, even though the resized images would fit in memory. The
+cache keeps the decoded and resized uint8 images, evicting the least
+recently used ones when the byte budget is exceeded. Unlike
+tf.data.Dataset.cache, it works when the dataset does not fit in memory,
+and since it stores the images before the augmentation, the augmentation
+is still random on every epoch.
+
+Only the cache lookups and insertions run in Python, holding the GIL for
+a dictionary access and a copy of the image. Reading, decoding and
+resizing the missing images, as well as converting them to float, are
+graph ops, so they still run in parallel within the dataset map.
+
+Images go through uint8 on every epoch, including the first one, so all
+the epochs see the same pixels. Compared with efficientdet.utils.io
+load_image without cache, float images are rounded to the closest of the
+256 levels before they are scaled and normalized.
+"""
+
+import threading
+import collections
+from typing import Mapping, Tuple
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet.utils.io as io_utils
+
+
+class ImageCache(object):
+    """
+    LRU cache of decoded images bounded by a number of bytes
+
+    Parameters
+    ----------
+    max_bytes: int
+        Memory budget of the cached images in bytes
+
+    Examples
+    --------
+    >>> cache = ImageCache(max_bytes=2 * 2 ** 30)
+    >>> ds, class2idx = build_ds(..., image_cache=cache)
+    >>> # After iterating the dataset
+    >>> cache.stats
+    {'hits': 4000, 'misses': 1000, 'evictions': 0, 'hit_rate': 0.8, ...}
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._images = collections.OrderedDict()
+        # The dataset map calls the cache from multiple threads
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    @property
+    def stats(self) -> Mapping[str, float]:
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    hit_rate=self.hits / lookups if lookups else 0.,
+                    images=len(self),
+                    nbytes=self.nbytes)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: Tuple) -> np.ndarray:
+        """
+        Returns the cached image or None, and records the lookup
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key: Tuple, image: np.ndarray):
+        """
+        Caches the image, evicting the least recently used ones so the
+        cache fits in the memory budget. Images larger than the budget
+        are not cached
+        """
+        if image.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._images:
+                return
+
+            self._images[key] = image
+            self.nbytes += image.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def load_image(self,
+                   im_path: tf.Tensor,
+                   im_size: Tuple[int, int],
+                   normalize_image: bool = False,
+                   dtype: tf.DType = tf.float32) -> tf.Tensor:
+        """
+        Drop-in replacement of efficientdet.utils.io.load_image reading
+        the images from the cache. It can be used within tf.data.Dataset
+        maps. Images are cached as uint8, so float images are quantized
+        to 256 levels before they are normalized
+        """
+        im_size = tuple(im_size)
+
+        def key(path: np.ndarray) -> Tuple:
+            return np.asarray(path).item(), im_size
+
+        def lookup(path: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            image = self.get(key(path))
+            if image is None:
+                return np.array(False), np.zeros((0, 0, 3), dtype=np.uint8)
+            return np.array(True), image
+
+        def insert(path: np.ndarray, image: np.ndarray) -> np.ndarray:
+            # The array may share the buffer of the tensor
+            self.put(key(path), image.copy())
+            return np.array(True)
+
+        def decode() -> tf.Tensor:
+            image = io_utils.load_image(im_path, im_size, dtype=tf.uint8)
+            inserted = tf.numpy_function(insert, [im_path, image], tf.bool)
+            with tf.control_dependencies([inserted]):
+                return tf.identity(image)
+
+        hit, cached = tf.numpy_function(lookup, [im_path],
+                                        [tf.bool, tf.uint8])
+        hit.set_shape([])
+        image = tf.cond(hit, lambda: cached, decode)
+        image.set_shape([*im_size, 3])
+        return io_utils.cast_image(image, dtype, 
+                                   normalize_image=normalize_image)
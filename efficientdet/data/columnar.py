@@ -0,0 +1,229 @@
+"""
+Compiled columnar annotations
+
+Parsing XML or JSON annotations is slow and bound to the Python GIL. The
+annotations of a dataset are compiled once into flat numpy arrays stored
+next to them:
+
+    - images.npy: [N] image file names
+    - sizes.npy: [N, 2] image heights and widths
+    - offsets.npy: [N + 1] the boxes of the i-th image are the rows
+      offsets[i]:offsets[i + 1] of boxes.npy and labels.npy
+    - boxes.npy: [TOTAL_BOXES, 4] boxes in pixels as
+      [xmin, ymin, xmax, ymax]
+    - labels.npy: [TOTAL_BOXES] indices of the label names, which are
+      stored in meta.json
+
+The arrays are stored in a columns-{generation} directory of the
+annotations cache, which meta.json names. Compiling again writes the
+directory of a new generation and then replaces meta.json atomically, so
+the arrays memory mapped by other processes are never modified.
+
+The arrays can be memory mapped, and the datasets are built from them with
+tf.data.Dataset.from_tensor_slices instead of Python generators.
+"""
+
+import json
+import uuid
+import shutil
+from pathlib import Path
+from typing import NamedTuple, Mapping, Sequence, Tuple, Union
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet.utils.bndbox as bb_utils
+from . import manifest
+from .index import CACHE_DIR
+
+
+COLUMNS_DIR = CACHE_DIR
+COLUMNS_VERSION = 3
+
+
+class AnnotationColumns(NamedTuple):
+    images: np.ndarray
+    sizes: np.ndarray
+    offsets: np.ndarray
+    boxes: np.ndarray
+    labels: np.ndarray
+    label_names: Sequence[str]
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+
+def columns_path(annots_path: Union[str, Path]) -> Path:
+    return Path(annots_path) / COLUMNS_DIR
+
+
+def compile_annotations(format: str,
+                        annots_path: Union[str, Path]) -> AnnotationColumns:
+    """
+    Parses all the annotations of a dataset and stores them as columns
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+
+    Returns
+    -------
+    AnnotationColumns
+    """
+    files = manifest.annotation_files(format, annots_path)
+    records = manifest.read_records(format, annots_path)
+
+    label_names = sorted(set(l for r in records for l in r['labels']))
+    label_idx = {l: i for i, l in enumerate(label_names)}
+
+    n_boxes = [len(r['boxes']) for r in records]
+    boxes = [b for r in records for b in r['boxes']]
+    labels = [label_idx[l] for r in records for l in r['labels']]
+
+    columns = AnnotationColumns(
+        images=np.array([r['image'] for r in records], dtype=np.str_),
+        sizes=np.array([[r['height'], r['width']] for r in records],
+                       dtype=np.int32).reshape(-1, 2),
+        offsets=np.cumsum([0] + n_boxes).astype(np.int64),
+        boxes=np.array(boxes, dtype=np.float32).reshape(-1, 4),
+        labels=np.array(labels, dtype=np.int32),
+        label_names=label_names)
+
+    path = columns_path(annots_path)
+    columns_dir = f'columns-{uuid.uuid4().hex}'
+
+    meta = dict(version=COLUMNS_VERSION,
+                format=format,
+                dir=columns_dir,
+                annotations=[f.name for f in files],
+                annotations_digest=manifest.annotations_digest(annots_path,
+                                                               files),
+                label_names=label_names)
+
+    try:
+        # The columns are written to a temporary directory and renamed,
+        # and then published by replacing the metadata
+        tmp_dir = path / f'.{columns_dir}.tmp'
+        tmp_dir.mkdir(parents=True)
+        for name in ('images', 'sizes', 'offsets', 'boxes', 'labels'):
+            np.save(str(tmp_dir / f'{name}.npy'), getattr(columns, name))
+        tmp_dir.rename(path / columns_dir)
+
+        tmp_path = path / 'meta.json.tmp'
+        with tmp_path.open('w') as f:
+            json.dump(meta, f)
+        tmp_path.replace(path / 'meta.json')
+
+        # Processes that mapped the previous columns keep reading them
+        # until they unmap them
+        for old in path.glob('columns-*'):
+            if old.name != columns_dir:
+                shutil.rmtree(old, ignore_errors=True)
+    except OSError:
+        print(f'Cannot write the compiled annotations to {path}')
+
+    return columns
+
+
+def load_annotations(format: str,
+                     annots_path: Union[str, Path],
+                     recompile: bool = False) -> AnnotationColumns:
+    """
+    Loads the compiled annotations of a dataset, memory mapping them. If
+    they do not exist or the annotations have changed since they were
+    compiled, they are compiled again.
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    recompile: bool, default False
+        Compile the annotations even though they are up to date
+
+    Returns
+    -------
+    AnnotationColumns
+    """
+    path = columns_path(annots_path)
+    meta_path = path / 'meta.json'
+
+    if not recompile and meta_path.exists():
+        with meta_path.open() as f:
+            meta = json.load(f)
+
+        files = manifest.annotation_files(format, annots_path)
+        if (meta.get('version') == COLUMNS_VERSION and
+                meta.get('format') == format and
+                (path / meta['dir']).is_dir() and
+                manifest.is_up_to_date(annots_path, files,
+                                       meta['annotations'],
+                                       meta['annotations_digest'])):
+            load = lambda name: np.load(str(path / meta['dir'] / 
+                                            f'{name}.npy'),
+                                        mmap_mode='r')
+            return AnnotationColumns(images=load('images'),
+                                     sizes=load('sizes'),
+                                     offsets=load('offsets'),
+                                     boxes=load('boxes'),
+                                     labels=load('labels'),
+                                     label_names=meta['label_names'])
+
+    return compile_annotations(format, annots_path)
+
+
+def build_annotations_dataset(
+        columns: AnnotationColumns,
+        images_path: Union[str, Path],
+        class2idx: Mapping[str, int],
+        with_sizes: bool = False) -> tf.data.Dataset:
+    """
+    Creates a dataset from the compiled annotations
+
+    Parameters
+    ----------
+    columns: AnnotationColumns
+    images_path: Union[str, Path]
+        Directory containing the images
+    class2idx: Mapping[str, int]
+        Mapping to convert string labels to numbers
+    with_sizes: bool, default False
+        Yield the image heights and widths recorded in the annotations
+        too, as (image_path, size, (labels, boxes))
+
+    Returns
+    -------
+    tf.data.Dataset
+        Dataset yielding (image_path, (labels, boxes)), where the boxes
+        are normalized to the [0, 1] range
+    """
+    images_path = Path(images_path)
+    label_names_to_idx = np.array(
+        [class2idx[l] for l in columns.label_names], dtype=np.int32)
+
+    image_paths = [str(images_path / im) for im in columns.images]
+    offsets = np.asarray(columns.offsets)
+
+    # All the boxes and labels are kept in memory, each example slices
+    # its own rows
+    boxes = tf.constant(np.asarray(columns.boxes))
+    labels = tf.constant(label_names_to_idx[np.asarray(columns.labels)])
+
+    def slice_annots(image_path: tf.Tensor,
+                     size: tf.Tensor,
+                     start: tf.Tensor,
+                     end: tf.Tensor) -> Tuple[tf.Tensor,
+                                              Tuple[tf.Tensor, tf.Tensor]]:
+        im_boxes = bb_utils.normalize_bndboxes(boxes[start: end],
+                                               (size[0], size[1]))
+        if with_sizes:
+            return image_path, size, (labels[start: end], im_boxes)
+        return image_path, (labels[start: end], im_boxes)
+
+    sizes = tf.cast(np.asarray(columns.sizes), tf.float32)
+    ds = tf.data.Dataset.from_tensor_slices(
+        (image_paths, sizes, offsets[:-1], offsets[1:]))
+    return ds.map(slice_annots)
@@ -0,0 +1,194 @@
+"""
+Incremental index of annotation directories
+
+The index stores the parsed record of every annotation file along with
+its modification time, size and content hash. When a dataset is built
+again, only new or modified files are parsed, and deleted ones are
+dropped, so datasets that grow slowly are indexed in seconds.
+"""
+
+import os
+import json
+import hashlib
+import concurrent.futures
+from pathlib import Path
+from typing import Any, Callable, Mapping, Sequence, Union
+
+
+CACHE_DIR = '.annotations_cache'
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 1
+
+# Below this number of files, spawning worker processes is slower than
+# parsing them sequentially
+_MIN_FILES_PER_POOL = 64
+
+Record = Mapping[str, Any]
+
+
+def index_path(annots_path: Union[str, Path]) -> Path:
+    return Path(annots_path) / CACHE_DIR / INDEX_FILE
+
+
+def _file_hash(path: Path) -> str:
+    with path.open('rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _parse_files(files: Sequence[Path],
+                 read_annotation: Callable[[Path], Record],
+                 processes: int = None) -> Sequence[Record]:
+    if processes == 1 or len(files) < _MIN_FILES_PER_POOL:
+        return [read_annotation(f) for f in files]
+
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(files) // (4 * processes))
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(read_annotation, files,
+                                 chunksize=chunksize))
+
+
+class AnnotationIndex(object):
+    """
+    Parsed annotation records indexed by file name
+
+    Parameters
+    ----------
+    path: Union[str, Path]
+        File where the index is stored. If it does not exist, the index
+        starts empty
+
+    Attributes
+    ----------
+    stats: Mapping[str, int]
+        Number of files parsed, reused and removed during the last update
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.entries = self._load()
+        self.stats = dict(parsed=0, reused=0, removed=0)
+
+    def _load(self) -> Mapping[str, Mapping[str, Any]]:
+        if not self.path.exists():
+            return dict()
+
+        with self.path.open() as f:
+            index = json.load(f)
+
+        if index.get('version') != INDEX_VERSION:
+            return dict()
+
+        return index['files']
+
+    def save(self):
+        try:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with tmp_path.open('w') as f:
+                json.dump(dict(version=INDEX_VERSION, files=self.entries), f)
+            # Replace atomically, so an interrupted write never leaves
+            # a corrupted index
+            tmp_path.replace(self.path)
+        except OSError:
+            print(f'Cannot write the annotations index to {self.path}')
+
+    def _stat_matches(self, entry: Mapping[str, Any], path: Path) -> bool:
+        stat = path.stat()
+        return (entry is not None and
+                entry['mtime'] == stat.st_mtime and
+                entry['size'] == stat.st_size)
+
+    def digest(self, files: Sequence[Path]) -> str:
+        """
+        Hash of the names and contents of the given files, which changes
+        whenever a file is added, removed or modified, regardless of its
+        modification time. The indexed hash of a file is reused if its
+        modification time and size have not changed since it was indexed
+
+        Parameters
+        ----------
+        files: Sequence[Path]
+            Current annotation files
+
+        Returns
+        -------
+        str
+        """
+        digest = hashlib.sha1()
+        for f in files:
+            entry = self.entries.get(f.name)
+            if self._stat_matches(entry, f):
+                file_hash = entry['hash']
+            else:
+                file_hash = _file_hash(f)
+            digest.update(f'{f.name}:{file_hash}\n'.encode())
+        return digest.hexdigest()
+
+    def update(self,
+               files: Sequence[Path],
+               read_annotation: Callable[[Path], Record],
+               processes: int = None) -> Sequence[Record]:
+        """
+        Brings the index up to date with the given files and returns
+        their records.
+
+        A file is parsed again only if its modification time or size has
+        changed and its content hash differs from the indexed one. The
+        modified files are parsed using a pool of processes.
+
+        Parameters
+        ----------
+        files: Sequence[Path]
+            Current annotation files. Indexed files not present in this
+            list are dropped
+        read_annotation: Callable[[Path], Record]
+            Function parsing a single annotation file. It must be
+            picklable, so it can be sent to the worker processes
+        processes: int, default None
+            Number of worker processes. Defaults to the number of CPUs
+
+        Returns
+        -------
+        Sequence[Record]
+            Records of the files, in the same order
+        """
+        entries = dict()
+        to_parse = []
+        modified = False
+
+        for f in files:
+            entry = self.entries.get(f.name)
+            if self._stat_matches(entry, f):
+                entries[f.name] = entry
+                continue
+
+            # Touched files whose content has not changed are not parsed
+            modified = True
+            stat = f.stat()
+            digest = _file_hash(f)
+            if entry is not None and entry['hash'] == digest:
+                entries[f.name] = dict(entry,
+                                       mtime=stat.st_mtime,
+                                       size=stat.st_size)
+                continue
+
+            entries[f.name] = dict(mtime=stat.st_mtime,
+                                   size=stat.st_size,
+                                   hash=digest,
+                                   record=None)
+            to_parse.append(f)
+
+        records = _parse_files(to_parse, read_annotation, processes)
+        for f, record in zip(to_parse, records):
+            entries[f.name]['record'] = record
+
+        removed = len(set(self.entries) - set(entries))
+        self.stats = dict(parsed=len(to_parse),
+                          reused=len(files) - len(to_parse),
+                          removed=removed)
+        self.entries = entries
+
+        if modified or removed > 0:
+            self.save()
+
+        return [entries[f.name]['record'] for f in files]
@@ -6,16 +6,14 @@ Read more about labelme here:
 """
 
 import json
-import random
 from pathlib import Path
-from functools import partial
-from typing import Mapping, Tuple, Sequence, Union
+from typing import Any, Mapping, Tuple, Sequence, Union
 
 import tensorflow as tf
 
 import efficientdet.utils.io as io_utils
-import efficientdet.utils.bndbox as bb_utils
-from .preprocess import augment
+from . import columnar
+from .preprocess import augment, scale_boxes
 
 
 def _load_bbox_from_rectangle(points: Sequence[float]) -> Sequence[float]:
@@ -31,27 +29,23 @@ def _load_bbox_from_polygon(points: Sequence[float]) -> Sequence[float]:
     return [xmin, ymin, xmax, ymax]
 
 
-def _load_labelme_instance(
-        images_base_path: Union[str, Path],
-        annot_path: Union[str, Path],
-        im_input_size: Tuple[int, int],
-        class2idx: Mapping[str, int]) -> Tuple[Sequence[int], 
-                                               Sequence[tf.Tensor]]:
-    # Reads a labelme annotation and returns
-    # a list of tuples containing the ground 
-    # truth boxes and its respective label
+def read_annotation(annot_path: Union[str, Path]) -> Mapping[str, Any]:
+    """
+    Parses a labelme annotation file
+
+    Returns
+    -------
+    Mapping[str, Any]
+        Record with the annotation file name, the image path relative to
+        the images directory, the image height and width, the label names
+        and the boxes in pixels as [xmin, ymin, xmax, ymax]
+    """
     with Path(annot_path).open() as f:
         annot = json.load(f)
 
     bbs = []
     labels = []
 
-    image_path = Path(images_base_path) / annot['imagePath']
-    image = io_utils.load_image(str(image_path), 
-                                im_input_size, normalize_image=True)
-    
-    w, h = annot['imageWidth'], annot['imageHeight']
-
     for shape in annot['shapes']:
         shape_type = shape['shape_type']
         if shape_type == 'rectangle':
@@ -61,45 +55,16 @@ def _load_labelme_instance(
         else:
             raise ValueError(
                 f'Unexpected shape type: {shape_type} in file {annot_path}')
-                
-        label = shape['label']
-        bbs.append(points)
-        labels.append(class2idx[label])
-
-    boxes = tf.stack(bbs)
-    boxes = bb_utils.normalize_bndboxes(boxes, (h, w))
-
-    return image, tf.stack(labels), boxes
-
-
-def _labelme_gen(
-        images_base_path: Union[str, Path],
-        annot_files: Sequence[Path],
-        im_input_size: Tuple[int, int],
-        class2idx: Mapping[str, int]):
-
-    for f in annot_files:
-        yield _load_labelme_instance(images_base_path=images_base_path,
-                                     annot_path=f,
-                                     im_input_size=im_input_size,
-                                     class2idx=class2idx)
 
+        bbs.append(points)
+        labels.append(shape['label'])
 
-def _scale_boxes(image: tf.Tensor, 
-                 labels: tf.Tensor, 
-                 boxes: tf.Tensor, 
-                 to_size: Tuple[int, int]):
-    
-    # Wrapper function to call scale_boxes on tf dataset pipeline
-    h, w = to_size
-
-    x1, y1, x2, y2 = tf.split(boxes, 4, axis=1)
-    x1 *= w
-    x2 *= w
-    y1 *= h
-    y2 *= h
-    
-    return image, (labels, tf.concat([x1, y1, x2, y2], axis=1))
+    return dict(annotation=Path(annot_path).name,
+                image=annot['imagePath'],
+                height=annot['imageHeight'],
+                width=annot['imageWidth'],
+                labels=labels,
+                boxes=bbs)
 
 
 def build_dataset(annotations_path: Union[str, Path],
@@ -108,7 +73,11 @@ def build_dataset(annotations_path: Union[str, Path],
                   im_input_size: Tuple[int, int],
                   shuffle: bool = True,
                   data_augmentation: bool = False,
-                  batch_size: int = 2) -> tf.data.Dataset:
+                  batch_size: int = 2,
+                  image_dtype: tf.DType = tf.float32,
+                  image_cache: 'ImageCache' = None,
+                  image_store: 'ImageStore' = None,
+                  buckets: Sequence[Tuple[int, int]] = None) -> tf.data.Dataset:
     """
     Create model input pipeline using tensorflow datasets
 
@@ -126,6 +95,18 @@ def build_dataset(annotations_path: Union[str, Path],
         Shuffle the dataset or not
     batch_size: int, default 2
         Training model batch size
+    image_dtype: tf.DType, default tf.float32
+        If tf.uint8, images are not normalized and are kept in the 
+        [0, 255] range. The model normalizes them, refer to 
+        efficientdet.models.layers.ImageNormalization
+    image_cache: efficientdet.data.cache.ImageCache, default None
+        If set, the decoded images are read from this cache
+    image_store: efficientdet.data.store.ImageStore, default None
+        If set, the images are read from the packed images store
+    buckets: Sequence[Tuple[int, int]], default None
+        If set, images are letterboxed within the bucket with the closest
+        aspect ratio instead of being resized to `im_input_size`. Refer
+        to efficientdet.data.buckets
     
     Examples
     --------
@@ -147,32 +128,59 @@ def build_dataset(annotations_path: Union[str, Path],
     tf.data.Dataset
 
     """
+    assert buckets is None or not data_augmentation, \
+        'Letterboxed images must be augmented by batches, refer to ' \
+        'efficientdet.data.preprocess.augment_batch'
+
     annotations_path = Path(annotations_path)
     images_path = Path(images_path)
 
-    # List sorted annotation files
-    annot_files = sorted(annotations_path.glob('*.json'))
-    if shuffle:
-        random.shuffle(annot_files)
+    # Annotations are parsed once and then read from the compiled columns
+    columns = columnar.load_annotations('labelme', annotations_path)
 
     # Scale the boxes with the same shape
-    scale_boxes = partial(_scale_boxes, to_size=im_input_size)
-
-    generator = lambda: _labelme_gen(images_path, 
-                                     annot_files, 
-                                     im_input_size, 
-                                     class2idx)
-    output_shapes = (tf.TensorShape([*im_input_size, 3]), 
-                     tf.TensorShape([None]),
-                     tf.TensorShape([None, 4]))
-
-    ds = (tf.data.Dataset
-          .from_generator(generator=generator, 
-                          output_types=(tf.float32, tf.int32, tf.float32),
-                          output_shapes=output_shapes)
-          .map(scale_boxes))
+    scale_annots = lambda image, labels, boxes: (
+        image, scale_boxes(labels, boxes, to_size=im_input_size))
+
+    if image_store is not None:
+        load_image = image_store.load_image
+    elif image_cache is not None:
+        load_image = image_cache.load_image
+    else:
+        load_image = io_utils.load_image
+
+    load_im = lambda im, annots: (load_image(im, im_input_size, 
+                                             normalize_image=True,
+                                             dtype=image_dtype),
+                                  *annots)
+
+    # The boxes of letterboxed images are scaled to the size of the image
+    # within its bucket. The bucket is chosen from the recorded size, as
+    # when counting the batches of each bucket
+    def load_letterboxed_im(im, im_shape, annots):
+        image, size = io_utils.load_letterboxed_image(
+            im, buckets, normalize_image=True, dtype=image_dtype,
+            im_shape=im_shape)
+        return image, scale_boxes(*annots, 
+                                  to_size=tf.unstack(tf.cast(size, tf.float32)))
+
+    autotune = tf.data.experimental.AUTOTUNE
+    ds = columnar.build_annotations_dataset(columns, images_path, class2idx,
+                                            with_sizes=buckets is not None)
+
+    # Shuffle before loading the images
+    if shuffle:
+        ds = ds.shuffle(len(columns))
+
+    # The annotations only hold the image paths, so the images are read,
+    # decoded and resized in parallel outside the Python interpreter
+    if buckets is None:
+        ds = (ds.map(load_im, num_parallel_calls=autotune)
+              .map(scale_annots, num_parallel_calls=autotune))
+    else:
+        ds = ds.map(load_letterboxed_im, num_parallel_calls=autotune)
 
     if data_augmentation:
-        ds = ds.map(augment)
+        ds = ds.map(augment, num_parallel_calls=autotune)
         
-    return ds
+    return ds.prefetch(autotune)
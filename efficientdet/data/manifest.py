@@ -0,0 +1,208 @@
+"""
+Dataset manifests
+
+A manifest summarizes an annotations directory: the image of each example,
+its size, its number of boxes and the instances of each class. It is
+written once next to the annotations, so the dataset size and statistics
+are known without decoding the images.
+"""
+
+import json
+import collections
+from pathlib import Path
+from typing import Any, Callable, Mapping, Sequence, Union
+
+from . import voc, labelme, index
+
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 2
+
+Record = Mapping[str, Any]
+
+def annotation_files(format: str,
+                     annots_path: Union[str, Path]) -> Sequence[Path]:
+    """
+    Sorted annotation files of a dataset
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    """
+    annots_path = Path(annots_path)
+    if format == 'VOC':
+        return sorted((annots_path / 'Annotations').glob('*.xml'))
+    elif format == 'labelme':
+        # The manifest may be stored along with the labelme annotations
+        return sorted(f for f in annots_path.glob('*.json') 
+                      if f.name != MANIFEST_FILE)
+
+    raise ValueError(f'Unexpected dataset format {format}')
+
+
+def annotation_reader(format: str) -> Callable[[Path], Record]:
+    """
+    Function parsing a single annotation file of the given format. Refer
+    to efficientdet.data.voc.read_annotation
+    """
+    if format == 'VOC':
+        return voc.read_annotation
+    elif format == 'labelme':
+        return labelme.read_annotation
+
+    raise ValueError(f'Unexpected dataset format {format}')
+
+
+def read_records(format: str,
+                 annots_path: Union[str, Path],
+                 processes: int = None) -> Sequence[Record]:
+    """
+    Parsed records of all the annotation files of a dataset, sorted by 
+    file name. Only the files that changed since the last call are 
+    parsed, refer to efficientdet.data.index.AnnotationIndex
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    processes: int, default None
+        Number of processes used to parse the modified files
+    """
+    files = annotation_files(format, annots_path)
+    annots_index = index.AnnotationIndex(index.index_path(annots_path))
+    return annots_index.update(files, annotation_reader(format), processes)
+
+
+def manifest_path(annots_path: Union[str, Path]) -> Path:
+    return Path(annots_path) / MANIFEST_FILE
+
+
+def annotations_digest(annots_path: Union[str, Path],
+                       files: Sequence[Path]) -> str:
+    """
+    Hash of the annotation files of a dataset, refer to
+    efficientdet.data.index.AnnotationIndex.digest
+    """
+    annots_index = index.AnnotationIndex(index.index_path(annots_path))
+    return annots_index.digest(files)
+
+
+def build_manifest(format: str, annots_path: Union[str, Path]) -> Record:
+    """
+    Parses all the annotations of a dataset and summarizes them
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+
+    Returns
+    -------
+    Mapping[str, Any]
+        The manifest containing the number of examples, the class
+        histogram of the whole dataset and the summary of each example
+    """
+    files = annotation_files(format, annots_path)
+
+    examples = []
+    class_histogram = collections.Counter()
+
+    for record in read_records(format, annots_path):
+        classes = collections.Counter(record['labels'])
+        class_histogram.update(classes)
+
+        examples.append(dict(annotation=record['annotation'],
+                             image=record['image'],
+                             height=record['height'],
+                             width=record['width'],
+                             n_boxes=len(record['boxes']),
+                             classes=dict(classes)))
+
+    return dict(version=MANIFEST_VERSION,
+                format=format,
+                annotations_digest=annotations_digest(annots_path, files),
+                num_examples=len(examples),
+                class_histogram=dict(class_histogram),
+                examples=examples)
+
+
+def is_up_to_date(annots_path: Union[str, Path],
+                  files: Sequence[Path],
+                  annotations: Sequence[str],
+                  digest: str) -> bool:
+    """
+    Checks if a file derived from the annotations is still valid, that is
+    the annotation files are the same and none has been modified since it
+    was written. Files replaced by others with an older modification time
+    are detected too, as the contents are compared
+
+    Parameters
+    ----------
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    files: Sequence[Path]
+        Current annotation files
+    annotations: Sequence[str]
+        Names of the annotation files when the file was derived
+    digest: str
+        Hash of the annotations when the file was derived, as returned
+        by annotations_digest
+    """
+    if list(annotations) != [f.name for f in files]:
+        return False
+    return digest == annotations_digest(annots_path, files)
+
+
+def load_manifest(format: str,
+                  annots_path: Union[str, Path],
+                  rebuild: bool = False) -> Record:
+    """
+    Loads the manifest of a dataset. If the manifest does not exist or
+    the annotations have changed since it was written, it is built again
+    and stored in the dataset directory.
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    rebuild: bool, default False
+        Build the manifest even though an up to date one exists
+
+    Returns
+    -------
+    Mapping[str, Any]
+        Refer to build_manifest
+    """
+    path = manifest_path(annots_path)
+    files = annotation_files(format, annots_path)
+
+    if not rebuild and path.exists():
+        with path.open() as f:
+            manifest = json.load(f)
+        if (manifest.get('version') == MANIFEST_VERSION and
+                manifest.get('format') == format and
+                is_up_to_date(annots_path, files,
+                              [e['annotation'] for e in manifest['examples']],
+                              manifest['annotations_digest'])):
+            return manifest
+
+    manifest = build_manifest(format, annots_path)
+
+    try:
+        # Replace atomically, so concurrent readers never see a partially
+        # written manifest
+        tmp_path = path.with_suffix('.json.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(manifest, f)
+        tmp_path.replace(path)
+    except OSError:
+        # Read only datasets are still usable, but the manifest is
+        # built every time
+        print(f'Cannot write the dataset manifest to {path}')
+
+    return manifest
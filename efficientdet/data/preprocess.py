@@ -47,6 +47,38 @@ def unnormalize_image(image: tf.Tensor) -> tf.Tensor:
     return image * std + mean
 
 
+def scale_boxes(labels: tf.Tensor,
+                boxes: tf.Tensor,
+                to_size: Tuple[int, int]) -> _Annots:
+    """
+    Scales boxes normalized to the [0, 1] range to an image size
+
+    Parameters
+    ----------
+    labels: tf.Tensor of shape [N]
+        Returned as is, so the function can be mapped over the 
+        annotations of a dataset
+    boxes: tf.Tensor of shape [N, 4]
+        Normalized boxes in [x1, y1, x2, y2] format
+    to_size: Tuple[int, int]
+        Height and width of the image
+
+    Returns
+    -------
+    Tuple[tf.Tensor, tf.Tensor]
+        The labels and the boxes in pixels
+    """
+    h, w = to_size
+
+    x1, y1, x2, y2 = tf.split(boxes, 4, axis=1)
+    x1 *= w
+    x2 *= w
+    y1 *= h
+    y2 *= h
+    
+    return labels, tf.concat([x1, y1, x2, y2], axis=1)
+
+
 def horizontal_flip(image: tf.Tensor, 
                     annots: _Annots) -> Tuple[tf.Tensor, _Annots]:
     labels, boxes = annots
@@ -91,6 +123,8 @@ def crop(image: tf.Tensor,
     crop_im = tf.image.crop_to_bounding_box(
         image, x[0], y[0], crop_height[0], crop_width[0])
     crop_im = tf.image.resize(crop_im, image.shape[:-1])
+    if image.dtype == tf.uint8:
+        crop_im = tf.saturate_cast(tf.round(crop_im), tf.uint8)
     
     # Clip the boxes to fit inside the crop
     x1, y1, x2, y2 = tf.split(boxes, 4, axis=-1)
@@ -153,4 +187,95 @@ def augment(image: tf.Tensor,
                             lambda: crop(image, annots),
                             lambda: no_transform(image, annots))
                             
-    return image, annots
\ No newline at end of file
+    return image, annots
+
+
+def augment_batch(images: tf.Tensor, 
+                  annots: _Annots,
+                  flip_prob: float = .5,
+                  crop_prob: float = .5) -> Tuple[tf.Tensor, _Annots]:
+    """
+    Vectorized version of `augment` for padded batches. Random horizontal
+    flips and crops are applied to the whole batch with a single 
+    tf.image.crop_and_resize, so it does not depend on static shapes and
+    it can run on the accelerator.
+
+    As in `crop`, crops keep from 40% to 80% of the image and the boxes
+    smaller than the 1% of the image area after the crop are removed.
+    Removed boxes are replaced by padding, that is labels are set to -1
+    and boxes to [-1, -1, -1, -1].
+
+    Parameters
+    ----------
+    images: tf.Tensor of shape [BATCH, H, W, C]
+    annots: Tuple[tf.Tensor, tf.Tensor]
+        Labels of shape [BATCH, MAX_INSTANCES] and boxes in pixels 
+        of shape [BATCH, MAX_INSTANCES, 4], padded with -1 
+    flip_prob: float, default .5
+        Probability of flipping each image
+    crop_prob: float, default .5
+        Probability of cropping each image
+
+    Returns
+    -------
+    Tuple[tf.Tensor, Tuple[tf.Tensor, tf.Tensor]]
+        Augmented images with the same type and shape as the inputs, and
+        their annotations
+    """
+    labels, boxes = annots
+    im_shape = tf.shape(images)
+    batch_size = im_shape[0]
+    h = tf.cast(im_shape[1], tf.float32)
+    w = tf.cast(im_shape[2], tf.float32)
+
+    # Crop windows in normalized coordinates, the full image when the 
+    # example is not cropped
+    is_cropped = tf.random.uniform([batch_size]) < crop_prob
+    crop_factor = tf.gather(tf.linspace(.4, .8, 4),
+                            tf.random.uniform([batch_size], maxval=4, 
+                                              dtype=tf.int32))
+    crop_factor = tf.where(is_cropped, crop_factor, 1.)
+    y1 = tf.random.uniform([batch_size]) * (1. - crop_factor)
+    x1 = tf.random.uniform([batch_size]) * (1. - crop_factor)
+    y2 = y1 + crop_factor
+    x2 = x1 + crop_factor
+
+    # crop_and_resize flips the crops whose x1 is greater than x2
+    is_flipped = tf.random.uniform([batch_size]) < flip_prob
+    x1, x2 = tf.where(is_flipped, x2, x1), tf.where(is_flipped, x1, x2)
+
+    crop_boxes = tf.stack([y1, x1, y2, x2], axis=-1)
+    aug_images = tf.image.crop_and_resize(
+        images, crop_boxes, tf.range(batch_size), im_shape[1:3])
+    if images.dtype == tf.uint8:
+        aug_images = tf.saturate_cast(tf.round(aug_images), tf.uint8)
+    else:
+        aug_images = tf.cast(aug_images, images.dtype)
+
+    # Map the boxes to the crop windows. Pixel i of the output samples the
+    # normalized coordinate start + i / (size - 1) * (end - start)
+    def remap(coords, start, end, size):
+        start = tf.reshape(start, [-1, 1])
+        end = tf.reshape(end, [-1, 1])
+        return (coords / (size - 1.) - start) / (end - start) * (size - 1.)
+
+    bx1, by1, bx2, by2 = tf.unstack(boxes, axis=-1)
+    bx1, bx2 = remap(bx1, x1, x2, w), remap(bx2, x1, x2, w)
+    by1, by2 = remap(by1, y1, y2, h), remap(by2, y1, y2, h)
+
+    # Flipped boxes have their x coordinates swapped
+    new_boxes = tf.stack([tf.minimum(bx1, bx2), by1, 
+                          tf.maximum(bx1, bx2), by2], axis=-1)
+    new_boxes = bb_utils.clip_boxes(new_boxes, (h, w))
+
+    # Remove the boxes out of the crops and the tiny ones
+    nx1, ny1, nx2, ny2 = tf.unstack(new_boxes, axis=-1)
+    areas = tf.maximum(nx2 - nx1, 0.) * tf.maximum(ny2 - ny1, 0.)
+    min_area = tf.where(tf.expand_dims(is_cropped, -1), .01 * h * w, 0.)
+    is_valid = tf.reduce_max(boxes, axis=-1) >= 0
+    keep = tf.logical_and(is_valid, areas > min_area)
+
+    labels = tf.where(keep, labels, -1)
+    new_boxes = tf.where(tf.expand_dims(keep, -1), new_boxes, -1.)
+
+    return aug_images, (labels, new_boxes)
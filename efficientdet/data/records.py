@@ -0,0 +1,308 @@
+"""
+Sharded TFRecord datasets
+
+A VOC or labelme dataset can be exported to N TFRecord shards holding the
+encoded images along with their boxes and labels. Reading a few large
+shards in parallel scales across cores and avoids opening millions of
+small files, which is slow on network filesystems.
+
+Export a dataset from the command line:
+
+    $ python -m efficientdet.data.records \
+        --format VOC \
+        --dataset data/VOC2007 \
+        --output data/VOC2007-records \
+        --num-shards 16
+"""
+
+import json
+from pathlib import Path
+from typing import Mapping, Sequence, Tuple, Union
+
+import click
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet.utils.io as io_utils
+from . import manifest, voc
+from .preprocess import augment, scale_boxes
+
+
+METADATA_FILE = 'records.json'
+SHARD_PATTERN = 'shard-*.tfrecord'
+
+_FEATURES = {
+    'image/encoded': tf.io.FixedLenFeature([], tf.string),
+    'image/filename': tf.io.FixedLenFeature([], tf.string),
+    'image/height': tf.io.FixedLenFeature([], tf.int64),
+    'image/width': tf.io.FixedLenFeature([], tf.int64),
+    'image/object/bbox': tf.io.VarLenFeature(tf.float32),
+    'image/object/label': tf.io.VarLenFeature(tf.int64),
+}
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values: Sequence[int]) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def _float_feature(values: Sequence[float]) -> tf.train.Feature:
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def _serialize_example(record: manifest.Record,
+                       image_bytes: bytes,
+                       class2idx: Mapping[str, int]) -> bytes:
+    h, w = record['height'], record['width']
+
+    # Boxes are normalized as efficientdet.utils.bndbox.normalize_bndboxes
+    boxes = np.array(record['boxes'], dtype=np.float32).reshape(-1, 4)
+    boxes /= np.array([w - 1, h - 1, w - 1, h - 1], dtype=np.float32)
+    labels = [class2idx[l] for l in record['labels']]
+
+    features = {
+        'image/encoded': _bytes_feature(image_bytes),
+        'image/filename': _bytes_feature(record['image'].encode()),
+        'image/height': _int64_feature([h]),
+        'image/width': _int64_feature([w]),
+        'image/object/bbox': _float_feature(boxes.reshape(-1).tolist()),
+        'image/object/label': _int64_feature(labels),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=features))
+    return example.SerializeToString()
+
+
+def export_tfrecords(format: str,
+                     annots_path: Union[str, Path],
+                     output_path: Union[str, Path],
+                     num_shards: int = 8,
+                     images_path: Union[str, Path] = None,
+                     class_names: Sequence[str] = None) -> Mapping:
+    """
+    Exports a dataset to sharded TFRecord files
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    output_path: Union[str, Path]
+        Directory where the shards and the records metadata are written.
+        The shards of previous exports to the same directory are removed
+    num_shards: int, default 8
+        Number of TFRecord files. Examples are distributed round robin
+    images_path: Union[str, Path], default None
+        Base path to images. Required when using labelme format
+    class_names: Sequence[str], default None
+        Name of the labels. Required when using labelme format
+
+    Returns
+    -------
+    Mapping
+        The records metadata, containing the class names, the number of
+        examples, the number of shards, their file names and the images
+        sizes
+    """
+    if format == 'VOC':
+        images_path = Path(annots_path) / 'JPEGImages'
+        class_names = voc.IDX_2_LABEL
+    else:
+        assert images_path is not None, 'Images base path missing'
+        assert class_names, 'You must specify class names'
+        images_path = Path(images_path)
+
+    class2idx = {c: i for i, c in enumerate(class_names)}
+    output_path = Path(output_path)
+    output_path.mkdir(exist_ok=True, parents=True)
+
+    # Shards are written with temporary names and renamed once complete
+    shard_names = [f'shard-{i:05d}-of-{num_shards:05d}.tfrecord'
+                   for i in range(num_shards)]
+    tmp_paths = [output_path / f'.{name}.tmp' for name in shard_names]
+    writers = [tf.io.TFRecordWriter(str(p)) for p in tmp_paths]
+
+    records = manifest.read_records(format, annots_path)
+    for i, record in enumerate(records):
+        with (images_path / record['image']).open('rb') as f:
+            image_bytes = f.read()
+
+        example = _serialize_example(record, image_bytes, class2idx)
+        writers[i % num_shards].write(example)
+
+    for w in writers:
+        w.close()
+    for tmp_path, name in zip(tmp_paths, shard_names):
+        tmp_path.replace(output_path / name)
+
+    # Images sizes allow to know the number of batches when grouping the
+    # images by aspect ratio, refer to efficientdet.data.buckets. The 
+    # shards are listed so the ones of previous exports are never read
+    metadata = dict(format=format,
+                    class_names=list(class_names),
+                    num_examples=len(records),
+                    num_shards=num_shards,
+                    shards=shard_names,
+                    image_sizes=[[r['height'], r['width']] for r in records])
+    metadata_path = output_path / METADATA_FILE
+    tmp_path = metadata_path.with_suffix('.json.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(metadata, f)
+    tmp_path.replace(metadata_path)
+
+    # Shards of previous exports with a different number of shards
+    for path in output_path.glob(SHARD_PATTERN):
+        if path.name not in shard_names:
+            path.unlink()
+
+    return metadata
+
+
+def load_metadata(records_path: Union[str, Path]) -> Mapping:
+    """
+    Reads the metadata written by export_tfrecords
+    """
+    with (Path(records_path) / METADATA_FILE).open() as f:
+        return json.load(f)
+
+
+def _parse_example(serialized: tf.Tensor) -> Tuple[tf.Tensor,
+                                                   tf.Tensor,
+                                                   Tuple[tf.Tensor,
+                                                         tf.Tensor]]:
+    example = tf.io.parse_single_example(serialized, _FEATURES)
+    boxes = tf.reshape(tf.sparse.to_dense(example['image/object/bbox']),
+                       [-1, 4])
+    labels = tf.cast(tf.sparse.to_dense(example['image/object/label']),
+                     tf.int32)
+    im_shape = tf.stack([example['image/height'], example['image/width']])
+    return example['image/encoded'], im_shape, (labels, boxes)
+
+
+def build_dataset(records_path: Union[str, Path],
+                  im_input_size: Tuple[int, int],
+                  shuffle: bool = True,
+                  data_augmentation: bool = False,
+                  cycle_length: int = 8,
+                  shuffle_buffer: int = 1024,
+                  image_dtype: tf.DType = tf.float32,
+                  buckets: Sequence[Tuple[int, int]] = None) -> tf.data.Dataset:
+    """
+    Create model input pipeline from the TFRecord shards
+
+    Parameters
+    ----------
+    records_path: Union[Path, str]
+        Directory containing the shards written by export_tfrecords
+    im_input_size: Tuple[int, int]
+        Model input size. Images will automatically be resized to this
+        shape
+    shuffle: bool, default True
+        Shuffle the order of the shards and the examples
+    data_augmentation: bool, default False
+        Wether or not to apply data augmentation
+    cycle_length: int, default 8
+        Number of shards read concurrently
+    shuffle_buffer: int, default 1024
+        Number of examples of the shuffle buffer
+    image_dtype: tf.DType, default tf.float32
+        If tf.uint8, images are not normalized and are kept in the 
+        [0, 255] range. The model normalizes them, refer to 
+        efficientdet.models.layers.ImageNormalization
+    buckets: Sequence[Tuple[int, int]], default None
+        If set, images are letterboxed within the bucket with the closest
+        aspect ratio instead of being resized to `im_input_size`. Refer
+        to efficientdet.data.buckets
+
+    Returns
+    -------
+    tf.data.Dataset
+    """
+    assert buckets is None or not data_augmentation, \
+        'Letterboxed images must be augmented by batches, refer to ' \
+        'efficientdet.data.preprocess.augment_batch'
+
+    autotune = tf.data.experimental.AUTOTUNE
+
+    # Only the shards of the last export are read
+    metadata = load_metadata(records_path)
+    assert 'shards' in metadata, \
+        'Export the records again to list their shards'
+    shard_paths = [str(Path(records_path) / name) 
+                   for name in metadata['shards']]
+
+    decode = lambda im, im_shape, annots: (
+        io_utils.decode_image(im, im_input_size, normalize_image=True,
+                              dtype=image_dtype),
+        scale_boxes(*annots, to_size=im_input_size))
+
+    # The boxes of letterboxed images are scaled to the size of the image
+    # within its bucket. The bucket is chosen from the recorded size, as
+    # when counting the batches of each bucket
+    def decode_letterboxed(im, im_shape, annots):
+        image, size = io_utils.decode_letterboxed_image(
+            im, buckets, normalize_image=True, dtype=image_dtype,
+            im_shape=im_shape)
+        return image, scale_boxes(*annots, 
+                                  to_size=tf.unstack(tf.cast(size, tf.float32)))
+
+    files = tf.data.Dataset.from_tensor_slices(shard_paths)
+    if shuffle:
+        files = files.shuffle(len(shard_paths))
+
+    # Read multiple shards in parallel. When shuffling, the examples
+    # order is not required to be deterministic
+    ds = files.interleave(tf.data.TFRecordDataset,
+                          cycle_length=cycle_length,
+                          num_parallel_calls=autotune,
+                          deterministic=not shuffle)
+
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer)
+
+    ds = ds.map(_parse_example, num_parallel_calls=autotune)
+    if buckets is None:
+        ds = ds.map(decode, num_parallel_calls=autotune)
+    else:
+        ds = ds.map(decode_letterboxed, num_parallel_calls=autotune)
+
+    if data_augmentation:
+        ds = ds.map(augment, num_parallel_calls=autotune)
+
+    return ds
+
+
+@click.command()
+@click.option('--format', type=click.Choice(['VOC', 'labelme']),
+              required=True, help='Format of the dataset to export')
+@click.option('--dataset', type=click.Path(file_okay=False, exists=True),
+              required=True, help='Path to annotations and images')
+@click.option('--images-path', type=click.Path(file_okay=False),
+              default=None, help='Base path to images. '
+                                 'Required when using labelme format')
+@click.option('--classes-names', default='', type=str,
+              help='Only required when format is labelme. '
+                   'Name of classes separated using comma. '
+                   'class1,class2,class3')
+@click.option('--output', type=click.Path(file_okay=False),
+              required=True, help='Directory to write the shards')
+@click.option('--num-shards', type=int, default=8,
+              help='Number of TFRecord files')
+def main(**kwargs):
+    class_names = [c for c in kwargs['classes_names'].split(',') if c]
+    metadata = export_tfrecords(kwargs['format'],
+                                kwargs['dataset'],
+                                kwargs['output'],
+                                num_shards=kwargs['num_shards'],
+                                images_path=kwargs['images_path'],
+                                class_names=class_names)
+    print(f'Exported {metadata["num_examples"]} examples to '
+          f'{metadata["num_shards"]} shards')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Input pipeline offload with tf.data service
+
+Decoding, augmenting the images and assigning the anchor targets compete
+with the training step for the threads of the training process. The
+input pipeline can instead run in separate worker processes, which are
+scaled and pinned to CPU cores independently of the training process.
+The training process then only receives the preprocessed examples over
+the network, and batches them.
+
+A local service is a dispatcher along with N worker processes running on
+the same machine. Either launch it within the training process:
+
+    >>> with LocalService(num_workers=4) as service:
+    ...     ds, class2idx = build_ds(..., data_service=service.target)
+
+Or from the command line, and then pass its address to the training
+script with --data-service grpc://localhost:5050:
+
+    $ python -m efficientdet.data.service \
+        --num-workers 4 \
+        --port 5050 \
+        --cpus 8-15
+"""
+
+import os
+import sys
+import subprocess
+from typing import Sequence
+
+import click
+
+import tensorflow as tf
+
+
+def parse_cpus(cpus: str) -> Sequence[int]:
+    """
+    Parses a list of CPUs as taskset does, for example 0-3,8,10-11
+    """
+    result = []
+    for part in filter(None, cpus.split(',')):
+        start, _, end = part.partition('-')
+        result.extend(range(int(start), int(end or start) + 1))
+    return result
+
+
+class LocalService(object):
+    """
+    tf.data service dispatcher running in this process along with worker
+    processes on the same machine
+
+    Parameters
+    ----------
+    num_workers: int
+        Number of worker processes
+    port: int, default 0
+        Dispatcher port. By default a free port is picked
+    cpus: Sequence[int], default None
+        CPU cores the worker processes are pinned to. Only supported on
+        Linux. By default the workers can run on any core
+    """
+    def __init__(self,
+                 num_workers: int,
+                 port: int = 0,
+                 cpus: Sequence[int] = None):
+        assert num_workers > 0, 'At least one worker is required'
+
+        self.dispatcher = tf.data.experimental.service.DispatchServer(
+            tf.data.experimental.service.DispatcherConfig(port=port))
+        address = self.target.split('://')[-1]
+
+        # Workers run only the input pipeline, so they must not allocate
+        # the accelerators memory
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+        command = [sys.executable, '-c', 
+                   'from efficientdet.data.service import main; main()',
+                   '--worker', '--dispatcher', address]
+        if cpus:
+            command += ['--cpus', ','.join(map(str, cpus))]
+
+        self.workers = [subprocess.Popen(command, env=env)
+                        for _ in range(num_workers)]
+
+    @property
+    def target(self) -> str:
+        """
+        Address of the dispatcher, as given to
+        efficientdet.data.build_ds data_service parameter
+        """
+        return self.dispatcher.target
+
+    def close(self):
+        for w in self.workers:
+            w.terminate()
+        for w in self.workers:
+            w.wait()
+        self.workers = []
+
+    def __enter__(self) -> 'LocalService':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def distribute(ds: tf.data.Dataset, service: str) -> tf.data.Dataset:
+    """
+    Runs the dataset in the tf.data service workers
+
+    Each element of an epoch is produced once, with the elements 
+    dynamically split among the workers, so their order is not kept. 
+    Distribute single examples and batch them afterwards: if the 
+    workers batched their own examples, each one would produce a 
+    partial batch at the end of the epoch
+
+    Parameters
+    ----------
+    ds: tf.data.Dataset
+    service: str
+        Address of the dispatcher, for example grpc://localhost:5050
+
+    Returns
+    -------
+    tf.data.Dataset
+    """
+    return ds.apply(tf.data.experimental.service.distribute(
+        processing_mode=tf.data.experimental.service.ShardingPolicy.DYNAMIC,
+        service=service))
+
+
+def _run_worker(dispatcher: str, cpus: Sequence[int] = None):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    worker = tf.data.experimental.service.WorkerServer(
+        tf.data.experimental.service.WorkerConfig(
+            dispatcher_address=dispatcher))
+    worker.join()
+
+
+@click.command()
+@click.option('--num-workers', type=int, default=1,
+              help='Number of worker processes')
+@click.option('--port', type=int, default=5050,
+              help='Dispatcher port')
+@click.option('--cpus', type=str, default='',
+              help='CPU cores the workers are pinned to, for example 8-15')
+@click.option('--worker', is_flag=True, hidden=True,
+              help='Run a single worker of the given dispatcher')
+@click.option('--dispatcher', type=str, default=None, hidden=True,
+              help='Dispatcher address of the worker')
+def main(**kwargs):
+    cpus = parse_cpus(kwargs['cpus'])
+
+    if kwargs['worker']:
+        _run_worker(kwargs['dispatcher'], cpus)
+        return
+
+    service = LocalService(kwargs['num_workers'],
+                           port=kwargs['port'],
+                           cpus=cpus)
+    print(f'Serving the input pipeline at {service.target} with '
+          f'{kwargs["num_workers"]} workers')
+    try:
+        service.dispatcher.join()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
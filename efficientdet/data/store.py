@@ -0,0 +1,261 @@
+"""
+Packed images stores
+
+The images of a dataset, already resized to a model input size, are packed
+into a single contiguous uint8 array of shape [N, H, W, 3] stored next to
+the annotations:
+
+    - images_{H}x{W}.{generation}.npy: the packed images. The i-th image
+      is the i-th row, so its offset is i * H * W * 3 bytes
+    - images_{H}x{W}.json: the image file names of the rows and the name
+      of the packed images file
+
+Packing again writes a file of a new generation and then replaces the
+metadata atomically, so readers always see a metadata file matching its
+images. The stores are keyed by the input size, so stores for different
+model sizes live side by side.
+
+Training reads the rows from the memory mapped array, so the images are
+decoded only once, and multiple training processes on the same machine
+share the page cache of the file. Reads are not zero-copy though: each
+row is copied from the page cache into the image tensor.
+
+Pack the images from the command line:
+
+    $ python -m efficientdet.data.store \
+        --format VOC \
+        --dataset data/VOC2007 \
+        --im-size 512
+"""
+
+import json
+import uuid
+from pathlib import Path
+from typing import Sequence, Tuple, Union
+
+import click
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet.utils.io as io_utils
+from . import columnar, manifest
+
+
+STORE_VERSION = 3
+
+
+def store_path(annots_path: Union[str, Path],
+               im_size: Tuple[int, int]) -> Path:
+    """
+    Metadata file of the store of the given input size, which names the
+    file of the packed images
+    """
+    h, w = im_size
+    return columnar.columns_path(annots_path) / f'images_{h}x{w}.json'
+
+
+def _images_path(format: str,
+                 annots_path: Union[str, Path],
+                 images_path: Union[str, Path] = None) -> Path:
+    if format == 'VOC':
+        return Path(annots_path) / 'JPEGImages'
+
+    assert images_path, 'Images base path missing'
+    return Path(images_path)
+
+
+class ImageStore(object):
+    """
+    Memory mapped images packed by pack_images
+
+    Parameters
+    ----------
+    images: np.ndarray of shape [N, H, W, 3]
+        Packed uint8 images, usually memory mapped
+    image_paths: Sequence[str]
+        Path of the image of each row, as yielded by the datasets built
+        with efficientdet.data.columnar.build_annotations_dataset
+    """
+    def __init__(self, images: np.ndarray, image_paths: Sequence[str]):
+        self.images = images
+        self.im_size = tuple(images.shape[1:3])
+        self.table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(
+                tf.constant(list(image_paths), tf.string),
+                tf.range(len(image_paths), dtype=tf.int64)),
+            default_value=-1)
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def load_image(self,
+                   im_path: tf.Tensor,
+                   im_size: Tuple[int, int],
+                   normalize_image: bool = False,
+                   dtype: tf.DType = tf.float32) -> tf.Tensor:
+        """
+        Drop-in replacement of efficientdet.utils.io.load_image reading
+        the images from the store. It can be used within tf.data.Dataset
+        maps
+        """
+        assert tuple(im_size) == self.im_size, \
+            f'Images are packed with size {self.im_size}'
+
+        idx = self.table.lookup(im_path)
+        tf.debugging.assert_non_negative(
+            idx, message='Image not found in the store')
+
+        # The row is copied from the page cache, without decoding the image
+        image = tf.numpy_function(lambda i: np.asarray(self.images[i]),
+                                  [idx], tf.uint8, stateful=False)
+        image.set_shape([*im_size, 3])
+        return io_utils.cast_image(image, dtype,
+                                   normalize_image=normalize_image)
+
+
+def pack_images(format: str,
+                annots_path: Union[str, Path],
+                im_size: Tuple[int, int],
+                images_path: Union[str, Path] = None) -> Path:
+    """
+    Decodes and resizes all the images of a dataset and packs them into
+    a single uint8 array
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    im_size: Tuple[int, int]
+        Model input size
+    images_path: Union[str, Path], default None
+        Base path to images. Required when using labelme format
+
+    Returns
+    -------
+    Path
+        Path of the packed images
+    """
+    h, w = im_size
+    meta_path = store_path(annots_path, im_size)
+    meta_path.parent.mkdir(exist_ok=True, parents=True)
+    images_path = _images_path(format, annots_path, images_path)
+
+    files = manifest.annotation_files(format, annots_path)
+    columns = columnar.load_annotations(format, annots_path)
+    image_names = [str(im) for im in columns.images]
+
+    # Images are decoded in parallel, keeping their order
+    ds = (tf.data.Dataset.from_tensor_slices(
+              [str(images_path / im) for im in image_names])
+          .map(lambda p: io_utils.load_image(p, im_size, dtype=tf.uint8),
+               num_parallel_calls=tf.data.experimental.AUTOTUNE))
+
+    # Every packing writes a new file, so the store being read by other
+    # processes is never modified
+    path = meta_path.with_name(f'{meta_path.stem}.{uuid.uuid4().hex}.npy')
+    images = np.lib.format.open_memmap(str(path), mode='w+',
+                                       dtype=np.uint8,
+                                       shape=(len(image_names), h, w, 3))
+    for i, image in enumerate(ds):
+        images[i] = image.numpy()
+    images.flush()
+    del images
+
+    meta = dict(version=STORE_VERSION,
+                format=format,
+                file=path.name,
+                annotations=[f.name for f in files],
+                annotations_digest=manifest.annotations_digest(annots_path,
+                                                               files),
+                images=image_names)
+
+    # Replacing the metadata publishes the new images at once
+    tmp_path = meta_path.with_suffix('.json.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(meta, f)
+    tmp_path.replace(meta_path)
+
+    # Processes that mapped the previous images keep reading them until
+    # they unmap them
+    for old in meta_path.parent.glob(f'{meta_path.stem}.*.npy'):
+        if old != path:
+            old.unlink()
+
+    return path
+
+
+def load_image_store(format: str,
+                     annots_path: Union[str, Path],
+                     im_size: Tuple[int, int],
+                     images_path: Union[str, Path] = None,
+                     repack: bool = False) -> ImageStore:
+    """
+    Memory maps the packed images of a dataset. If they do not exist or
+    the annotations have changed since they were packed, they are packed
+    again.
+
+    Parameters
+    ----------
+    format: str, choice of [VOC, labelme]
+    annots_path: Union[str, Path]
+        Dataset directory, as given to efficientdet.data.build_ds
+    im_size: Tuple[int, int]
+        Model input size
+    images_path: Union[str, Path], default None
+        Base path to images. Required when using labelme format
+    repack: bool, default False
+        Pack the images even though they are up to date
+
+    Returns
+    -------
+    ImageStore
+    """
+    meta_path = store_path(annots_path, im_size)
+
+    meta = None
+    if not repack and meta_path.exists():
+        with meta_path.open() as f:
+            meta = json.load(f)
+
+        files = manifest.annotation_files(format, annots_path)
+        if (meta.get('version') != STORE_VERSION or
+                meta.get('format') != format or
+                not (meta_path.parent / meta['file']).exists() or
+                not manifest.is_up_to_date(annots_path, files,
+                                           meta['annotations'],
+                                           meta['annotations_digest'])):
+            meta = None
+
+    if meta is None:
+        pack_images(format, annots_path, im_size, images_path)
+        with meta_path.open() as f:
+            meta = json.load(f)
+
+    images_path = _images_path(format, annots_path, images_path)
+    images = np.load(str(meta_path.parent / meta['file']), mmap_mode='r')
+    return ImageStore(images, [str(images_path / im)
+                               for im in meta['images']])
+
+
+@click.command()
+@click.option('--format', type=click.Choice(['VOC', 'labelme']),
+              required=True, help='Format of the dataset')
+@click.option('--dataset', type=click.Path(file_okay=False, exists=True),
+              required=True, help='Path to annotations and images')
+@click.option('--images-path', type=click.Path(file_okay=False),
+              default=None, help='Base path to images. '
+                                 'Required when using labelme format')
+@click.option('--im-size', type=int, required=True,
+              help='Model input size, for example 512 for EfficientDet D0')
+def main(**kwargs):
+    im_size = (kwargs['im_size'],) * 2
+    path = pack_images(kwargs['format'], kwargs['dataset'], im_size,
+                       images_path=kwargs['images_path'])
+    print(f'Images packed to {path}')
+
+
+if __name__ == "__main__":
+    main()
@@ -7,15 +7,15 @@ Download the dataset from here:
 
 from pathlib import Path
 from functools import partial
-from typing import Tuple, Sequence, Union
+from typing import Any, Mapping, Tuple, Sequence, Union
 
 import tensorflow as tf
 
 import xml.etree.ElementTree as ET
 
 import efficientdet.utils.io as io_utils
-import efficientdet.utils.bndbox as bb_utils
-from .preprocess import normalize_image, augment
+from . import columnar
+from .preprocess import normalize_image, augment, scale_boxes
 
 
 IDX_2_LABEL = [
@@ -47,56 +47,47 @@ IDX_2_LABEL = [
 LABEL_2_IDX = {l: i for i, l in enumerate(IDX_2_LABEL)}
 
 
-def _read_voc_annot(annot_path: str) -> Tuple[Sequence[int], 
-                                              Sequence[tf.Tensor]]:
-    # Reads a voc annotation and returns
-    # a list of tuples containing the ground 
-    # truth boxes and its respective label
-    root = ET.parse(annot_path).getroot()
-    image_size = (int(root.findtext('size/height')), 
-                  int(root.findtext('size/width')))
+def read_annotation(annot_path: Union[str, Path]) -> Mapping[str, Any]:
+    """
+    Parses a VOC annotation file
+
+    Returns
+    -------
+    Mapping[str, Any]
+        Record with the annotation file name, the image file name, the
+        image height and width, the label names and the boxes in pixels
+        as [xmin, ymin, xmax, ymax]
+    """
+    root = ET.parse(str(annot_path)).getroot()
 
-    boxes = root.findall('object')
     bbs = []
     labels = []
 
-    for b in boxes:
+    for b in root.findall('object'):
         bb = b.find('bndbox')
-        bb = (int(bb.findtext('xmin')), 
+        bb = [int(bb.findtext('xmin')), 
               int(bb.findtext('ymin')), 
               int(bb.findtext('xmax')), 
-              int(bb.findtext('ymax')))
+              int(bb.findtext('ymax'))]
         bbs.append(bb)
-        labels.append(LABEL_2_IDX[b.findtext('name')])
-
-    bbs = tf.stack(bbs)
-    bbs = bb_utils.normalize_bndboxes(bbs, image_size)
-
-    return labels, bbs
-
+        labels.append(b.findtext('name'))
 
-def _annot_gen(annot_file: Sequence[Path]):
-    for f in annot_file:
-        yield _read_voc_annot(str(f))
-
-
-def _scale_boxes(labels: tf.Tensor, boxes: tf.Tensor, 
-                 to_size: Tuple[int, int]):
-    h, w = to_size
-
-    x1, y1, x2, y2 = tf.split(boxes, 4, axis=1)
-    x1 *= w
-    x2 *= w
-    y1 *= h
-    y2 *= h
-    
-    return labels, tf.concat([x1, y1, x2, y2], axis=1)
+    return dict(annotation=Path(annot_path).name,
+                image=root.findtext('filename'),
+                height=int(root.findtext('size/height')),
+                width=int(root.findtext('size/width')),
+                labels=labels,
+                boxes=bbs)
 
 
 def build_dataset(dataset_path: Union[str, Path],
                   im_input_size: Tuple[int, int],
                   shuffle: bool = True,
-                  data_augmentation: bool = False) -> tf.data.Dataset:
+                  data_augmentation: bool = False,
+                  image_dtype: tf.DType = tf.float32,
+                  image_cache: 'ImageCache' = None,
+                  image_store: 'ImageStore' = None,
+                  buckets: Sequence[Tuple[int, int]] = None) -> tf.data.Dataset:
     """
     Create model input pipeline using tensorflow datasets
 
@@ -111,6 +102,19 @@ def build_dataset(dataset_path: Union[str, Path],
         shape
     data_augmentation: bool, default False
         Wether or not to apply data augmentation
+    image_dtype: tf.DType, default tf.float32
+        If tf.uint8, images are not normalized and are kept in the 
+        [0, 255] range. The model normalizes them, refer to 
+        efficientdet.models.layers.ImageNormalization
+    image_cache: efficientdet.data.cache.ImageCache, default None
+        If set, the decoded images are read from this cache
+    image_store: efficientdet.data.store.ImageStore, default None
+        If set, the images are read from the packed images store
+    buckets: Sequence[Tuple[int, int]], default None
+        If set, images are letterboxed within the bucket with the closest
+        aspect ratio instead of being resized to `im_input_size`. Refer
+        to efficientdet.data.buckets
+
     Examples
     --------
     
@@ -129,37 +133,57 @@ def build_dataset(dataset_path: Union[str, Path],
     tf.data.Dataset
 
     """
+    assert buckets is None or not data_augmentation, \
+        'Letterboxed images must be augmented by batches, refer to ' \
+        'efficientdet.data.preprocess.augment_batch'
+
     dataset_path = Path(dataset_path)
     im_path = dataset_path / 'JPEGImages'
-    annot_path = dataset_path / 'Annotations'
 
-    # List sorted annotation files
-    annot_files = sorted(annot_path.glob('*.xml'))
+    # Annotations are parsed once and then read from the compiled columns
+    columns = columnar.load_annotations('VOC', dataset_path)
     
     # Partially evaluate image loader to resize images
     # always with the same shape and normalize them
-    load_im = lambda im, annots: (io_utils.load_image(im, im_input_size, 
-                                                      normalize_image=True),
+    if image_store is not None:
+        load_image = image_store.load_image
+    elif image_cache is not None:
+        load_image = image_cache.load_image
+    else:
+        load_image = io_utils.load_image
+
+    load_im = lambda im, annots: (load_image(im, im_input_size, 
+                                             normalize_image=True,
+                                             dtype=image_dtype),
                                   annots)
-    scale_boxes = partial(_scale_boxes, to_size=im_input_size)
-
-    # We assume that tf datasets list files sorted when shuffle=False
-    im_ds = tf.data.Dataset.list_files(str(im_path / '*.jpg'), shuffle=False)
-    annot_ds = (tf.data.Dataset
-                .from_generator(generator=lambda: _annot_gen(annot_files), 
-                                output_types=(tf.int32, tf.float32))
-                .map(scale_boxes))
-
-    # Join both datasets
-    ds = tf.data.Dataset.zip((im_ds, annot_ds))
+    scale_annots = partial(scale_boxes, to_size=im_input_size)
+
+    # The boxes of letterboxed images are scaled to the size of the image
+    # within its bucket. The bucket is chosen from the recorded size, as
+    # when counting the batches of each bucket
+    def load_letterboxed_im(im, im_shape, annots):
+        image, size = io_utils.load_letterboxed_image(
+            im, buckets, normalize_image=True, dtype=image_dtype,
+            im_shape=im_shape)
+        return image, scale_boxes(*annots, 
+                                  to_size=tf.unstack(tf.cast(size, tf.float32)))
+
+    autotune = tf.data.experimental.AUTOTUNE
+    ds = columnar.build_annotations_dataset(columns, im_path, LABEL_2_IDX,
+                                            with_sizes=buckets is not None)
+    if buckets is None:
+        ds = ds.map(lambda im, annots: (im, scale_annots(*annots)))
 
     # Shuffle before loading the images
     if shuffle:
         ds = ds.shuffle(1024)
 
-    ds = ds.map(load_im)
+    if buckets is None:
+        ds = ds.map(load_im, num_parallel_calls=autotune)
+    else:
+        ds = ds.map(load_letterboxed_im, num_parallel_calls=autotune)
 
     if data_augmentation:
-        ds = ds.map(augment)
+        ds = ds.map(augment, num_parallel_calls=autotune)
     
-    return ds
+    return ds.prefetch(autotune)
@@ -1,4 +1,5 @@
 import copy
+import collections
 from typing import Callable, Tuple, Mapping, Sequence
 
 import tensorflow as tf
@@ -7,16 +8,18 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 
 import efficientdet.utils as utils
+from efficientdet import optim
 
 LossFn = Callable[[tf.Tensor] * 4, Tuple[tf.Tensor, tf.Tensor]]
 import time
 
 
-def get_lr(optimizer):
-    lr = optimizer.learning_rate
-    if isinstance(lr, tf.keras.optimizers.schedules.LearningRateSchedule):
-        return lr.current_lr
-    return lr
+def get_lr(optimizer) -> float:
+    # With a schedule, the optimizer evaluates it at its iterations, so
+    # the value is also right when the steps run within a tf.function.
+    # The learning rate may be a tf.Variable, which does not support
+    # format specifiers
+    return float(optimizer.learning_rate)
 
 
 def _train_step(model: tf.keras.Model,
@@ -27,9 +30,9 @@ def _train_step(model: tf.keras.Model,
                 labels: tf.Tensor) -> Tuple[float, float]:
     
     with tf.GradientTape() as tape:
-        regressors, clf_probas = model(images)
+        regressors, clf_logits = model(images)
 
-        reg_loss, clf_loss = loss_fn(labels, clf_probas, 
+        reg_loss, clf_loss = loss_fn(labels, clf_logits, 
                                     regress_targets, regressors)
         l2_loss = 4e-5 * sum([tf.reduce_sum(tf.pow(w, 2)) 
                               for w in model.trainable_variables])
@@ -49,61 +52,470 @@ def train_single_epoch(model: tf.keras.Model,
                        epoch: int,
                        num_classes: int,
                        print_every: int = 10):
-    
-    @tf.function(
-        input_signature=[tf.TensorSpec(shape=[None, None, None, 3], 
-                                       dtype=tf.float32),
-                         tf.TensorSpec(shape=[None, None, 5], 
-                                       dtype=tf.float32),
-                         tf.TensorSpec(shape=[None, None, num_classes + 1], 
-                                       dtype=tf.float32)])
-    def train_step(images, r_targets, c_targets):
+    """
+    Trains the model for a single epoch
+
+    Every call traces the training step again. To train for more than
+    one epoch use efficientdet.engine.Trainer instead, which keeps the
+    compiled step functions across epochs
+
+    Parameters
+    ----------
+    anchors: tf.Tensor of shape [N_ANCHORS, 4]
+        Anchors used to compute the targets of each batch. When set to None,
+        the dataset must already yield the targets as 
+        (images, (regression_targets, class_targets)). 
+        See efficientdet.data.build_ds anchors parameter
+    """
+    trainer = Trainer(model=model,
+                      optimizer=optimizer,
+                      loss_fn=loss_fn,
+                      num_classes=num_classes,
+                      anchors=anchors,
+                      grad_accum_steps=grad_accum_steps,
+                      print_every=print_every)
+    trainer.epoch = epoch
+    trainer.train_epoch(dataset, steps=steps)
+
+
+class Trainer(object):
+    """
+    Owns the model, the optimizer and the compiled step functions, so the
+    graphs are traced once and reused across epochs.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+    optimizer: tf.optimizers.Optimizer
+    loss_fn: LossFn
+    num_classes: int
+    anchors: tf.Tensor of shape [N_ANCHORS, 4], default None
+        Anchors used to compute the targets of each batch. When set to None,
+        the datasets must already yield the targets as
+        (images, (regression_targets, class_targets)).
+        See efficientdet.data.build_ds anchors parameter
+    grad_accum_steps: int, default 1
+        Number of steps to accumulate the gradients before updating the
+        model weights
+    average_gradients: bool, default False
+        Update the weights with the mean of the accumulated gradients 
+        instead of their sum
+    steps_per_execution: int, default 1
+        Number of training steps run within a single call to the compiled
+        function. Larger values reduce the Python overhead per step
+    jit_compile: bool, default False
+        Compile the forward and backward passes with XLA. Requires a loss
+        function with static shapes, as efficientdet.train.loss_fn
+    augment_fn: Callable, default None
+        Augmentation applied to the padded batches within the training 
+        step, so it runs on the accelerator. For example 
+        efficientdet.data.preprocess.augment_batch. Requires the anchors
+    print_every: int, default 10
+        Report the running losses every `print_every` steps
+    checkpoint_dir: str, default None
+        Directory where the training state is checkpointed every 
+        `checkpoint_every` steps, so an interrupted training can be 
+        resumed in the middle of an epoch with Trainer.restore. The state
+        contains the model variables, the optimizer slots and iterations,
+        which drive the learning rate schedule, the accumulated gradients,
+        the epoch and step counters and the dataset iterator, including
+        its shuffle buffer. Datasets distributed with tf.data service
+        cannot be checkpointed
+    checkpoint_every: int, default None
+        Number of training steps between checkpoints. Requires 
+        `checkpoint_dir`
+    max_checkpoints: int, default 3
+        Number of most recent checkpoints kept in `checkpoint_dir`
+
+    Attributes
+    ----------
+    trace_counts: collections.Counter
+        Number of times each step function has been traced. When the model
+        variables are created within the first step, TensorFlow traces it
+        twice. Once the first epoch has finished, the counts are not 
+        expected to increase
+    val_map: float
+        COCO mAP computed by Trainer.fit at the end of the last epoch, or
+        None if the epoch has not been validated
+    """
+    def __init__(self,
+                 model: tf.keras.Model,
+                 optimizer: tf.optimizers.Optimizer,
+                 loss_fn: LossFn,
+                 num_classes: int,
+                 anchors: tf.Tensor = None,
+                 grad_accum_steps: int = 1,
+                 average_gradients: bool = False,
+                 steps_per_execution: int = 1,
+                 jit_compile: bool = False,
+                 augment_fn: Callable = None,
+                 print_every: int = 10,
+                 checkpoint_dir: str = None,
+                 checkpoint_every: int = None,
+                 max_checkpoints: int = 3):
+        assert augment_fn is None or anchors is not None, \
+            'Augmenting the batches requires the anchors to compute the targets'
+        assert checkpoint_every is None or checkpoint_dir is not None, \
+            'Checkpointing the training state requires a directory'
+
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.num_classes = num_classes
+        self.anchors = anchors
+        self.augment_fn = augment_fn
+        self.steps_per_execution = steps_per_execution
+        self.print_every = print_every
+
+        # The input pipeline and the weights update cannot be compiled
+        # with XLA, so only the forward and backward passes are
+        if jit_compile:
+            self._forward_backward = tf.function(self._compute_gradients, 
+                                                 jit_compile=True)
+        else:
+            self._forward_backward = self._compute_gradients
+
+        self.accumulator = optim.GradientAccumulator(
+            optimizer, accum_steps=grad_accum_steps, 
+            average=average_gradients)
+
+        self.running_loss = tf.metrics.Mean()
+        self.running_clf_loss = tf.metrics.Mean()
+        self.running_reg_loss = tf.metrics.Mean()
+
+        self.epoch = 0
+        self.trace_counts = collections.Counter()
+        self.val_map = None
+
+        # Counters are mirrored in variables to be checkpointed
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.max_checkpoints = max_checkpoints
+        self._epoch_var = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self._step_var = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self._global_step_var = tf.Variable(0, trainable=False, 
+                                            dtype=tf.int64)
+        self._checkpoint_manager = None
+        self._resume_path = None
+        self._resume_step = 0
+
+        # Compiled inference functions indexed by their input signature
+        self._predict_steps = dict()
+
+    def _state(self) -> Mapping[str, object]:
+        # Keras layers held in lists are not tracked by tf.train.Checkpoint,
+        # so the variables are checkpointed explicitly in their creation
+        # order. Therefore, they must exist before saving or restoring.
+        # The model variables include the dropout random generators state
+        accumulator = [self.accumulator.step]
+        if self.accumulator.gradients is not None:
+            accumulator += list(self.accumulator.gradients)
+
+        return dict(model=list(self.model.variables),
+                    optimizer=list(self.optimizer.variables),
+                    accumulator=accumulator,
+                    epoch=self._epoch_var,
+                    step=self._step_var,
+                    global_step=self._global_step_var)
+
+    def save_state(self, iterator: tf.data.Iterator, step: int) -> str:
+        """
+        Checkpoints the training state after `step` steps of the current
+        epoch, along with the iterator of the epoch
+
+        Returns
+        -------
+        str
+            Path of the checkpoint
+        """
+        self._epoch_var.assign(self.epoch)
+        self._step_var.assign(step)
+
+        if self._checkpoint_manager is None:
+            self._checkpoint_manager = tf.train.CheckpointManager(
+                tf.train.Checkpoint(**self._state()),
+                directory=str(self.checkpoint_dir),
+                max_to_keep=self.max_checkpoints)
+
+        # The iterator of the current epoch replaces the previous one
+        self._checkpoint_manager.checkpoint.iterator = iterator
+        return self._checkpoint_manager.save(
+            checkpoint_number=int(self._global_step_var))
+
+    def restore(self) -> bool:
+        """
+        Restores the epoch and step counters of the latest training state
+        checkpointed in `checkpoint_dir`. The rest of the state is 
+        restored by the next Trainer.train_epoch call, which continues 
+        the interrupted epoch without replaying its already seen batches.
+        Therefore, the next epoch must be trained with the same dataset,
+        otherwise its iterator cannot be restored.
+
+        Returns
+        -------
+        bool
+            Whether a checkpoint has been found
+        """
+        if self.checkpoint_dir is None:
+            return False
+
+        path = tf.train.latest_checkpoint(str(self.checkpoint_dir))
+        if path is None:
+            return False
+
+        (tf.train.Checkpoint(epoch=self._epoch_var, 
+                             step=self._step_var,
+                             global_step=self._global_step_var)
+         .read(path).expect_partial())
+        self.epoch = int(self._epoch_var)
+        self._resume_step = int(self._step_var)
+        self._resume_path = path
+        return True
+
+    def _restore_state(self, iterator: tf.data.Iterator, dataset_spec):
+        # The model, the optimizer slots and the accumulated gradients are
+        # created beforehand with a dummy batch. The model
+        # is fully convolutional, so the shape of the batch only needs to
+        # be a multiple of the largest stride
+        images_spec = tf.nest.flatten(dataset_spec)[0]
+        shape = [1] + [d or 128 for d in images_spec.shape[1:3]] + [3]
+        self.model(tf.zeros(shape, images_spec.dtype), training=False)
+
+        variables = self.model.trainable_variables
+        if self.accumulator.accum_steps > 1:
+            self.accumulator.build(variables)
+        elif not self.optimizer.built:
+            self.optimizer.build(variables)
+
+        (tf.train.Checkpoint(iterator=iterator, **self._state())
+         .read(self._resume_path).assert_existing_objects_matched())
+
+    def _compute_gradients(self, 
+                           images: tf.Tensor, 
+                           target_reg: tf.Tensor, 
+                           target_clf: tf.Tensor):
         return _train_step(
-            model=model, optimizer=optimizer, loss_fn=loss_fn,
-            images=images, regress_targets=r_targets, labels=c_targets)
-
-    acc_gradients = []
-
-    running_loss = tf.metrics.Mean()
-    running_clf_loss = tf.metrics.Mean()
-    running_reg_loss = tf.metrics.Mean()
-
-    for i, (images, (labels, bbs)) in enumerate(dataset):
-
-        target_reg, target_clf = utils.anchors.anchor_targets_bbox(
-            anchors, images, bbs, labels, num_classes)
-
-        reg_loss, clf_loss, grads = train_step(
-            images=images, r_targets=target_reg, c_targets=target_clf)
-        
-        if tf.math.is_nan(reg_loss) or tf.math.is_nan(clf_loss):
-            print('Loss NaN, skipping training step')
-            
-        if len(acc_gradients) == 0:
-            acc_gradients = grads 
+            model=self.model, optimizer=self.optimizer, loss_fn=self.loss_fn,
+            images=images, regress_targets=target_reg, labels=target_clf)
+
+    def _train_step(self, 
+                    images: tf.Tensor, 
+                    targets: Tuple[tf.Tensor, tf.Tensor]):
+        if self.augment_fn is not None:
+            images, targets = self.augment_fn(images, targets)
+
+        target_reg, target_clf = self._targets(images, targets)
+        reg_loss, clf_loss, grads = self._forward_backward(
+            images, target_reg, target_clf)
+
+        def accumulate():
+            self.accumulator(grads, self.model.trainable_variables)
+
+        def skip():
+            tf.print('Loss NaN, skipping training step')
+
+        is_finite = tf.logical_and(tf.math.is_finite(reg_loss),
+                                   tf.math.is_finite(clf_loss))
+        tf.cond(is_finite, accumulate, skip)
+
+        self.running_loss.update_state(reg_loss + clf_loss)
+        self.running_clf_loss.update_state(clf_loss)
+        self.running_reg_loss.update_state(reg_loss)
+
+    @tf.function
+    def _train_steps(self, iterator: tf.data.Iterator) -> tf.Tensor:
+        """
+        Runs up to `steps_per_execution` training steps, and returns the
+        number of steps that have been run. Less steps than 
+        `steps_per_execution` means that the iterator is exhausted
+        """
+        # Python side effects only run while tracing
+        self.trace_counts['train_step'] += 1
+
+        n_steps = tf.constant(0)
+        for _ in tf.range(self.steps_per_execution):
+            batch = iterator.get_next_as_optional()
+            if not batch.has_value():
+                break
+
+            images, targets = batch.get_value()
+            self._train_step(images, targets)
+            n_steps += 1
+
+        return n_steps
+
+    def _predict_step(self, images: tf.Tensor) -> Tuple:
+        # Compiled inference functions are indexed by the images shape, so
+        # bucketed datasets trace one function per bucket
+        input_signature = (tf.TensorSpec(shape=[None] + images.shape[1:],
+                                         dtype=images.dtype),)
+
+        if input_signature not in self._predict_steps:
+            @tf.function(input_signature=input_signature)
+            def predict_step(images):
+                self.trace_counts['predict_step'] += 1
+                return self.model(images, training=False)
+
+            self._predict_steps[input_signature] = predict_step
+
+        return self._predict_steps[input_signature](images)
+
+    def _targets(self, 
+                 images: tf.Tensor, 
+                 targets: Tuple[tf.Tensor, tf.Tensor]):
+        if self.anchors is None:
+            # The dataset already yields the anchors targets
+            return targets
+
+        labels, bbs = targets
+
+        # Only the images shape is used to compute the targets, but the
+        # compiled functions expect float images
+        if images.dtype != tf.float32:
+            images = tf.cast(images, tf.float32)
+
+        if isinstance(bbs, tf.RaggedTensor):
+            target_fn = utils.anchors.ragged_anchor_targets_bbox
         else:
-            acc_gradients = [g1 + g2 for g1, g2 in zip(acc_gradients, grads)]
-
-        if (i + 1) % grad_accum_steps == 0:
-            optimizer.apply_gradients(
-                zip(acc_gradients, model.trainable_variables))
-            acc_gradients = []
-        
-        running_loss(reg_loss + clf_loss)
-        running_clf_loss(clf_loss)
-        running_reg_loss(reg_loss)
-
-        if (i + 1) % print_every == 0:
-            lr = get_lr(optimizer)
-            print(f'Epoch[{epoch}] [{i}/{steps}] '
-                  f'loss: {running_loss.result():.6f} '
-                  f'clf. loss: {running_clf_loss.result():.6f} '
-                  f'reg. loss: {running_reg_loss.result():.6f} '
-                  f'learning rate: {lr:.6f}')
-
-    if len(acc_gradients) > 0:
-        optimizer.apply_gradients(
-                zip(acc_gradients, model.trainable_variables))
+            target_fn = utils.anchors.anchor_targets_bbox
+
+        return target_fn(self.anchors, images, bbs, labels, self.num_classes)
+
+    def train_epoch(self, 
+                    dataset: tf.data.Dataset, 
+                    steps: int = None) -> Mapping[str, float]:
+        """
+        Trains the model for a single epoch. After Trainer.restore, the 
+        interrupted epoch is continued instead, and the returned losses
+        only cover its remaining steps
+
+        Parameters
+        ----------
+        dataset: tf.data.Dataset
+        steps: int, default None
+            Number of steps of the epoch. Only used to report the progress
+
+        Returns
+        -------
+        Mapping[str, float]
+            Mean of the losses over the epoch
+        """
+        metrics = [self.running_loss, 
+                   self.running_clf_loss, 
+                   self.running_reg_loss]
+        for m in metrics:
+            m.reset_state()
+
+        if self.checkpoint_dir is not None:
+            # The state of stateful ops, such as the random augmentation,
+            # is not checkpointed. The examples order is
+            options = tf.data.Options()
+            options.experimental_external_state_policy = \
+                tf.data.experimental.ExternalStatePolicy.IGNORE
+            dataset = dataset.with_options(options)
+
+        iterator = iter(dataset)
+        step = 0
+
+        if self._resume_path is not None:
+            # Continue the interrupted epoch
+            self._restore_state(iterator, dataset.element_spec)
+            step = self._resume_step
+            self._resume_path = None
+
+        while True:
+            n_steps = int(self._train_steps(iterator))
+            if n_steps == 0:
+                break
+
+            prev_step = step
+            step += n_steps
+            self._global_step_var.assign_add(n_steps)
+
+            if step // self.print_every > prev_step // self.print_every:
+                lr = get_lr(self.optimizer)
+                print(f'Epoch[{self.epoch}] [{step - 1}/{steps}] '
+                      f'loss: {self.running_loss.result():.6f} '
+                      f'clf. loss: {self.running_clf_loss.result():.6f} '
+                      f'reg. loss: {self.running_reg_loss.result():.6f} '
+                      f'learning rate: {lr:.6f}')
+
+            if (self.checkpoint_every is not None and 
+                    step // self.checkpoint_every > 
+                    prev_step // self.checkpoint_every):
+                self.save_state(iterator, step)
+
+            if n_steps < self.steps_per_execution:
+                break
+
+        # Apply the remaining accumulated gradients
+        self.accumulator.flush(self.model.trainable_variables)
+
+        self.epoch += 1
+
+        return dict(loss=float(self.running_loss.result()),
+                    clf_loss=float(self.running_clf_loss.result()),
+                    reg_loss=float(self.running_reg_loss.result()))
+
+    def evaluate(self, 
+                 dataset: tf.data.Dataset,
+                 class2idx: Mapping[str, int],
+                 steps: int = None) -> float:
+        """
+        Computes the COCO mAP using the compiled inference step.
+        See efficientdet.engine.evaluate
+        """
+        return evaluate(model=self.model,
+                        dataset=dataset,
+                        class2idx=class2idx,
+                        steps=steps,
+                        print_every=self.print_every,
+                        predict_fn=self._predict_step)
+
+    def fit(self,
+            dataset: tf.data.Dataset,
+            epochs: int,
+            steps_per_epoch: int = None,
+            val_dataset: tf.data.Dataset = None,
+            class2idx: Mapping[str, int] = None,
+            validation_steps: int = None,
+            validate_every: int = 1,
+            on_epoch_end: Callable[[int], None] = None):
+        """
+        Trains the model for the given number of epochs
+
+        Parameters
+        ----------
+        dataset: tf.data.Dataset
+        epochs: int
+            Number of epochs to train. Training resumes from `self.epoch`
+            so successive calls keep counting the epochs
+        steps_per_epoch: int, default None
+        val_dataset: tf.data.Dataset, default None
+            If set, the COCO mAP is computed every `validate_every` epochs.
+            Requires `class2idx`
+        class2idx: Mapping[str, int], default None
+        validation_steps: int, default None
+        validate_every: int, default 1
+        on_epoch_end: Callable[[int], None], default None
+            Called with the epoch index after each epoch, e.g. to save
+            a checkpoint. The mAP of the epoch is in `self.val_map`
+        """
+        for _ in range(epochs):
+            epoch = self.epoch
+            self.train_epoch(dataset, steps=steps_per_epoch)
+
+            self.val_map = None
+            if val_dataset is not None and (epoch + 1) % validate_every == 0:
+                print('Evaluating COCO mAP...')
+                self.val_map = self.evaluate(val_dataset, 
+                                             class2idx=class2idx, 
+                                             steps=validation_steps)
+
+            if on_epoch_end is not None:
+                on_epoch_end(epoch)
+
+        print('Traced functions:', dict(self.trace_counts))
 
 
 def _COCO_result(image_id: int,
@@ -156,7 +568,24 @@ def evaluate(model: tf.keras.Model,
              dataset: tf.data.Dataset,
              class2idx: Mapping[str, int],
              steps: int,
-             print_every: int = 10):
+             print_every: int = 10,
+             predict_fn: Callable[[tf.Tensor], Tuple] = None) -> float:
+    """
+    Computes the COCO mAP of the model over the dataset
+
+    Parameters
+    ----------
+    predict_fn: Callable[[tf.Tensor], Tuple], default None
+        Function returning the (boxes, labels, scores) of a batch of
+        images. Defaults to an eager call to the model
+
+    Returns
+    -------
+    float
+        mAP averaged over the IoU thresholds from 0.5 to 0.95
+    """
+    if predict_fn is None:
+        predict_fn = lambda images: model(images, training=False)
 
     gt_coco = dict(images=[], annotations=[])
     results_coco = []
@@ -170,7 +599,7 @@ def evaluate(model: tf.keras.Model,
     
     for i, (images, (labels, bbs)) in enumerate(dataset):
         
-        bboxes, categories, scores = model(images, training=False)
+        bboxes, categories, scores = predict_fn(images)
         h, w = images.shape[1: 3]
         
         # Iterate through images in batch, and for each one
@@ -191,6 +620,12 @@ def evaluate(model: tf.keras.Model,
             preds = categories[batch_idx], bboxes[batch_idx], scores[batch_idx]
             pred_labels, pred_boxes, pred_scores = preds
 
+            # Remove the padded detections
+            no_padding_mask = pred_labels != -1
+            pred_labels = tf.boolean_mask(pred_labels, no_padding_mask)
+            pred_boxes = tf.boolean_mask(pred_boxes, no_padding_mask)
+            pred_scores = tf.boolean_mask(pred_scores, no_padding_mask)
+
             if pred_labels.shape[0] > 0:
                 results = _COCO_result(image_id, 
                                        pred_labels, pred_boxes, pred_scores)
@@ -228,3 +663,5 @@ def evaluate(model: tf.keras.Model,
     coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
+
+    return float(coco_eval.stats[0])
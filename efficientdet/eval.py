@@ -23,19 +23,20 @@ def evaluate(**kwargs):
         im_size=(model.config.input_size,) * 2,
         class_names=params['classes_names'].split(','),
         data_augmentation=False,
+        ragged=True,
         batch_size=8)
     
     engine.evaluate(
             model=model,
             dataset=ds,
-            steps=sum(1 for _ in ds),
+            steps=int(ds.cardinality()),
             class2idx=class2idx)
 
 
 @click.command()
 
 # Data parameters
-@click.option('--format', type=click.Choice(['VOC', 'labelme']),
+@click.option('--format', type=click.Choice(['VOC', 'labelme', 'tfrecord']),
               required=True, help='Dataset to use for training')
 @click.option('--test-dataset', type=click.Path(file_okay=False, exists=True),
               required=True, help='Path to annotations and images')
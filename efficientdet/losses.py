@@ -7,9 +7,26 @@ def focal_loss(y_true: tf.Tensor,
                alpha: float = 0.25,
                from_logits: bool = False,
                reduction: str = 'sum'):
+    """
+    Focal loss summed over classes
 
+    Parameters
+    ----------
+    y_true: tf.Tensor
+        One-hot encoded labels with the same shape as y_pred. Integer class
+        indices with one dimension less than y_pred are also supported,
+        in that case they are one-hot encoded lazily and negative indices
+        are considered background
+    y_pred: tf.Tensor
+        Predicted probabilities (or logits if from_logits is True)
+    """
     if from_logits:
         y_pred = tf.sigmoid(y_pred)
+
+    if (y_true.dtype.is_integer and 
+            y_true.shape.rank == y_pred.shape.rank - 1):
+        y_true = tf.one_hot(tf.cast(y_true, tf.int32), 
+                            depth=tf.shape(y_pred)[-1])
     
     epsilon = 1e-6
     y_pred = tf.clip_by_value(y_pred, epsilon, 1. - epsilon)
@@ -31,9 +48,63 @@ def focal_loss(y_true: tf.Tensor,
     return loss
 
 
+def sigmoid_focal_loss(y_true: tf.Tensor,
+                       logits: tf.Tensor,
+                       gamma: float = 1.5,
+                       alpha: float = 0.25,
+                       weights: tf.Tensor = None,
+                       reduction: str = 'sum'):
+    """
+    Focal loss summed over classes computed from logits.
+
+    The cross entropy term is computed with 
+    tf.nn.sigmoid_cross_entropy_with_logits, so no clipping is needed and 
+    the loss is stable for large logits. All shapes are static, so it can
+    be compiled with XLA.
+
+    Parameters
+    ----------
+    y_true: tf.Tensor
+        One-hot encoded labels with the same shape as logits, or integer
+        class indices with one dimension less. Negative indices are 
+        considered background
+    logits: tf.Tensor
+        Predicted class logits
+    weights: tf.Tensor, default None
+        Weight of each element, with the shape of logits without the
+        classes dimension. Used to mask out the ignored anchors
+    """
+    logits = tf.cast(logits, tf.float32)
+    if (y_true.dtype.is_integer and 
+            y_true.shape.rank == logits.shape.rank - 1):
+        y_true = tf.one_hot(tf.cast(y_true, tf.int32), 
+                            depth=logits.shape[-1])
+    y_true = tf.cast(y_true, tf.float32)
+
+    ce = tf.nn.sigmoid_cross_entropy_with_logits(labels=y_true, 
+                                                 logits=logits)
+    probas = tf.sigmoid(logits)
+    pt = y_true * probas + (1. - y_true) * (1. - probas)
+    alpha = y_true * alpha + (1. - y_true) * (1. - alpha)
+
+    loss = alpha * tf.pow(1. - pt, gamma) * ce
+    loss = tf.reduce_sum(loss, axis=-1)
+
+    if weights is not None:
+        loss = loss * tf.cast(weights, tf.float32)
+
+    if reduction == 'mean':
+        return tf.reduce_mean(loss)
+    elif reduction == 'sum':
+        return tf.reduce_sum(loss)
+
+    return loss
+
+
 def huber_loss(y_true: tf.Tensor, 
                y_pred: tf.Tensor, 
                clip_delta: float = 1.0,
+               weights: tf.Tensor = None,
                reduction: str = 'sum'):
 
     y_pred = tf.cast(y_pred, tf.float32)
@@ -48,6 +119,9 @@ def huber_loss(y_true: tf.Tensor,
     loss = tf.where(cond, squared_loss, linear_loss)
     loss = tf.reduce_mean(loss, axis=-1)
 
+    if weights is not None:
+        loss = loss * tf.cast(weights, tf.float32)
+
     if reduction == 'mean':
         return tf.reduce_mean(loss)
     elif reduction == 'sum':
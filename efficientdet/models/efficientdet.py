@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List, Union
+from typing import List, Tuple, Union
 
 import tensorflow as tf
 
@@ -20,6 +20,19 @@ class EfficientDet(tf.keras.Model):
         to better understand this parameter refer to EfficientDet 
         paper 4.2 section
     freeze_backbone: bool, default False
+    score_threshold: float, default .1
+        Minimum score of the detections returned at inference time
+    iou_threshold: float, default .5
+        IoU threshold used by the non maximum suppression
+    max_detections_per_class: int, default 100
+        Maximum number of detections of each class kept per image
+    max_detections: int, default 100
+        Maximum number of detections kept per image. Inference outputs are
+        padded to this size
+    pre_nms_top_k: int, default 1000
+        Number of highest scored anchors of each pyramid level that are
+        decoded and passed to the non maximum suppression. If set to None
+        all anchors are decoded
     weights: str, default 'imagenet'
         If set to 'imagenet' then the backbone will be pretrained
         on imagenet. If set to None, the backbone will be random
@@ -31,13 +44,22 @@ class EfficientDet(tf.keras.Model):
                  bidirectional: bool = True,
                  freeze_backbone: bool = False,
                  score_threshold: float = .1,
+                 iou_threshold: float = .5,
+                 max_detections_per_class: int = 100,
+                 max_detections: int = 100,
+                 pre_nms_top_k: int = 1000,
                  weights : str = 'imagenet'):
                  
         super(EfficientDet, self).__init__()
+        self.normalize = models.layers.ImageNormalization()
         self.config = config.EfficientDetCompudScaling(D=D)
         self.anchors_config = config.AnchorsConfig()
         self.num_classes = num_classes
         self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections_per_class = max_detections_per_class
+        self.max_detections = max_detections
+        self.pre_nms_top_k = pre_nms_top_k
         self.backbone = (models
                          .build_efficient_net_backbone(self.config.B, 
                                                        weights))
@@ -54,12 +76,6 @@ class EfficientDet(tf.keras.Model):
         self.bb_head = models.RetinaNetBBPredictor(self.config.Wbifpn,
                                                    self.config.Dclass)
 
-        self.anchors_gen = [anchors.AnchorGenerator(
-            size=self.anchors_config.sizes[i - 3],
-            aspect_ratios=self.anchors_config.ratios,
-            stride=self.anchors_config.strides[i - 3]
-        ) for i in range(3, 8)] # 3 to 7 pyramid levels
-
     def call(self, images: tf.Tensor, training: bool = True):
         """
         EfficientDet forward step
@@ -67,10 +83,23 @@ class EfficientDet(tf.keras.Model):
         Parameters
         ----------
         images: tf.Tensor
+            Normalized float images or uint8 images, which are normalized
+            by the model
         training: bool
             Wether if model is training or it is in inference mode
 
+        Returns
+        -------
+        Tuple[tf.Tensor, tf.Tensor]
+            When training, the box regressors of shape [BATCH, N, 4] and the
+            class logits of shape [BATCH, N, NUM_CLASSES]
+        Tuple[tf.Tensor, tf.Tensor, tf.Tensor]
+            At inference, the detected boxes [BATCH, max_detections, 4], 
+            labels [BATCH, max_detections] and scores 
+            [BATCH, max_detections]. Outputs are padded, padded detections
+            are labeled with -1
         """
+        images = self.normalize(images)
         features = self.backbone(images, training=training)
         
         # List of [BATCH, H, W, C]
@@ -95,27 +124,64 @@ class EfficientDet(tf.keras.Model):
             im_shape = tf.shape(images)
             batch_size, h, w = im_shape[0], im_shape[1], im_shape[2]
             
-            # Create the anchors
-            anchors = [g(f[0].shape)
-                       for g, f in zip(self.anchors_gen, bifnp_features)]
-            anchors = tf.concat(anchors, axis=0)
-            
-            # Tile anchors over batches, so they can be regressed
-            anchors = tf.tile(tf.expand_dims(anchors, 0), [batch_size, 1, 1])
-            
             class_scores = tf.reshape(class_scores, 
                                       [batch_size, -1, self.num_classes])
             bboxes = tf.reshape(bboxes, 
                                 [batch_size, -1, 4])
 
+            anchors = self.anchors_for(images.shape[1:3])
+
+            if self.pre_nms_top_k is not None:
+                # Only the best candidates of each level are decoded
+                level_sizes = self.anchors_per_level(images.shape[1:3])
+                class_scores, bboxes, anchors = bndbox.top_k_per_level(
+                    class_scores, bboxes, anchors, 
+                    level_sizes, k=self.pre_nms_top_k)
+            else:
+                # Broadcast the anchors over the batch instead of tiling
+                # them, so they can be regressed
+                anchors = tf.expand_dims(anchors, 0)
+
+            # The sigmoid preserves the order of the logits, so it is
+            # applied only to the selected candidates
+            class_scores = tf.sigmoid(class_scores)
+
             boxes = bndbox.regress_bndboxes(anchors, bboxes)
             boxes = bndbox.clip_boxes(boxes, [h, w])
-            boxes, labels, scores = bndbox.nms(
-                boxes, class_scores, score_threshold=self.score_threshold)
+            boxes, labels, scores, _ = bndbox.batched_nms(
+                boxes, class_scores, 
+                score_threshold=self.score_threshold,
+                iou_threshold=self.iou_threshold,
+                max_detections_per_class=self.max_detections_per_class,
+                max_detections=self.max_detections)
 
-            # TODO: Pad output
             return boxes, labels, scores
     
+    def anchors_for(self, im_size: Tuple[int, int]) -> tf.Tensor:
+        """
+        Anchors of all pyramid levels for the given input size. Anchors are
+        memoized process-wide, so this is cheap after the first call
+
+        Parameters
+        ----------
+        im_size: Tuple[int, int]
+            Input images (height, width). Both must be known, otherwise
+            a ValueError is raised
+
+        Returns
+        -------
+        tf.Tensor of shape [N_ANCHORS, 4]
+        """
+        return anchors.generate_anchors(self.anchors_config, 
+                                        _static_size(im_size))
+
+    def anchors_per_level(self, im_size: Tuple[int, int]) -> List[int]:
+        """
+        Number of anchors of each pyramid level for the given input size
+        """
+        return anchors.anchors_per_level(self.anchors_config, 
+                                         _static_size(im_size))
+
     @staticmethod
     def from_pretrained(checkpoint_path: Union[Path, str], 
                         num_classes: int = None,
@@ -159,3 +225,16 @@ class EfficientDet(tf.keras.Model):
                 model.config.Wbifpn, model.config.D, num_classes)
 
         return model
+
+
+def _static_size(im_size: Tuple[int, int]) -> Tuple[int, int]:
+    # The anchors are generated once per input size, so the boxes would
+    # be decoded against a wrong grid if an unknown size was guessed
+    h, w = im_size
+    if h is None or w is None:
+        raise ValueError(
+            'The images height and width must be static to generate the '
+            f'anchors, got {tuple(im_size)}. Trace the inference with the '
+            'input shape of each batch, for example one tf.function trace '
+            'per bucket shape')
+    return int(h), int(w)
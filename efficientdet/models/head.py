@@ -34,7 +34,10 @@ class RetinaNetBBPredictor(tf.keras.Model):
 
 
 class RetinaNetClassifier(tf.keras.Model):
-
+    """
+    Predicts the class logits of each anchor. The sigmoid is not applied,
+    so the loss can be computed in a numerically stable way from logits
+    """
     def __init__(self, 
                  width: int, 
                  depth: int,
@@ -55,7 +58,6 @@ class RetinaNetClassifier(tf.keras.Model):
         w_init = tf.constant_initializer(-math.log((1 - prob) / prob))
         self.cls_score = tf.keras.layers.Conv2D(num_anchors * num_classes,
                                                 kernel_size=3,
-                                                activation='sigmoid',
                                                 padding='same',
                                                 bias_initializer=w_init)
 
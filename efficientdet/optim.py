@@ -1,4 +1,5 @@
 import math
+from typing import Sequence
 
 import tensorflow as tf
 from tensorflow.keras.optimizers.schedules import LearningRateSchedule
@@ -17,31 +18,144 @@ class WarmupCosineDecayLRScheduler(LearningRateSchedule):
         self.alpha = alpha
 
         self.max_lr = max_lr
-        self.last_step = 0
 
         self.warmup_steps = warmup_steps
         self.linear_increase = self.max_lr / float(self.warmup_steps)
 
         self.decay_steps = decay_steps
 
-    @property
-    def current_lr(self):
-        if self.last_step < self.warmup_steps:
-            return self.linear_increase * self.last_step
-        else:
-            rate = (self.last_step - self.warmup_steps) / self.decay_steps
-            cosine_decayed = 0.5 * (1.0 + tf.cos(
-                tf.constant(math.pi) * rate))
-            decayed = (1 - self.alpha) * cosine_decayed + self.alpha
-            return self.max_lr * decayed
+    def _lr(self, step) -> tf.Tensor:
+        # Implemented with tf ops so the schedule can be evaluated 
+        # within a compiled training step
+        step = tf.cast(step, tf.float32)
+        warmup_lr = self.linear_increase * step
+
+        rate = (step - self.warmup_steps) / self.decay_steps
+        cosine_decayed = 0.5 * (1.0 + tf.cos(tf.constant(math.pi) * rate))
+        decayed = (1 - self.alpha) * cosine_decayed + self.alpha
+
+        return tf.where(step < self.warmup_steps, 
+                        warmup_lr, self.max_lr * decayed)
 
     def __call__(self, step):
-        self.last_step = int(step)
-        return self.current_lr
+        return self._lr(step)
 
     def get_config(self):
         return {
-            "steps_per_epoch": self.steps_per_epoch,
-            "n_epochs": self.n_epochs,
+            'max_lr': self.max_lr,
+            'warmup_steps': self.warmup_steps,
+            'decay_steps': self.decay_steps,
             'alpha': self.alpha,
-        }
\ No newline at end of file
+        }
+
+
+class GradientAccumulator(object):
+    """
+    Accumulates the gradients of several steps in preallocated variables
+    and updates the weights every `accum_steps` steps.
+
+    All the operations are regular tf ops, so the accumulator can be
+    called within a tf.function. The accumulation variables are created
+    the first time the accumulator is called.
+
+    Parameters
+    ----------
+    optimizer: tf.optimizers.Optimizer
+        Optimizer used to apply the accumulated gradients
+    accum_steps: int, default 1
+        Number of steps to accumulate before updating the weights. With
+        a single step the gradients are applied straight away and no 
+        accumulation variables are allocated
+    average: bool, default False
+        Apply the mean of the accumulated gradients instead of their sum
+    """
+    def __init__(self, 
+                 optimizer: tf.optimizers.Optimizer,
+                 accum_steps: int = 1,
+                 average: bool = False):
+        self.optimizer = optimizer
+        self.accum_steps = accum_steps
+        self.average = average
+
+        self.step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self._gradients = None
+
+    @property
+    def gradients(self) -> Sequence[tf.Variable]:
+        return self._gradients
+
+    @property
+    def pending_steps(self) -> tf.Tensor:
+        """
+        Number of accumulated steps that have not been applied yet
+        """
+        return self.step % self.accum_steps
+
+    def build(self, variables: Sequence[tf.Variable]):
+        if self._gradients is not None:
+            return
+
+        # Lift the variables creation out of the traced function
+        with tf.init_scope():
+            self._gradients = [
+                tf.Variable(tf.zeros(v.shape, dtype=v.dtype), 
+                            trainable=False)
+                for v in variables]
+
+            # The optimizer slots cannot be created within a tf.cond
+            if not self.optimizer.built:
+                self.optimizer.build(variables)
+
+    def reset(self):
+        if self._gradients is not None:
+            for g in self._gradients:
+                g.assign(tf.zeros_like(g))
+
+    def _apply(self, variables: Sequence[tf.Variable], n_steps: tf.Tensor):
+        gradients = [g.read_value() for g in self._gradients]
+        if self.average:
+            scale = 1. / tf.cast(n_steps, tf.float32)
+            gradients = [g * tf.cast(scale, g.dtype) for g in gradients]
+
+        self.optimizer.apply_gradients(zip(gradients, variables))
+        self.reset()
+
+    def __call__(self, 
+                 gradients: Sequence[tf.Tensor], 
+                 variables: Sequence[tf.Variable]):
+        """
+        Accumulates the gradients, and updates the variables if 
+        `accum_steps` have been accumulated since the last update
+        """
+        if self.accum_steps == 1:
+            self.step.assign_add(1)
+            self.optimizer.apply_gradients(zip(gradients, variables))
+            return
+
+        self.build(variables)
+        for acc, g in zip(self._gradients, gradients):
+            if g is not None:
+                acc.assign_add(g)
+
+        self.step.assign_add(1)
+
+        def apply():
+            self._apply(variables, self.accum_steps)
+
+        tf.cond(tf.equal(self.pending_steps, 0), apply, lambda: None)
+
+    def flush(self, variables: Sequence[tf.Variable]):
+        """
+        Applies the gradients accumulated since the last update, for 
+        example at the end of an epoch
+        """
+        if self._gradients is None:
+            return
+
+        n_steps = self.pending_steps
+
+        def apply():
+            self._apply(variables, n_steps)
+
+        tf.cond(n_steps > 0, apply, lambda: None)
+        self.step.assign(0)
@@ -14,6 +14,9 @@ import efficientdet
 
 @click.option('--format', type=click.Choice(['VOC', 'labelme']),
               required=True, help='Dataset to use for training')
+@click.option('--aspect-ratio-buckets/--square-inputs', default=False,
+              help='Letterbox the image in a rectangular shape depending on '
+                   'its aspect ratio instead of resizing it to a square')
 
 def main(**kwargs):
 
@@ -29,16 +32,28 @@ def main(**kwargs):
     
     # load image
     im_size = model.config.input_size
-    im = efficientdet.utils.io.load_image(kwargs['image'], (im_size,) * 2)
-    norm_image = efficientdet.data.preprocess.normalize_image(im)
+    if kwargs['aspect_ratio_buckets']:
+        buckets = efficientdet.data.buckets.bucket_shapes(im_size)
+        input_im, (h, w) = efficientdet.utils.io.load_letterboxed_image(
+            kwargs['image'], buckets)
+        # The padding is not shown
+        im = input_im[:h, :w]
+    else:
+        input_im = im = efficientdet.utils.io.load_image(
+            kwargs['image'], (im_size,) * 2)
+    norm_image = efficientdet.data.preprocess.normalize_image(input_im)
 
     boxes, labels, scores = model(tf.expand_dims(norm_image, axis=0), 
                                   training=False)
 
-    labels = [classes[l] for l in labels[0]]
-    scores = scores[0]
+    # Remove padded detections
+    n_valid = tf.reduce_sum(tf.cast(labels[0] != -1, tf.int32))
+    boxes = boxes[0, :n_valid]
+    scores = scores[0, :n_valid]
+    labels = [classes[l] for l in labels[0, :n_valid]]
+
     im = efficientdet.visualizer.draw_boxes(
-        im, boxes[0], labels=labels, scores=scores)
+        im, boxes, labels=labels, scores=scores)
     
     plt.imshow(im)
     plt.axis('off')
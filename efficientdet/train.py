@@ -1,5 +1,6 @@
-from typing import Tuple
+from typing import Sequence, Tuple, Union
 from pathlib import Path
+from urllib.parse import urlparse
 
 import click
 
@@ -10,56 +11,96 @@ import efficientdet.utils as utils
 import efficientdet.engine as engine
 
 
-huber_loss_fn = tf.losses.Huber(
-    reduction=tf.losses.Reduction.SUM)
-
-
 def loss_fn(y_true_clf: tf.Tensor, 
             y_pred_clf: tf.Tensor, 
             y_true_reg: tf.Tensor, 
             y_pred_reg: tf.Tensor) -> Tuple[float, float]:
+    """
+    Focal loss of the non ignored anchors and huber loss of the positive 
+    anchors, both normalized by the number of positive anchors.
+
+    The losses are computed densely over all the anchors and the anchors
+    states are applied as weights, so all the shapes are static and the 
+    training step can be compiled with XLA
+
+    Parameters
+    ----------
+    y_true_clf: Union[tf.Tensor, Tuple[tf.Tensor, tf.Tensor]]
+        Either the one-hot encoded labels concatenated with the anchors 
+        states, or the compact targets (class indices, anchors states)
+    y_pred_clf: tf.Tensor of shape [BATCH, N, NUM_CLASSES]
+        Predicted class logits
+    y_true_reg: tf.Tensor of shape [BATCH, N, 4 or 5]
+    y_pred_reg: tf.Tensor of shape [BATCH, N, 4]
+    """
+    if isinstance(y_true_clf, (tuple, list)):
+        # Compact targets. Class indices are one-hot encoded lazily
+        # by the focal loss
+        y_true_clf, anchors_states = y_true_clf
+        anchors_states = tf.cast(anchors_states, tf.float32)
+    else:
+        anchors_states = y_true_clf[:, :, -1]
+        y_true_clf = y_true_clf[:, :, :-1]
 
-    y_shape = tf.shape(y_true_clf)
-    batch = y_shape[0]
-    n_anchors = y_shape[1]
-    
-    anchors_states = y_true_clf[:, :, -1]
-    not_ignore_idx = tf.where(tf.not_equal(anchors_states, -1.))
-    true_idx = tf.where(tf.equal(anchors_states, 1.))
-    
-    normalizer = tf.shape(true_idx)[0]
-    normalizer = tf.cast(normalizer, tf.float32)
+    not_ignore_mask = tf.cast(tf.not_equal(anchors_states, -1.), tf.float32)
+    positive_mask = tf.cast(tf.equal(anchors_states, 1.), tf.float32)
     
-    y_true_clf = tf.gather_nd(y_true_clf[:, :, :-1], not_ignore_idx)
-    y_pred_clf = tf.gather_nd(y_pred_clf, not_ignore_idx)
-    
-    y_true_reg = tf.gather_nd(y_true_reg[:, :, :-1], true_idx)
-    y_pred_reg = tf.gather_nd(y_pred_reg, true_idx)
-    
-    reg_loss = huber_loss_fn(y_true_reg, y_pred_reg)
+    # Avoid dividing by zero on batches without positive anchors
+    normalizer = tf.maximum(tf.reduce_sum(positive_mask), 1.)
 
-    clf_loss = efficientdet.losses.focal_loss(y_true_clf, 
-                                              y_pred_clf,
+    reg_loss = efficientdet.losses.huber_loss(y_true_reg[:, :, :4], 
+                                              y_pred_reg,
+                                              weights=positive_mask,
                                               reduction='sum')
 
+    clf_loss = efficientdet.losses.sigmoid_focal_loss(
+        y_true_clf, y_pred_clf, weights=not_ignore_mask, reduction='sum')
+
     return tf.divide(reg_loss, normalizer), tf.divide(clf_loss, normalizer)
 
 
 def generate_anchors(anchors_config: efficientdet.config.AnchorsConfig,
-                     im_shape: int) -> tf.Tensor:
-
-    anchors_gen = [utils.anchors.AnchorGenerator(
-            size=anchors_config.sizes[i - 3],
-            aspect_ratios=anchors_config.ratios,
-            stride=anchors_config.strides[i - 3]) 
-            for i in range(3, 8)]
-
-    shapes = [im_shape // (2 ** x) for x in range(3, 8)]
-
-    anchors = [g((size, size, 3))
-               for g, size in zip(anchors_gen, shapes)]
-
-    return tf.concat(anchors, axis=0)
+                     im_shape: Union[int, Tuple[int, int]]) -> tf.Tensor:
+    return utils.anchors.generate_anchors(anchors_config, im_shape)
+
+
+def progressive_schedule(sizes: Sequence[int],
+                         input_size: int,
+                         epochs: int) -> Sequence[Tuple[int, int]]:
+    """
+    Splits the training epochs into stages of increasing input size
+
+    Early epochs are trained on smaller images, which are much faster to
+    process, and the last stage always uses the model input size so the
+    final model is not affected. The epochs are evenly split among the
+    stages and the remaining ones are trained at the model input size
+
+    Parameters
+    ----------
+    sizes: Sequence[int]
+        Increasing input sizes of the stages preceding the model input
+        size. Must be multiples of 128 so the images can be downsampled
+        up to the last pyramid level
+    input_size: int
+        Model input size. Refer to efficientdet.config
+    epochs: int
+        Total number of training epochs
+
+    Returns
+    -------
+    Sequence[Tuple[int, int]]
+        Input size and number of epochs of each stage
+    """
+    sizes = [s for s in sizes if s != input_size] + [input_size]
+    assert all(s % 128 == 0 for s in sizes), \
+        'Input sizes must be multiples of 128'
+    assert all(a < b for a, b in zip(sizes, sizes[1:])), \
+        'Input sizes must be increasing and smaller than the model input size'
+    assert epochs >= len(sizes), 'Each stage must train at least one epoch'
+
+    stage_epochs = [epochs // len(sizes)] * len(sizes)
+    stage_epochs[-1] += epochs % len(sizes)
+    return list(zip(sizes, stage_epochs))
 
 
 def train(**kwargs):
@@ -87,14 +128,81 @@ def train(**kwargs):
             freeze_backbone=kwargs['freeze_backbone'],
             weights='imagenet')
 
-    ds, class2idx = efficientdet.data.build_ds(
-        format=kwargs['format'],
-        annots_path=kwargs['train_dataset'],
-        images_path=kwargs['images_path'],
-        im_size=(model.config.input_size,) * 2,
-        class_names=kwargs['classes_names'].split(','),
-        batch_size=kwargs['batch_size'],
-        data_augmentation=True)
+    image_dtype = tf.uint8 if kwargs['uint8_images'] else tf.float32
+
+    # Train and validation datasets share the decoded images cache
+    image_cache = None
+    if kwargs['image_cache_size'] > 0:
+        image_cache = efficientdet.data.cache.ImageCache(
+            kwargs['image_cache_size'] * 2 ** 20)
+
+    # The iterators of distributed datasets cannot be checkpointed
+    assert kwargs['checkpoint_every'] == 0 or not (
+        kwargs['data_service'] or kwargs['data_service_workers']), \
+        'Mid-epoch checkpoints are not supported with the data service'
+
+    # The training pipeline can run in tf.data service workers, either
+    # an existing service or local worker processes launched here
+    service = None
+    data_service = kwargs['data_service'] or None
+    if kwargs['data_service_workers'] > 0:
+        service = efficientdet.data.service.LocalService(
+            kwargs['data_service_workers'],
+            cpus=efficientdet.data.service.parse_cpus(
+                kwargs['data_service_cpus']))
+        data_service = service.target
+
+    def bucket_shapes(input_size):
+        # Images are letterboxed in rectangular shapes, each one with 
+        # its own anchors
+        if not kwargs['aspect_ratio_buckets']:
+            return None
+        return efficientdet.data.buckets.bucket_shapes(input_size)
+
+    def build_train_ds(input_size):
+        buckets = bucket_shapes(input_size)
+        if buckets is not None:
+            anchors = {b: generate_anchors(model.anchors_config, b) 
+                       for b in buckets}
+        else:
+            anchors = generate_anchors(model.anchors_config, input_size)
+
+        matcher = utils.matching.build_matcher(
+            kwargs['matching'],
+            memory_budget=kwargs['matching_memory_budget'] * 2 ** 20,
+            anchors_config=model.anchors_config,
+            im_size=input_size)
+
+        # Anchor targets are computed within the input pipeline
+        return efficientdet.data.build_ds(
+            format=kwargs['format'],
+            annots_path=kwargs['train_dataset'],
+            images_path=kwargs['images_path'],
+            im_size=(input_size,) * 2,
+            class_names=kwargs['classes_names'].split(','),
+            batch_size=kwargs['batch_size'],
+            data_augmentation=True,
+            anchors=anchors,
+            matcher=matcher,
+            compact_targets=True,
+            regression_dtype=(tf.float16 if kwargs['fp16_targets'] 
+                              else tf.float32),
+            image_dtype=image_dtype,
+            image_cache=image_cache,
+            packed_images=kwargs['packed_images'],
+            batched_augmentation=kwargs['batched_augmentation'],
+            buckets=buckets,
+            data_service=data_service)
+
+    # Each input size of the progressive resizing has its own dataset. 
+    # The compiled training step is traced once per size
+    sizes = [int(s) for s in kwargs['progressive_sizes'].split(',') if s]
+    stages = progressive_schedule(sizes, model.config.input_size, 
+                                  kwargs['epochs'])
+    stages_ds = []
+    for input_size, _ in stages:
+        ds, class2idx = build_train_ds(input_size)
+        stages_ds.append(ds)
 
     val_ds = None
     if kwargs['val_dataset']:
@@ -106,21 +214,29 @@ def train(**kwargs):
             im_size=(model.config.input_size,) * 2,
             shuffle=False,
             data_augmentation=False,
+            ragged=True,
+            image_dtype=image_dtype,
+            image_cache=image_cache,
+            packed_images=kwargs['packed_images'],
+            buckets=bucket_shapes(model.config.input_size),
             batch_size=max(1, kwargs['batch_size'] // 2))
 
-    anchors = generate_anchors(model.anchors_config,
-                               model.config.input_size)
-    
-    steps_per_epoch = sum(1 for _ in ds)
+    stages_steps = [int(ds.cardinality()) for ds in stages_ds]
+    validation_steps = None
     if val_ds is not None:
-        validation_steps = sum(1 for _ in val_ds)
+        validation_steps = int(val_ds.cardinality())
 
     if kwargs['w_scheduler']:
-        optim_steps = (steps_per_epoch // kwargs['grad_accum_steps']) + 1
+        # The schedule spans all the stages. Bucketed datasets may have
+        # a different number of batches at each input size
+        optim_steps = [(steps // kwargs['grad_accum_steps']) + 1
+                       for steps in stages_steps]
+        total_steps = sum(steps * epochs 
+                          for steps, (_, epochs) in zip(optim_steps, stages))
         lr = efficientdet.optim.WarmupCosineDecayLRScheduler(
             kwargs['learning_rate'],
-            warmup_steps=optim_steps,
-            decay_steps=optim_steps * (kwargs['epochs'] - 1),
+            warmup_steps=optim_steps[0],
+            decay_steps=total_steps - optim_steps[0],
             alpha=kwargs['alpha'])
     else:
         lr = kwargs['learning_rate']
@@ -129,35 +245,82 @@ def train(**kwargs):
         learning_rate=lr,
         momentum=0.9)
 
-    for epoch in range(kwargs['epochs']):
-
-        engine.train_single_epoch(
-            model=model,
-            anchors=anchors,
-            dataset=ds,
-            optimizer=optimizer,
-            grad_accum_steps=kwargs['grad_accum_steps'],
-            loss_fn=loss_fn,
-            num_classes=kwargs['n_classes'],
-            epoch=epoch,
-            steps=steps_per_epoch,
-            print_every=kwargs['print_freq'])
-
-        if val_ds is not None and (epoch + 1) % kwargs['validate_freq'] == 0:
-            print('Evaluating COCO mAP...')
-            engine.evaluate(
-                model=model,
-                dataset=val_ds,
-                steps=validation_steps,
-                print_every=kwargs['print_freq'],
-                class2idx=class2idx)
-        
-        model_type = 'bifpn' if kwargs['bidirectional'] else 'fpn'
-        data_format = kwargs['format']
-        arch = kwargs['efficientdet']
-        save_dir = (save_checkpoint_dir / 
-                    f'{arch}_{model_type}_{data_format}_{epoch}')
-        efficientdet.checkpoint.save(model, kwargs, save_dir)
+    trainer = engine.Trainer(
+        model=model,
+        optimizer=optimizer,
+        loss_fn=loss_fn,
+        num_classes=kwargs['n_classes'],
+        anchors=None,
+        grad_accum_steps=kwargs['grad_accum_steps'],
+        average_gradients=kwargs['average_gradients'],
+        steps_per_execution=kwargs['steps_per_execution'],
+        jit_compile=kwargs['jit_compile'],
+        print_every=kwargs['print_freq'],
+        checkpoint_dir=(save_checkpoint_dir / 'train_state' 
+                        if kwargs['checkpoint_every'] else None),
+        checkpoint_every=kwargs['checkpoint_every'] or None)
+
+    # Resume an interrupted training from its last mid-epoch checkpoint
+    if trainer.restore():
+        print(f'Resuming training from epoch {trainer.epoch}...')
+
+    model_type = 'bifpn' if kwargs['bidirectional'] else 'fpn'
+    data_format = kwargs['format']
+    arch = kwargs['efficientdet']
+
+    # Checkpoints are written in the background, so the training loop
+    # only waits for the weights to be copied to host memory
+    store = None
+    if kwargs['upload_to'].startswith('gs://'):
+        upload_url = urlparse(kwargs['upload_to'])
+        store = efficientdet.checkpoint.GCSStore(
+            bucket=upload_url.netloc, prefix=upload_url.path)
+    elif kwargs['upload_to']:
+        store = efficientdet.checkpoint.LocalDirectoryStore(
+            kwargs['upload_to'])
+
+    checkpoints = efficientdet.checkpoint.AsyncCheckpointManager(
+        save_checkpoint_dir, 
+        kwargs,
+        keep_last=kwargs['keep_checkpoints'] or None,
+        keep_best=kwargs['keep_best_checkpoints'],
+        store=store)
+
+    def save_checkpoint(epoch):
+        checkpoints.save(model, f'{arch}_{model_type}_{data_format}_{epoch}',
+                         metric=trainer.val_map)
+
+        if image_cache is not None:
+            print('Images cache:', image_cache.stats)
+            image_cache.reset_stats()
+
+    try:
+        stage_end = 0
+        for (input_size, epochs), ds, steps in zip(stages, stages_ds, 
+                                                   stages_steps):
+            # When resuming, skip the epochs that have already been trained
+            stage_end += epochs
+            epochs = min(epochs, stage_end - trainer.epoch)
+            if epochs <= 0:
+                continue
+
+            if len(stages) > 1:
+                print(f'Training {epochs} epochs with input size '
+                      f'{input_size}...')
+
+            # Validation always runs at the model input size
+            trainer.fit(ds,
+                        epochs=epochs,
+                        steps_per_epoch=steps,
+                        val_dataset=val_ds,
+                        class2idx=class2idx,
+                        validation_steps=validation_steps,
+                        validate_every=kwargs['validate_freq'],
+                        on_epoch_end=save_checkpoint)
+    finally:
+        checkpoints.close()
+        if service is not None:
+            service.close()
 
 
 @click.command()
@@ -181,6 +344,13 @@ def train(**kwargs):
               help='Gradient accumulation steps. Simulates a larger batch '
                    'size, for example if batch_size=16 and grad_accum_steps=2 '
                    'the simulated batch size is 16 * 2 = 32')
+@click.option('--average-gradients/--sum-gradients', default=False,
+              help='Whether to average or sum the accumulated gradients')
+@click.option('--steps-per-execution', type=int, default=1,
+              help='Number of training steps run within a single call '
+                   'to the compiled training function')
+@click.option('--jit-compile/--no-jit-compile', default=False,
+              help='Compile the forward and backward passes with XLA')
 @click.option('--learning-rate', type=float, default=1e-3,
               help='Optimizer learning rate. It is recommended to reduce it '
                    'in case backbone is not frozen')
@@ -191,14 +361,64 @@ def train(**kwargs):
               help='Proportion to reduce the learning rate during '
                    'the decay period')
                    
+@click.option('--matching', default='dense',
+              type=click.Choice(['dense', 'chunked', 'grid']),
+              help='Strategy to match anchors with ground truth boxes. '
+                   'Dense materializes all the IoUs at once, chunked bounds '
+                   'the memory using --matching-memory-budget and grid only '
+                   'computes the IoUs of the anchors near each box')
+@click.option('--matching-memory-budget', type=int, default=64,
+              help='Peak memory in MB used by the chunked matching')
+@click.option('--fp16-targets/--fp32-targets', default=False,
+              help='Store the regression targets in half precision within '
+                   'the input pipeline')
+@click.option('--uint8-images/--float-images', default=False,
+              help='Feed uint8 images to the model, which normalizes them '
+                   'on device')
+@click.option('--image-cache-size', type=int, default=0,
+              help='Memory budget in MB to keep the decoded images in '
+                   'memory. By default images are not cached')
+@click.option('--packed-images/--no-packed-images', default=False,
+              help='Read the images resized to the input size from a '
+                   'memory mapped file, refer to efficientdet.data.store')
+@click.option('--batched-augmentation/--example-augmentation', default=False,
+              help='Augment whole batches with vectorized operations instead '
+                   'of augmenting each example')
+@click.option('--aspect-ratio-buckets/--square-inputs', default=False,
+              help='Letterbox the images in rectangular shapes depending on '
+                   'their aspect ratio instead of resizing them to a square')
+@click.option('--progressive-sizes', type=str, default='',
+              help='Increasing input sizes, separated using comma, to train '
+                   'the first epochs with smaller images. For example '
+                   '256,384. The last epochs always use the model input '
+                   'size. By default all epochs use the model input size')
+@click.option('--data-service', type=str, default='',
+              help='Address of a tf.data service dispatcher running the '
+                   'training input pipeline, for example '
+                   'grpc://localhost:5050. The examples are batched in the '
+                   'training process, so no example is dropped. Refer to '
+                   'efficientdet.data.service')
+@click.option('--data-service-workers', type=int, default=0,
+              help='Launch a local tf.data service with this number of '
+                   'worker processes to run the training input pipeline')
+@click.option('--data-service-cpus', type=str, default='',
+              help='CPU cores the local tf.data service workers are pinned '
+                   'to, for example 8-15')
+
 # Logging parameters
 @click.option('--print-freq', type=int, default=10,
               help='Print training loss every n steps')
 @click.option('--validate-freq', type=int, default=3,
               help='Print COCO evaluations every n epochs')
+@click.option('--checkpoint-every', type=int, default=0,
+              help='Checkpoint the training state, including the dataset '
+                   'iterator, every n steps in the train_state directory '
+                   'of --save-dir. An interrupted training is resumed from '
+                   'its last checkpoint. By default only the model is saved '
+                   'at the end of each epoch')
 
 # Data parameters
-@click.option('--format', type=click.Choice(['VOC', 'labelme']),
+@click.option('--format', type=click.Choice(['VOC', 'labelme', 'tfrecord']),
               required=True, help='Dataset to use for training')
 @click.option('--train-dataset', type=click.Path(file_okay=False, exists=True),
               required=True, help='Path to annotations and images')
@@ -230,6 +450,15 @@ def train(**kwargs):
 @click.option('--save-dir', help='Directory to save model weights',
               required=True, default='models', 
               type=click.Path(file_okay=False))
+@click.option('--keep-checkpoints', type=int, default=0,
+              help='Number of most recent epoch checkpoints to keep. By '
+                   'default all of them are kept')
+@click.option('--keep-best-checkpoints', type=int, default=0,
+              help='Number of checkpoints with the best validation mAP to '
+                   'keep besides the most recent ones')
+@click.option('--upload-to', type=str, default='',
+              help='Directory or gs://bucket/prefix where the checkpoints '
+                   'are uploaded in the background')
 def main(**kwargs):
     train(**kwargs)
 
@@ -1,5 +1,6 @@
 from . import anchors
 from . import bndbox
+from . import matching
 from . import visualizer
 from . import tf_utils
 from . import checkpoint
\ No newline at end of file
@@ -12,12 +12,17 @@ limitations under the License.
 """
 
 import math
+import collections
 from typing import List, Union, Tuple, Sequence
 
 import numpy as np
 import tensorflow as tf
 
 from . import bndbox
+import efficientdet.config as config
+
+
+PYRAMID_LEVELS = (3, 4, 5, 6, 7)
 
 
 class AnchorGenerator(object):
@@ -115,22 +120,181 @@ class AnchorGenerator(object):
         return len(self.aspect_ratios) * len(self.anchor_scales)
 
 
-@tf.function(
-    input_signature=[tf.TensorSpec(shape=[None, 4], dtype=tf.float32),
-                     tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.float32),
-                     tf.TensorSpec(shape=[None, None, 4], dtype=tf.float32),
-                     tf.TensorSpec(shape=[None, None], dtype=tf.int32),
-                     tf.TensorSpec(shape=None, dtype=tf.int32),
-                     tf.TensorSpec(shape=None, dtype=tf.float32),
-                     tf.TensorSpec(shape=None, dtype=tf.float32)])
-def anchor_targets_bbox(anchors: tf.Tensor,
-                        images: tf.Tensor,
-                        bndboxes: tf.Tensor,
-                        labels: tf.Tensor,
-                        num_classes: int,
-                        negative_overlap: float = 0.4,
-                        positive_overlap: float = 0.5) -> Tuple[tf.Tensor,
-                                                                tf.Tensor]:
+def _feature_map_size(size: int, stride: int) -> int:
+    # Backbone and BiFPN use 'same' padding, so the feature map size is
+    # the ceil of the input size divided by the level stride
+    return int(math.ceil(size / stride))
+
+
+def _generate_anchors(im_size: Tuple[int, int],
+                      anchors_config: config.AnchorsConfig,
+                      levels: Sequence[int]) -> tf.Tensor:
+    h, w = im_size
+    anchors = []
+    for level in levels:
+        stride = anchors_config.strides[level - 3]
+        gen = AnchorGenerator(size=anchors_config.sizes[level - 3],
+                              aspect_ratios=anchors_config.ratios,
+                              stride=stride)
+        fm_shape = (_feature_map_size(h, stride), 
+                    _feature_map_size(w, stride), 3)
+        anchors.append(gen(fm_shape))
+
+    return tf.concat(anchors, axis=0)
+
+
+class AnchorsCache(object):
+    """
+    Process-wide LRU cache of precomputed anchors
+
+    Anchors only depend on the input image size, the anchors configuration
+    and the pyramid levels, so they are generated once and reused by both
+    training and inference.
+
+    Parameters
+    ----------
+    max_size: int, default 16
+        Maximum number of anchor tensors kept in memory. When the limit
+        is exceeded the least recently used entry is evicted
+    """
+    def __init__(self, max_size: int = 16):
+        assert max_size > 0, 'Cache max_size must be greater than 0'
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def _key(self, 
+             im_size: Tuple[int, int], 
+             anchors_config: config.AnchorsConfig,
+             levels: Sequence[int]):
+        anchors_config = config.AnchorsConfig(
+            *[tuple(o) for o in anchors_config])
+        h, w = im_size
+        return int(h), int(w), anchors_config, tuple(levels)
+
+    def get(self,
+            im_size: Tuple[int, int],
+            anchors_config: config.AnchorsConfig = config.AnchorsConfig(),
+            levels: Sequence[int] = PYRAMID_LEVELS) -> tf.Tensor:
+        """
+        Returns the anchors for the given image size, generating them
+        only if they are not already cached
+
+        Parameters
+        ----------
+        im_size: Tuple[int, int]
+            Input image (height, width)
+        anchors_config: config.AnchorsConfig
+            Anchors sizes, strides and aspect ratios
+        levels: Sequence[int], default (3, 4, 5, 6, 7)
+            Pyramid levels where the anchors are tiled
+
+        Returns
+        -------
+        tf.Tensor of shape [N_ANCHORS, 4]
+        """
+        key = self._key(im_size, anchors_config, levels)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+
+        # Anchors are created eagerly so they are captured as a constant
+        # when the cache is accessed inside a tf.function
+        with tf.init_scope():
+            anchors = _generate_anchors(key[:2], key[2], key[3])
+
+        self._cache[key] = anchors
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        return anchors
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+
+anchors_cache = AnchorsCache()
+
+
+def generate_anchors(anchors_config: config.AnchorsConfig,
+                     im_size: Union[int, Tuple[int, int]],
+                     levels: Sequence[int] = PYRAMID_LEVELS) -> tf.Tensor:
+    """
+    Get the anchors of all pyramid levels for an input image size.
+    Anchors are memoized by the process-wide `anchors_cache`.
+
+    Parameters
+    ----------
+    anchors_config: config.AnchorsConfig
+        Anchors sizes, strides and aspect ratios
+    im_size: Union[int, Tuple[int, int]]
+        Input image size. If it is an int the image is assumed to be squared
+    levels: Sequence[int], default (3, 4, 5, 6, 7)
+        Pyramid levels where the anchors are tiled
+
+    Returns
+    -------
+    tf.Tensor of shape [N_ANCHORS, 4]
+    """
+    if isinstance(im_size, int):
+        im_size = (im_size, im_size)
+    return anchors_cache.get(im_size, anchors_config, levels)
+
+
+def anchors_per_level(anchors_config: config.AnchorsConfig,
+                      im_size: Union[int, Tuple[int, int]],
+                      levels: Sequence[int] = PYRAMID_LEVELS) -> List[int]:
+    """
+    Number of anchors tiled at each pyramid level. The anchors returned by
+    `generate_anchors` are the concatenation of the levels in this order.
+
+    Parameters
+    ----------
+    anchors_config: config.AnchorsConfig
+        Anchors sizes, strides and aspect ratios
+    im_size: Union[int, Tuple[int, int]]
+        Input image size. If it is an int the image is assumed to be squared
+    levels: Sequence[int], default (3, 4, 5, 6, 7)
+        Pyramid levels where the anchors are tiled
+
+    Returns
+    -------
+    List[int]
+    """
+    if isinstance(im_size, int):
+        im_size = (im_size, im_size)
+    h, w = im_size
+    
+    anchors_per_location = (len(anchors_config.ratios) * 
+                            len(anchors_config.scales))
+    sizes = []
+    for level in levels:
+        stride = anchors_config.strides[level - 3]
+        sizes.append(_feature_map_size(h, stride) * 
+                     _feature_map_size(w, stride) * 
+                     anchors_per_location)
+    return sizes
+
+
+def compute_anchor_targets(anchors: tf.Tensor,
+                           images: tf.Tensor,
+                           bndboxes: tf.Tensor,
+                           labels: tf.Tensor,
+                           num_classes: int,
+                           negative_overlap: float = 0.4,
+                           positive_overlap: float = 0.5,
+                           matcher: 'IoUMatcher' = None,
+                           compact: bool = False,
+                           regression_dtype: tf.DType = tf.float32):
     """ 
     Generate anchor targets for bbox detection.
 
@@ -140,10 +304,12 @@ def anchor_targets_bbox(anchors: tf.Tensor,
         Annotations of shape (N, 4) for (x1, y1, x2, y2).
     images: tf.Tensor
         Array of shape [BATCH, H, W, C] containing images.
-    bndboxes: tf.Tensor
-        Array of shape [BATCH, N, 4] contaning ground truth boxes
-    labels: tf.Tensor
-        Array of shape [BATCH, N] containing the labels for each box
+    bndboxes: Union[tf.Tensor, tf.RaggedTensor]
+        Array of shape [BATCH, N, 4] contaning ground truth boxes. Ragged
+        boxes avoid computing overlaps with padding boxes
+    labels: Union[tf.Tensor, tf.RaggedTensor]
+        Array of shape [BATCH, N] containing the labels for each box. Must
+        be ragged if bndboxes is ragged
     num_classes: int
         Number of classes to predict.
     negative_overlap: float, default 0.4
@@ -152,8 +318,16 @@ def anchor_targets_bbox(anchors: tf.Tensor,
     positive_overlap: float, default 0.5
         IoU overlap or positive anchors 
         (all anchors with overlap > positive_overlap are positive).
-    padding_value: int
-        Value used to pad labels
+    matcher: IoUMatcher, default None
+        Strategy used to compute the anchors overlaps with the ground truth
+        boxes. Refer to efficientdet.utils.matching. If left to None, the
+        overlaps are computed densely.
+    compact: bool, default False
+        Return the targets in the compact format. Refer to the returned
+        values section.
+    regression_dtype: tf.DType, default tf.float32
+        Data type of the compact regression targets. Use tf.float16 to
+        halve its size
         
     Returns
     --------
@@ -169,6 +343,17 @@ def anchor_targets_bbox(anchors: tf.Tensor,
             where N is the number of anchors for an image, the first 4 columns 
             define regression targets for (x1, y1, x2, y2) and the
             last column defines anchor states (-1 for ignore, 0 for bg, 1 for fg).
+    Tuple[tf.Tensor, Tuple[tf.Tensor, tf.Tensor]]
+        When compact is set to True, the returned values are
+        regression_batch: 
+            tf.Tensor of shape (batch_size, N, 4) and `regression_dtype`
+            containing the regression targets
+        (class_batch, anchors_states):
+            class_batch is a tf.int16 tensor of shape (batch_size, N) with 
+            the class index of the positive anchors and -1 otherwise.
+            anchors_states is a tf.int8 tensor of shape (batch_size, N)
+            (-1 for ignore, 0 for bg, 1 for fg).
+        Use `expand_compact_targets` to convert them to the default format
     """
     im_shape = tf.shape(images)
     batch_size = im_shape[0]
@@ -180,9 +365,19 @@ def anchor_targets_bbox(anchors: tf.Tensor,
     result = compute_gt_annotations(anchors, 
                                     bndboxes,
                                     negative_overlap, 
-                                    positive_overlap)
+                                    positive_overlap,
+                                    matcher=matcher)
     positive_indices, ignore_indices, argmax_overlaps_inds = result
 
+    if isinstance(bndboxes, tf.RaggedTensor):
+        # Labels and boxes are padded only to gather them. An extra padding
+        # column makes the gather valid even if no image has boxes
+        labels = tf.concat([labels.to_tensor(-1), 
+                            -tf.ones([batch_size, 1], dtype=labels.dtype)], 
+                           axis=1)
+        bndboxes = tf.concat([bndboxes.to_tensor(-1.),
+                              -tf.ones([batch_size, 1, 4])], axis=1)
+
     # Expand ignore indices with out of image anchors
     x_anchor_centre = (anchors[:, 0] + anchors[:, 2]) / 2.
     y_anchor_centre = (anchors[:, 1] + anchors[:, 3]) / 2.
@@ -201,15 +396,23 @@ def anchor_targets_bbox(anchors: tf.Tensor,
     # To ignore the label add -1
     labels_per_anchor = tf.where(positive_indices, chose_labels, -1)
     labels_per_anchor = tf.where(ignore_indices, -1, labels_per_anchor)
-    labels_per_anchor = tf.one_hot(labels_per_anchor, 
-                                   axis=-1, depth=num_classes)
-    labels_per_anchor = tf.cast(labels_per_anchor, tf.float32)
 
     # Add regression for each anchor
     chose_bndboxes = tf.gather_nd(bndboxes, argmax_overlaps_inds)
     chose_bndboxes = tf.reshape(chose_bndboxes, [batch_size, -1, 4])
     regression_per_anchor = tf.zeros([batch_size, n_anchors, 4])
     regression_per_anchor = bbox_transform(anchors, chose_bndboxes)
+
+    if compact:
+        anchors_states = tf.cast(positive_indices, tf.int8)
+        anchors_states = tf.where(ignore_indices, 
+                                  tf.constant(-1, tf.int8), anchors_states)
+        return (tf.cast(regression_per_anchor, regression_dtype),
+                (tf.cast(labels_per_anchor, tf.int16), anchors_states))
+
+    labels_per_anchor = tf.one_hot(labels_per_anchor, 
+                                   axis=-1, depth=num_classes)
+    labels_per_anchor = tf.cast(labels_per_anchor, tf.float32)
     
     # Generate extra label to add the state of the label. 
     # (It should be ignored?)
@@ -224,12 +427,163 @@ def anchor_targets_bbox(anchors: tf.Tensor,
     return regression_per_anchor, labels_per_anchor
 
 
+@tf.function(
+    input_signature=[tf.TensorSpec(shape=[None, 4], dtype=tf.float32),
+                     tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.float32),
+                     tf.TensorSpec(shape=[None, None, 4], dtype=tf.float32),
+                     tf.TensorSpec(shape=[None, None], dtype=tf.int32),
+                     tf.TensorSpec(shape=None, dtype=tf.int32),
+                     tf.TensorSpec(shape=None, dtype=tf.float32),
+                     tf.TensorSpec(shape=None, dtype=tf.float32)])
+def anchor_targets_bbox(anchors: tf.Tensor,
+                        images: tf.Tensor,
+                        bndboxes: tf.Tensor,
+                        labels: tf.Tensor,
+                        num_classes: int,
+                        negative_overlap: float = 0.4,
+                        positive_overlap: float = 0.5) -> Tuple[tf.Tensor,
+                                                                tf.Tensor]:
+    """ 
+    Graph compiled version of `compute_anchor_targets` using dense IoU 
+    matching. Refer to `compute_anchor_targets` for the parameters and
+    returned values.
+    """
+    return compute_anchor_targets(anchors, images, bndboxes, labels, 
+                                  num_classes, 
+                                  negative_overlap=negative_overlap,
+                                  positive_overlap=positive_overlap)
+
+
+@tf.function(
+    input_signature=[tf.TensorSpec(shape=[None, 4], dtype=tf.float32),
+                     tf.TensorSpec(shape=[None, None, None, 3], dtype=tf.float32),
+                     tf.RaggedTensorSpec(shape=[None, None, 4], 
+                                         dtype=tf.float32, ragged_rank=1),
+                     tf.RaggedTensorSpec(shape=[None, None], dtype=tf.int32),
+                     tf.TensorSpec(shape=None, dtype=tf.int32),
+                     tf.TensorSpec(shape=None, dtype=tf.float32),
+                     tf.TensorSpec(shape=None, dtype=tf.float32)])
+def ragged_anchor_targets_bbox(
+        anchors: tf.Tensor,
+        images: tf.Tensor,
+        bndboxes: tf.RaggedTensor,
+        labels: tf.RaggedTensor,
+        num_classes: int,
+        negative_overlap: float = 0.4,
+        positive_overlap: float = 0.5) -> Tuple[tf.Tensor, tf.Tensor]:
+    """ 
+    Same as `anchor_targets_bbox` but for ragged ground truth boxes and
+    labels, as the ones generated by efficientdet.data.build_ds with
+    ragged=True.
+    """
+    return compute_anchor_targets(anchors, images, bndboxes, labels, 
+                                  num_classes, 
+                                  negative_overlap=negative_overlap,
+                                  positive_overlap=positive_overlap)
+
+
+def expand_compact_targets(
+        regression_targets: tf.Tensor,
+        class_targets: Tuple[tf.Tensor, tf.Tensor],
+        num_classes: int) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Converts the compact anchor targets returned by `compute_anchor_targets`
+    to the default format of float32 one-hot class targets and regression 
+    targets, both with the anchors states as last column.
+
+    Parameters
+    ----------
+    regression_targets: tf.Tensor of shape [BATCH, N, 4]
+    class_targets: Tuple[tf.Tensor, tf.Tensor]
+        Class indices and anchors states, both of shape [BATCH, N]
+    num_classes: int
+        Number of classes to predict.
+
+    Returns
+    -------
+    Tuple[tf.Tensor, tf.Tensor]
+        Regression targets of shape [BATCH, N, 5] and class targets of 
+        shape [BATCH, N, num_classes + 1]
+    """
+    labels, anchors_states = class_targets
+    anchors_states = tf.expand_dims(tf.cast(anchors_states, tf.float32), -1)
+
+    labels = tf.one_hot(tf.cast(labels, tf.int32), depth=num_classes)
+    regression_targets = tf.cast(regression_targets, tf.float32)
+
+    return (tf.concat([regression_targets, anchors_states], axis=-1),
+            tf.concat([labels, anchors_states], axis=-1))
+
+
+def _max_overlaps(anchors: tf.Tensor,
+                  annotations: tf.Tensor,
+                  matcher: 'IoUMatcher' = None) -> Tuple[tf.Tensor, tf.Tensor]:
+    if matcher is not None:
+        return matcher(anchors, annotations)
+
+    # Compute the ious between boxes, and get the argmax indices and 
+    # max values. Anchors are broadcasted over the batch
+    overlaps = bndbox.bbox_overlap(tf.expand_dims(anchors, 0), annotations)
+    return _reduce_overlaps(overlaps, annotations)
+
+
+def _reduce_overlaps(overlaps: tf.Tensor,
+                     annotations: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    # Padding boxes can be anywhere in the row (e.g. after augmenting the
+    # batch), so they are masked out instead of relying on their IoU being
+    # lower than the one of the valid boxes
+    is_padding = tf.less(tf.reduce_max(annotations, axis=-1), 0.)
+    is_padding = tf.broadcast_to(tf.expand_dims(is_padding, 1), 
+                                 tf.shape(overlaps))
+    overlaps = tf.where(is_padding, 
+                        tf.fill(tf.shape(overlaps), -np.inf), 
+                        overlaps)
+
+    argmax_overlaps_inds = tf.argmax(overlaps, axis=-1, output_type=tf.int32)
+    max_overlaps = tf.reduce_max(overlaps, axis=-1)
+
+    # Images without valid boxes have an overlap of -1 with the first box
+    no_boxes = tf.math.is_inf(max_overlaps)
+    max_overlaps = tf.where(no_boxes, -1., max_overlaps)
+    argmax_overlaps_inds = tf.where(
+        no_boxes, tf.zeros_like(argmax_overlaps_inds), argmax_overlaps_inds)
+    return max_overlaps, argmax_overlaps_inds
+
+
+def _ragged_max_overlaps(
+        anchors: tf.Tensor,
+        annotations: tf.RaggedTensor,
+        matcher: 'IoUMatcher' = None) -> Tuple[tf.Tensor, tf.Tensor]:
+    n_anchors = tf.shape(anchors)[0]
+    row_splits = tf.cast(annotations.row_splits, tf.int32)
+    
+    def match_image(i):
+        boxes = annotations.values[row_splits[i]: row_splits[i + 1]]
+        
+        def match():
+            max_overlaps, argmax_overlaps_inds = _max_overlaps(
+                anchors, tf.expand_dims(boxes, 0), matcher)
+            return max_overlaps[0], argmax_overlaps_inds[0]
+
+        # Images without boxes behave as if all its boxes were padding
+        def no_boxes():
+            return (-tf.ones([n_anchors]), 
+                    tf.zeros([n_anchors], dtype=tf.int32))
+
+        return tf.cond(tf.shape(boxes)[0] > 0, match, no_boxes)
+
+    return tf.map_fn(match_image, 
+                     tf.range(annotations.nrows(out_type=tf.int32)),
+                     fn_output_signature=(tf.float32, tf.int32))
+
+
 def compute_gt_annotations(anchors: tf.Tensor,
                            annotations: tf.Tensor,
                            negative_overlap=0.4,
-                           positive_overlap=0.5) -> Tuple[tf.Tensor,
-                                                          tf.Tensor,
-                                                          tf.Tensor]:
+                           positive_overlap=0.5,
+                           matcher: 'IoUMatcher' = None) -> Tuple[tf.Tensor,
+                                                                  tf.Tensor,
+                                                                  tf.Tensor]:
     """ 
     Obtain indices of gt annotations with the greatest overlap.
     
@@ -237,14 +591,21 @@ def compute_gt_annotations(anchors: tf.Tensor,
     ----------
     anchors: tf.Tensor
         Annotations of shape [N, 4] for (x1, y1, x2, y2).
-    annotations: tf.Tensor 
-        shape [BATCH, N, 4] for (x1, y1, x2, y2).
+    annotations: Union[tf.Tensor, tf.RaggedTensor]
+        shape [BATCH, N, 4] for (x1, y1, x2, y2). When annotations is a 
+        tf.RaggedTensor, the overlaps are computed for each image 
+        separately and only for its real boxes
     negative_overlap: float, default 0.4
         IoU overlap for negative anchors 
         (all anchors with overlap < negative_overlap are negative).
     positive_overlap: float, default 0.5
         IoU overlap or positive anchors 
         (all anchors with overlap > positive_overlap are positive).
+    matcher: IoUMatcher, default None
+        Computes the maximum overlap of each anchor and the index of the
+        ground truth box with the largest overlap. If left to None the
+        overlaps are computed densely materializing a 
+        [BATCH, N, MAX_NUM_INSTANCES] tensor.
 
     Returns
     -------
@@ -253,19 +614,20 @@ def compute_gt_annotations(anchors: tf.Tensor,
         ignore_indices: indices of ignored anchors
         argmax_overlaps_inds: ordered overlaps indices
     """
-    batch_size = tf.shape(annotations)[0]
     n_anchors = tf.shape(anchors)[0]
 
-    # Cast and reshape inputs to expected values
-    anchors = tf.expand_dims(anchors, 0)
+    # Cast inputs to expected values
     anchors = tf.cast(anchors, tf.float32)
-    anchors = tf.tile(anchors, [batch_size, 1, 1])
     annotations = tf.cast(annotations, tf.float32)
 
-    # Compute the ious between boxes, and get the argmax indices and max values
-    overlaps = bndbox.bbox_overlap(anchors, annotations)
-    argmax_overlaps_inds = tf.argmax(overlaps, axis=-1, output_type=tf.int32)
-    max_overlaps = tf.reduce_max(overlaps, axis=-1)
+    if isinstance(annotations, tf.RaggedTensor):
+        batch_size = annotations.nrows(out_type=tf.int32)
+        max_overlaps, argmax_overlaps_inds = _ragged_max_overlaps(
+            anchors, annotations, matcher)
+    else:
+        batch_size = tf.shape(annotations)[0]
+        max_overlaps, argmax_overlaps_inds = _max_overlaps(
+            anchors, annotations, matcher)
     
     # Generate index like [batch_idx, max_overlap]	
     batched_indices = tf.ones([batch_size, n_anchors], dtype=tf.int32) 	
@@ -1,5 +1,5 @@
 from functools import partial
-from typing import Tuple, List, Union
+from typing import Tuple, List, Sequence, Union
 
 import tensorflow as tf
 
@@ -99,6 +99,55 @@ def regress_bndboxes(boxes: tf.Tensor,
     return tf.stack([x1, y1, x2, y2], axis=2)
 
 
+def top_k_per_level(class_scores: tf.Tensor,
+                    regressors: tf.Tensor,
+                    anchors: tf.Tensor,
+                    level_sizes: Sequence[int],
+                    k: int = 1000) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Keeps the k highest scored anchors of each pyramid level, so only the
+    surviving candidates have to be decoded, clipped and suppressed.
+    Anchors are ranked by their maximum class score.
+
+    Parameters
+    ----------
+    class_scores: tf.Tensor of shape [BATCH, N, NUM_CLASSES]
+    regressors: tf.Tensor of shape [BATCH, N, 4]
+    anchors: tf.Tensor of shape [N, 4]
+    level_sizes: Sequence[int]
+        Number of anchors of each pyramid level. Must sum up to N
+    k: int, default 1000
+        Maximum number of candidates kept at each level
+    
+    Returns
+    -------
+    Tuple[tf.Tensor, tf.Tensor, tf.Tensor]
+        The class scores [BATCH, K, NUM_CLASSES], regressors [BATCH, K, 4]
+        and anchors [BATCH, K, 4] of the selected candidates, where K is the
+        sum of min(k, level_size) over all levels
+    """
+    level_sizes = list(level_sizes)
+    scores_per_level = tf.split(class_scores, level_sizes, axis=1)
+    regressors_per_level = tf.split(regressors, level_sizes, axis=1)
+    anchors_per_level = tf.split(anchors, level_sizes, axis=0)
+
+    it = zip(level_sizes, scores_per_level, 
+             regressors_per_level, anchors_per_level)
+
+    top_scores, top_regressors, top_anchors = [], [], []
+    for size, scores, regress, level_anchors in it:
+        _, indices = tf.math.top_k(tf.reduce_max(scores, axis=-1), 
+                                   k=min(k, size), 
+                                   sorted=False)
+        top_scores.append(tf.gather(scores, indices, batch_dims=1))
+        top_regressors.append(tf.gather(regress, indices, batch_dims=1))
+        top_anchors.append(tf.gather(level_anchors, indices))
+
+    return (tf.concat(top_scores, axis=1), 
+            tf.concat(top_regressors, axis=1), 
+            tf.concat(top_anchors, axis=1))
+
+
 def clip_boxes(boxes: tf.Tensor, 
                im_size: Tuple[int, int]) -> tf.Tensor:
     # TODO: Document this
@@ -115,12 +164,14 @@ def clip_boxes(boxes: tf.Tensor,
     return tf.stack([x1, y1, x2, y2], axis=2)
 
 
-# TODO: tf.function this?
 def nms(boxes: tf.Tensor, 
         class_scores: tf.Tensor,
         score_threshold: float = 0.5) -> tf.Tensor:
 
     """
+    Per image and per class non maximum suppression returning ragged python
+    lists. Prefer `batched_nms` when working inside a tf.function.
+
     Parameters
     ----------
     boxes: tf.Tensor of shape [BATCH, N, 4]
@@ -205,6 +256,72 @@ def nms(boxes: tf.Tensor,
     return all_boxes, all_labels, all_scores
     
 
+def batched_nms(boxes: tf.Tensor,
+                class_scores: tf.Tensor,
+                score_threshold: float = 0.5,
+                iou_threshold: float = 0.5,
+                max_detections_per_class: int = 100,
+                max_detections: int = 100) -> Tuple[tf.Tensor, tf.Tensor, 
+                                                    tf.Tensor, tf.Tensor]:
+    """
+    Per class non maximum suppression over the whole batch at once.
+    Unlike `nms`, outputs are padded to a fixed size, so this function can
+    be traced within a tf.function with a dynamic batch size.
+
+    Parameters
+    ----------
+    boxes: tf.Tensor of shape [BATCH, N, 4]
+        Boxes in [xmin, ymin, xmax, ymax] format
+    class_scores: tf.Tensor of shape [BATCH, N, NUM_CLASSES]
+    score_threshold: float, default 0.5
+        Classification score to keep the box
+    iou_threshold: float, default 0.5
+        Boxes of the same class overlapping more than this threshold with
+        a higher scored box are suppressed
+    max_detections_per_class: int, default 100
+        Maximum number of boxes kept for each class
+    max_detections: int, default 100
+        Maximum number of boxes kept for each image
+    
+    Returns
+    -------
+    Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]
+        boxes: tf.Tensor of shape [BATCH, max_detections, 4]
+        labels: tf.Tensor of shape [BATCH, max_detections]. Padded 
+            detections are labeled with -1
+        scores: tf.Tensor of shape [BATCH, max_detections]. Padded 
+            detections have a score of 0
+        num_valid: tf.Tensor of shape [BATCH] with the number of non padded
+            detections of each image
+    """
+    boxes = tf.cast(boxes, tf.float32)
+    class_scores = tf.cast(class_scores, tf.float32)
+
+    # combined_non_max_suppression works with [ymin, xmin, ymax, xmax]
+    x1, y1, x2, y2 = tf.unstack(boxes, 4, axis=-1)
+    boxes = tf.stack([y1, x1, y2, x2], axis=-1)
+
+    nms_boxes, nms_scores, nms_labels, num_valid = \
+        tf.image.combined_non_max_suppression(
+            tf.expand_dims(boxes, 2),
+            class_scores,
+            max_output_size_per_class=max_detections_per_class,
+            max_total_size=max_detections,
+            iou_threshold=iou_threshold,
+            score_threshold=score_threshold,
+            pad_per_class=False,
+            clip_boxes=False)
+
+    y1, x1, y2, x2 = tf.unstack(nms_boxes, 4, axis=-1)
+    nms_boxes = tf.stack([x1, y1, x2, y2], axis=-1)
+
+    valid_mask = tf.less(tf.range(tf.shape(nms_labels)[1]), 
+                         tf.expand_dims(num_valid, -1))
+    nms_labels = tf.where(valid_mask, tf.cast(nms_labels, tf.int32), -1)
+
+    return nms_boxes, nms_labels, nms_scores, num_valid
+
+
 def bbox_overlap(boxes, gt_boxes):
     """
     Calculates the overlap between proposal and ground truth boxes.
@@ -1,13 +1,22 @@
+import abc
 import json
 import base64
+import shutil
 import hashlib
 from pathlib import Path
-from typing import Union
 from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Mapping, Sequence, Union
+
+import numpy as np
 
 import tensorflow as tf
 
 
+WEIGHTS_FILE = 'model.npz'
+INDEX_FILE = 'checkpoints.json'
+
+
 def _md5(fname):
     hash_md5 = hashlib.md5()
     with open(str(fname), "rb") as f:
@@ -57,6 +66,308 @@ def save(model: 'EfficientDet',
             f'gs://ml-generic-purpose-tf-models/{prefix}/model.tf')
 
 
+class RemoteStore(abc.ABC):
+    """
+    Destination where AsyncCheckpointManager pushes the checkpoints once
+    they are written locally. Each checkpoint is a directory identified
+    by its name
+    """
+    @abc.abstractmethod
+    def upload(self, local_dir: Path, name: str):
+        """
+        Pushes the files of the local checkpoint directory
+        """
+
+    @abc.abstractmethod
+    def delete(self, name: str):
+        """
+        Deletes the checkpoint, if it exists
+        """
+
+    @abc.abstractmethod
+    def list(self) -> Sequence[str]:
+        """
+        Sorted names of the stored checkpoints
+        """
+
+
+class LocalDirectoryStore(RemoteStore):
+    """
+    Copies the checkpoints to another directory, for example a mounted
+    network filesystem
+
+    Parameters
+    ----------
+    root: Union[str, Path]
+        Directory where the checkpoints are copied
+    """
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+
+    def upload(self, local_dir: Path, name: str):
+        # Copied to a temporary directory and then renamed, so a reader
+        # never sees a partially copied checkpoint
+        tmp_dir = self.root / f'.{name}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(local_dir, tmp_dir)
+        self.delete(name)
+        tmp_dir.rename(self.root / name)
+
+    def delete(self, name: str):
+        shutil.rmtree(self.root / name, ignore_errors=True)
+
+    def list(self) -> Sequence[str]:
+        return sorted(p.name for p in self.root.iterdir() 
+                      if p.is_dir() and not p.name.startswith('.'))
+
+
+class GCSStore(RemoteStore):
+    """
+    Uploads the checkpoints to a google cloud storage bucket, where they
+    can be loaded with efficientdet.checkpoint.load using a 
+    gs://{bucket}/{prefix}/{name} path
+
+    Parameters
+    ----------
+    bucket: str, default 'ml-generic-purpose-tf-models'
+        Bucket where the checkpoints are uploaded
+    prefix: str, default ''
+        Path within the bucket of the checkpoints directories
+    project: str, default 'ml-generic-purpose'
+        Google cloud project of the bucket
+    """
+    def __init__(self, 
+                 bucket: str = 'ml-generic-purpose-tf-models',
+                 prefix: str = '',
+                 project: str = 'ml-generic-purpose'):
+        from google.cloud import storage
+
+        client = storage.Client(project=project)
+        self.bucket = client.bucket(bucket)
+        self.prefix = prefix.strip('/')
+
+    def _blob_prefix(self, name: str = '') -> str:
+        return '/'.join(filter(None, [self.prefix, name])) + '/'
+
+    def upload(self, local_dir: Path, name: str):
+        prefix = self._blob_prefix(name)
+        for f in Path(local_dir).iterdir():
+            self.bucket.blob(prefix + f.name).upload_from_filename(str(f))
+
+    def delete(self, name: str):
+        for blob in self.bucket.list_blobs(prefix=self._blob_prefix(name)):
+            blob.delete()
+
+    def list(self) -> Sequence[str]:
+        # With a delimiter, the checkpoints directories are listed as 
+        # prefixes once all the pages are consumed
+        prefix = self._blob_prefix()
+        blobs = self.bucket.list_blobs(prefix=prefix, delimiter='/')
+        for _ in blobs:
+            pass
+        return sorted(p[len(prefix):].rstrip('/') for p in blobs.prefixes)
+
+
+class AsyncCheckpointManager(object):
+    """
+    Saves the model without blocking the training loop
+
+    The weights are copied to host memory when AsyncCheckpointManager.save
+    is called, and written along with the hyperparameters from a 
+    background thread, which then pushes the checkpoint to the remote 
+    store. Only a single checkpoint is written at a time, so saving waits
+    for the previous one to finish, which bounds the memory used by the
+    copies. The checkpoints can be loaded with efficientdet.checkpoint.load
+
+    Old checkpoints are deleted, both locally and from the remote store,
+    except the last `keep_last` ones and the `keep_best` ones with the best
+    metric. The kept checkpoints are listed in a checkpoints.json file 
+    within `save_dir`, so the rotation continues after a restart.
+
+    Parameters
+    ----------
+    save_dir: Union[str, Path]
+        Directory where the checkpoints directories are written
+    parameters: dict
+        Dictionary containing the CLI arguments used to train the model
+    keep_last: int, default None
+        Number of most recent checkpoints to keep. By default all the 
+        checkpoints are kept
+    keep_best: int, default 0
+        Number of checkpoints with the best metric to keep besides the most
+        recent ones
+    mode: str, choice of [max, min], default max
+        Whether the best metric is the highest or the lowest
+    store: RemoteStore, default None
+        Where the checkpoints are pushed after being written
+
+    Examples
+    --------
+    >>> manager = AsyncCheckpointManager('models', hparams, keep_last=2,
+    ...                                  keep_best=1, store=store)
+    >>> manager.save(model, 'D0_VOC_3', metric=0.42)
+    >>> # Training continues while the checkpoint is written
+    >>> manager.close()
+    """
+    def __init__(self,
+                 save_dir: Union[str, Path],
+                 parameters: dict,
+                 keep_last: int = None,
+                 keep_best: int = 0,
+                 mode: str = 'max',
+                 store: RemoteStore = None):
+        assert mode in {'max', 'min'}, 'Mode must be either max or min'
+
+        self.save_dir = Path(save_dir)
+        self.save_dir.mkdir(exist_ok=True, parents=True)
+        self.parameters = parameters
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.store = store
+
+        self.checkpoints = []
+        index_path = self.save_dir / INDEX_FILE
+        if index_path.exists():
+            with index_path.open() as f:
+                self.checkpoints = json.load(f)
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def save(self, 
+             model: tf.keras.Model, 
+             name: str, 
+             metric: float = None) -> Future:
+        """
+        Copies the model weights to host memory and writes them in the
+        background
+
+        Parameters
+        ----------
+        model: tf.keras.Model
+        name: str
+            Name of the checkpoint directory
+        metric: float, default None
+            Validation metric used to keep the best checkpoints. 
+            Checkpoints without metric are only kept while they are
+            among the most recent ones
+
+        Returns
+        -------
+        Future
+            Completed when the checkpoint has been written and pushed to
+            the remote store
+        """
+        # Raises the errors of the previous checkpoint
+        self.wait()
+
+        weights = [v.numpy() for v in model.weights]
+        self._pending = self._executor.submit(self._write, weights, 
+                                              name, metric)
+        return self._pending
+
+    def wait(self):
+        """
+        Waits until the pending checkpoint has been written
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self) -> 'AsyncCheckpointManager':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, weights: Sequence[np.ndarray], name: str, metric: float):
+        # Written to a temporary directory and then renamed, so a crash 
+        # never leaves a partially written checkpoint
+        save_dir = self.save_dir / name
+        tmp_dir = self.save_dir / f'.{name}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        with (tmp_dir / 'hp.json').open('w') as f:
+            json.dump(self.parameters, f)
+        np.savez(str(tmp_dir / WEIGHTS_FILE), *weights)
+
+        shutil.rmtree(save_dir, ignore_errors=True)
+        tmp_dir.rename(save_dir)
+
+        if self.store is not None:
+            self.store.upload(save_dir, name)
+
+        self.checkpoints = [c for c in self.checkpoints if c['name'] != name]
+        self.checkpoints.append(dict(name=name, metric=metric))
+        self._rotate()
+
+    def _rotate(self):
+        keep = self._kept_names()
+        for c in self.checkpoints:
+            if c['name'] not in keep:
+                shutil.rmtree(self.save_dir / c['name'], ignore_errors=True)
+                if self.store is not None:
+                    self.store.delete(c['name'])
+
+        self.checkpoints = [c for c in self.checkpoints if c['name'] in keep]
+        with (self.save_dir / INDEX_FILE).open('w') as f:
+            json.dump(self.checkpoints, f)
+
+    def _kept_names(self) -> Sequence[str]:
+        if self.keep_last is None:
+            return {c['name'] for c in self.checkpoints}
+
+        keep = {c['name'] for c in self.checkpoints[-self.keep_last:]} \
+            if self.keep_last > 0 else set()
+
+        scored = [c for c in self.checkpoints if c['metric'] is not None]
+        scored.sort(key=lambda c: c['metric'], reverse=self.mode == 'max')
+        keep.update(c['name'] for c in scored[:self.keep_best])
+        return keep
+
+
+def _load_weights(model: 'EfficientDet', weights_path: Path):
+    # The model variables are created with a dummy batch so they can be
+    # assigned in the same order they were saved
+    input_size = model.config.input_size
+    model(tf.zeros([1, input_size, input_size, 3]), training=False)
+    with np.load(str(weights_path)) as f:
+        model.set_weights([f[f'arr_{i}'] for i in range(len(f.files))])
+
+
+def _download(bucket: 'storage.Bucket', 
+              prefix: str, 
+              local_dir: Path) -> Sequence[Path]:
+    # Only the files that changed are downloaded, and the cached files
+    # that are not part of the checkpoint anymore are removed
+    local_dir.mkdir(exist_ok=True, parents=True)
+
+    files = []
+    for blob in bucket.list_blobs(prefix=prefix):
+        fname = local_dir / blob.name[len(prefix):]
+        if fname.parent != local_dir:
+            continue
+        if not fname.exists() or _md5(fname) != blob.md5_hash:
+            blob.download_to_filename(str(fname))
+        files.append(fname)
+
+    for f in local_dir.iterdir():
+        if f not in files:
+            if f.is_dir():
+                shutil.rmtree(f)
+            else:
+                f.unlink()
+
+    return files
+
+
 def load(save_dir_or_url: Union[str, Path], **kwargs) -> 'EfficientDet':
     """
     Load efficientdet model from google cloud storage or from local
@@ -71,34 +382,28 @@ def load(save_dir_or_url: Union[str, Path], **kwargs) -> 'EfficientDet':
         from google import auth
         from google.cloud import storage
 
-        save_dir = Path.home() / '.effdet-checkpoints'
-        save_dir.mkdir(exist_ok=True, parents=True)
-        
+        # Each checkpoint has its own cache directory, so files of other
+        # checkpoints are never mistaken for its own
+        prefix = save_dir_url.path.strip('/')
+        save_dir = (Path.home() / '.effdet-checkpoints' / 
+                    save_dir_url.netloc / prefix)
+
         client = storage.Client(
             project='ml-generic-purpose',
             credentials=auth.credentials.AnonymousCredentials())
-        bucket = client.bucket('ml-generic-purpose-tf-models')
-
-        prefix = save_dir_url.path[1:] + '/'
-        blobs = bucket.list_blobs(prefix=prefix)
+        bucket = client.bucket(save_dir_url.netloc)
+        files = _download(bucket, prefix + '/', save_dir)
+    else:
+        save_dir = Path(save_dir_or_url)
+        files = list(save_dir.iterdir()) if save_dir.is_dir() else []
 
-        hp_fname = save_dir / 'hp.json'
-        model_path = save_dir / 'model.tf'
+    hp_fname = save_dir / 'hp.json'
 
-        hp_blob = bucket.blob(prefix + 'hp.json')
-        hp_blob.reload()
-
-        if hp_fname.exists() and _md5(hp_fname) != hp_blob.md5_hash:
-            for blob in blobs:
-                fname = save_dir / blob.name.replace(prefix, '')
-                blob.download_to_filename(fname)
-        elif not hp_fname.exists():
-            for blob in blobs:
-                fname = save_dir / blob.name.replace(prefix, '')
-                blob.download_to_filename(fname)
+    # Checkpoints written by AsyncCheckpointManager
+    if any(f.name == WEIGHTS_FILE for f in files):
+        model_path = save_dir / WEIGHTS_FILE
     else:
-        hp_fname = Path(save_dir_or_url) / 'hp.json'
-        model_path = Path(save_dir_or_url) / 'model.tf'
+        model_path = save_dir / 'model.tf'
 
     assert hp_fname.exists()
 
@@ -116,7 +421,10 @@ def load(save_dir_or_url: Union[str, Path], **kwargs) -> 'EfficientDet':
         **kwargs)
     
     print('Loading model weights from {}...'.format(str(model_path)))
-    model.load_weights(str(model_path))
+    if model_path.suffix == '.npz':
+        _load_weights(model, model_path)
+    else:
+        model.load_weights(str(model_path))
     for l in model.layers:
         l.trainable = False
     model.trainable = False
@@ -1,18 +1,177 @@
-from typing import Tuple
+from typing import Sequence, Tuple
 
 import tensorflow as tf
-from efficientdet.data import preprocess
+from efficientdet.data import preprocess, buckets
+
+
+# Downscaling factors supported by the JPEG decoder
+_JPEG_RATIOS = (1, 2, 4, 8)
+
+
+def _jpeg_ratio_index(im_bytes: tf.Tensor,
+                      im_size: Tuple[int, int]) -> tf.Tensor:
+    # Index of the largest ratio that still decodes an image bigger than
+    # the target size, so the resize never upsamples a downscaled image
+    shape = tf.image.extract_jpeg_shape(im_bytes)
+    h, w = shape[0], shape[1]
+    fits = [tf.logical_and(h // r >= im_size[0], w // r >= im_size[1])
+            for r in _JPEG_RATIOS]
+    return tf.reduce_sum(tf.cast(tf.stack(fits[1:]), tf.int32))
+
+
+def _decode_jpeg(im_bytes: tf.Tensor, im_size: Tuple[int, int]) -> tf.Tensor:
+    # The JPEG decoder downscales in the DCT domain, which is much faster
+    # than decoding the full resolution image. The ratio is an attribute
+    # of the op, so there is one branch per ratio
+    branches = [lambda r=r: tf.image.decode_jpeg(im_bytes, channels=3,
+                                                  ratio=r)
+                for r in _JPEG_RATIOS]
+    return tf.switch_case(_jpeg_ratio_index(im_bytes, im_size), branches)
+
+
+def _decode_any(im_bytes: tf.Tensor) -> tf.Tensor:
+    return tf.io.decode_image(im_bytes, channels=3, expand_animations=False)
+
+
+def _decode(im_bytes: tf.Tensor, im_size: Tuple[int, int]) -> tf.Tensor:
+    # Decodes an image of any format. JPEG images are decoded to the 
+    # smallest size larger than im_size
+    im = tf.cond(tf.io.is_jpeg(im_bytes),
+                 lambda: _decode_jpeg(im_bytes, im_size),
+                 lambda: _decode_any(im_bytes))
+    im.set_shape([None, None, 3])
+    return im
+
+
+def cast_image(image: tf.Tensor,
+               dtype: tf.DType,
+               normalize_image: bool = False) -> tf.Tensor:
+    """
+    Converts an image with values in the [0, 255] range to the given type.
+    uint8 images are rounded, float images are scaled to the [0, 1] range
+    and optionally normalized according imagenet mean and std
+    """
+    if dtype == tf.uint8:
+        if image.dtype == tf.uint8:
+            return image
+        return tf.saturate_cast(tf.round(image), tf.uint8)
+
+    image = tf.cast(image, tf.float32) / 255.
+    if normalize_image:
+        image = preprocess.normalize_image(image)
+    return image
+
+
+def decode_image(im_bytes: tf.Tensor,
+                 im_size: Tuple[int, int],
+                 normalize_image: bool = False,
+                 dtype: tf.DType = tf.float32) -> tf.Tensor:
+    """
+    Decodes an encoded image and resizes it
+
+    The image is resized before converting it to float, so the float
+    work is proportional to the model input size instead of the original
+    image size. JPEG images are decoded at a reduced resolution when they
+    are at least twice as large as `im_size`. Other formats such as PNG,
+    BMP or GIF are detected from the content.
+
+    Parameters
+    ----------
+    im_bytes: tf.Tensor of type tf.string
+        Encoded image
+    im_size: Tuple[int, int]
+        Output height and width
+    normalize_image: bool, default False
+        Normalize the image according imagenet mean and std
+    dtype: tf.DType, default tf.float32
+        If tf.uint8, the resized image is returned in the [0, 255] range
+        and `normalize_image` is ignored. Refer to 
+        efficientdet.models.layers.ImageNormalization
+
+    Returns
+    -------
+    tf.Tensor of shape [*im_size, 3]
+        Image in [0, 1] range, or normalized if `normalize_image` is set
+    """
+    im = _decode(im_bytes, im_size)
+
+    # Resizing the uint8 image returns float32 values in the [0, 255]
+    # range. Scaling and normalizing are then done on the small image
+    im = tf.image.resize(im, im_size)
+    return cast_image(im, dtype, normalize_image=normalize_image)
 
 
 def load_image(im_path: str,
                im_size: Tuple[int, int],
-               normalize_image: bool = False) -> tf.Tensor:
-                
+               normalize_image: bool = False,
+               dtype: tf.DType = tf.float32) -> tf.Tensor:
+
     # Reads the image and resizes it
     im = tf.io.read_file(im_path)
-    im = tf.image.decode_jpeg(im, channels=3)
-    im = tf.image.convert_image_dtype(im, tf.float32)
-    if normalize_image:
-        im = preprocess.normalize_image(im)
-        
-    return tf.image.resize(im, im_size)
\ No newline at end of file
+    return decode_image(im, im_size, 
+                        normalize_image=normalize_image, 
+                        dtype=dtype)
+
+
+def decode_letterboxed_image(
+        im_bytes: tf.Tensor,
+        shapes: Sequence[Tuple[int, int]],
+        normalize_image: bool = False,
+        dtype: tf.DType = tf.float32,
+        im_shape: tf.Tensor = None) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Decodes an encoded image and letterboxes it within the bucket with the
+    closest aspect ratio. Refer to efficientdet.data.buckets
+
+    Parameters
+    ----------
+    im_bytes: tf.Tensor of type tf.string
+        Encoded image
+    shapes: Sequence[Tuple[int, int]]
+        Height and width of the buckets
+    normalize_image: bool, default False
+        Normalize the image according imagenet mean and std
+    dtype: tf.DType, default tf.float32
+    im_shape: tf.Tensor, default None
+        Height and width the bucket is chosen from, for example the size
+        recorded in the annotations, so the bucket is the one counted by
+        efficientdet.data.buckets.count_batches. By default it is the 
+        size of the encoded image
+
+    Returns
+    -------
+    Tuple[tf.Tensor, tf.Tensor]
+        The image with the shape of its bucket, padded at the bottom and
+        right sides, and the height and width of the resized image within
+        the bucket
+    """
+    # The size of JPEG images is read from their header. Other formats
+    # are decoded twice
+    if im_shape is None:
+        im_shape = tf.cond(tf.io.is_jpeg(im_bytes),
+                           lambda: tf.image.extract_jpeg_shape(im_bytes)[:2],
+                           lambda: tf.shape(_decode_any(im_bytes))[:2])
+
+    idx = buckets.bucket_index(im_shape, shapes)
+    bucket_shape = tf.gather(tf.constant(shapes, dtype=tf.int32), idx)
+    size = buckets.letterbox_size(im_shape, bucket_shape)
+
+    im = tf.image.resize(_decode(im_bytes, size), size)
+    im = tf.image.pad_to_bounding_box(im, 0, 0, 
+                                      bucket_shape[0], bucket_shape[1])
+    return cast_image(im, dtype, normalize_image=normalize_image), size
+
+
+def load_letterboxed_image(
+        im_path: str,
+        shapes: Sequence[Tuple[int, int]],
+        normalize_image: bool = False,
+        dtype: tf.DType = tf.float32,
+        im_shape: tf.Tensor = None) -> Tuple[tf.Tensor, tf.Tensor]:
+
+    # Reads the image and letterboxes it
+    im = tf.io.read_file(im_path)
+    return decode_letterboxed_image(im, shapes, 
+                                    normalize_image=normalize_image, 
+                                    dtype=dtype,
+                                    im_shape=im_shape)
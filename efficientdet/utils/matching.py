@@ -0,0 +1,283 @@
+"""
+Memory bounded strategies to match anchors with ground truth boxes.
+
+A matcher is a callable that receives the anchors of shape [N, 4] and the
+ground truth boxes of shape [BATCH, MAX_NUM_INSTANCES, 4] (padded with
+negative values) and returns a tuple containing:
+    - max_overlaps: tf.Tensor of shape [BATCH, N] with the largest IoU of
+      each anchor. Anchors of images without ground truth boxes have
+      an overlap of -1
+    - argmax_overlaps: tf.Tensor of shape [BATCH, N] containing the index
+      of the ground truth box with the largest overlap
+
+All matchers produce the same results as the dense matching performed by
+efficientdet.utils.anchors.compute_gt_annotations, but without
+materializing the [BATCH, N, MAX_NUM_INSTANCES] IoU tensor.
+"""
+
+import abc
+from typing import Sequence, Tuple, Union
+
+import tensorflow as tf
+
+import efficientdet.config as config
+from . import anchors as anchors_utils
+from . import bndbox
+
+
+# Approximate number of [BATCH, N, MAX_NUM_INSTANCES] float32 intermediates
+# alive at the same time when computing bndbox.bbox_overlap
+_IOU_INTERMEDIATES = 10
+
+
+class IoUMatcher(abc.ABC):
+    """
+    Base class of the strategies to match anchors with ground truth boxes
+    """
+    @abc.abstractmethod
+    def __call__(self,
+                 anchors: tf.Tensor,
+                 annotations: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Returns the (max_overlaps, argmax_overlaps) of each anchor, as
+        described in the module docstring
+        """
+
+
+class ChunkedIoUMatcher(IoUMatcher):
+    """
+    Computes the overlaps in fixed-size chunks of anchors, so the working
+    set is bounded by the memory budget instead of growing with the number
+    of anchors.
+
+    Parameters
+    ----------
+    memory_budget: int, default 64MB
+        Peak memory in bytes used to compute the IoU of a chunk. The chunk
+        size is derived from this budget, the batch size and the
+        number of ground truth boxes
+    """
+    def __init__(self, memory_budget: int = 64 * 2 ** 20):
+        self.memory_budget = memory_budget
+
+    def chunk_size(self, annotations: tf.Tensor) -> tf.Tensor:
+        shape = tf.shape(annotations)
+        bytes_per_anchor = shape[0] * shape[1] * 4 * _IOU_INTERMEDIATES
+        return tf.maximum(1, self.memory_budget // bytes_per_anchor)
+
+    def __call__(self,
+                 anchors: tf.Tensor,
+                 annotations: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        batch_size = tf.shape(annotations)[0]
+        n_anchors = tf.shape(anchors)[0]
+        chunk_size = tf.minimum(self.chunk_size(annotations), n_anchors)
+
+        # Pad the anchors so they can be split in chunks of equal size
+        n_chunks = (n_anchors + chunk_size - 1) // chunk_size
+        padding = n_chunks * chunk_size - n_anchors
+        chunks = tf.pad(anchors, [[0, padding], [0, 0]])
+        chunks = tf.reshape(chunks, [n_chunks, chunk_size, 4])
+
+        def match_chunk(chunk):
+            overlaps = bndbox.bbox_overlap(tf.expand_dims(chunk, 0),
+                                           annotations)
+            return anchors_utils._reduce_overlaps(overlaps, annotations)
+
+        # Chunks are processed sequentially to keep a single chunk alive
+        max_overlaps, argmax_overlaps = tf.map_fn(
+            match_chunk, chunks,
+            fn_output_signature=(tf.float32, tf.int32),
+            parallel_iterations=1)
+
+        # [N_CHUNKS, BATCH, CHUNK_SIZE] -> [BATCH, N]
+        def unchunk(t):
+            t = tf.reshape(tf.transpose(t, [1, 0, 2]), [batch_size, -1])
+            return t[:, :n_anchors]
+
+        return unchunk(max_overlaps), unchunk(argmax_overlaps)
+
+
+class GridIoUMatcher(IoUMatcher):
+    """
+    Uses the regular layout of the anchors over the pyramid levels as a
+    spatial grid index. For each ground truth box, only the IoU of the
+    anchors whose boxes can overlap with it are computed.
+
+    The anchors must be the ones generated by
+    efficientdet.utils.anchors.generate_anchors with the same parameters.
+
+    Parameters
+    ----------
+    anchors_config: config.AnchorsConfig
+        Anchors sizes, strides and aspect ratios
+    im_size: Union[int, Tuple[int, int]]
+        Input image size. If it is an int the image is assumed to be squared
+    levels: Sequence[int], default (3, 4, 5, 6, 7)
+        Pyramid levels where the anchors are tiled
+    """
+    def __init__(self,
+                 anchors_config: config.AnchorsConfig,
+                 im_size: Union[int, Tuple[int, int]],
+                 levels: Sequence[int] = anchors_utils.PYRAMID_LEVELS):
+        if isinstance(im_size, int):
+            im_size = (im_size, im_size)
+        h, w = im_size
+
+        # For each level store the offset of its first anchor, the grid
+        # dimensions, the stride and the extent of the anchors with
+        # respect to their centre
+        self.levels = []
+        offset = 0
+        level_sizes = anchors_utils.anchors_per_level(
+            anchors_config, im_size, levels)
+
+        for level, size in zip(levels, level_sizes):
+            stride = anchors_config.strides[level - 3]
+            gen = anchors_utils.AnchorGenerator(
+                size=anchors_config.sizes[level - 3],
+                aspect_ratios=anchors_config.ratios,
+                stride=stride)
+            base_anchors = gen.anchors.numpy()
+            self.levels.append(dict(
+                offset=offset,
+                h=anchors_utils._feature_map_size(h, stride),
+                w=anchors_utils._feature_map_size(w, stride),
+                stride=float(stride),
+                n_anchors=len(gen),
+                min_x1=float(base_anchors[:, 0].min()),
+                min_y1=float(base_anchors[:, 1].min()),
+                max_x2=float(base_anchors[:, 2].max()),
+                max_y2=float(base_anchors[:, 3].max())))
+            offset += size
+
+    def _cell_range(self, low: tf.Tensor, high: tf.Tensor,
+                    stride: float, limit: int) -> tf.Tensor:
+        # Cells whose centre (i + .5) * stride lies within (low, high).
+        # The range is widened by one cell to be robust to rounding errors
+        start = tf.cast(tf.math.floor(low / stride - .5), tf.int32) - 1
+        end = tf.cast(tf.math.ceil(high / stride - .5), tf.int32) + 1
+        start = tf.clip_by_value(start, 0, limit)
+        end = tf.clip_by_value(end + 1, start, limit)
+        return tf.range(start, end)
+
+    def candidates(self, box: tf.Tensor) -> tf.Tensor:
+        """
+        Indices of the anchors that may overlap with the given box
+
+        Parameters
+        ----------
+        box: tf.Tensor of shape [4]
+            Box in [xmin, ymin, xmax, ymax] format
+
+        Returns
+        -------
+        tf.Tensor of shape [N_CANDIDATES]
+        """
+        x1, y1, x2, y2 = tf.unstack(box)
+        indices = []
+        for level in self.levels:
+            stride = level['stride']
+            cols = self._cell_range(x1 - level['max_x2'],
+                                    x2 - level['min_x1'],
+                                    stride, level['w'])
+            rows = self._cell_range(y1 - level['max_y2'],
+                                    y2 - level['min_y1'],
+                                    stride, level['h'])
+            cells = (tf.reshape(rows, [-1, 1]) * level['w'] +
+                     tf.reshape(cols, [1, -1]))
+            level_indices = (tf.reshape(cells, [-1, 1]) * level['n_anchors']
+                             + tf.range(level['n_anchors']))
+            indices.append(level['offset'] + tf.reshape(level_indices, [-1]))
+
+        return tf.concat(indices, axis=0)
+
+    def _match_single(self,
+                      anchors: tf.Tensor,
+                      annotations: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        n_anchors = tf.shape(anchors)[0]
+        n_annots = tf.shape(annotations)[0]
+        is_valid = tf.greater_equal(tf.reduce_max(annotations, axis=-1), 0.)
+
+        # When there are valid boxes, non overlapping anchors have an IoU
+        # of 0 with the first valid box, which is not necessarily the
+        # first one. Otherwise all IoUs are -1 (padding)
+        initial_overlap = tf.where(tf.reduce_any(is_valid), 0., -1.)
+        first_valid = tf.argmax(tf.cast(is_valid, tf.int32), 
+                                output_type=tf.int32)
+        max_overlaps = tf.fill([n_anchors], initial_overlap)
+        argmax_overlaps = tf.fill([n_anchors], first_valid)
+
+        def match_box(i, max_overlaps, argmax_overlaps):
+            box = annotations[i]
+            indices = self.candidates(box)
+            overlaps = bndbox.bbox_overlap(
+                tf.reshape(tf.gather(anchors, indices), [1, -1, 4]),
+                tf.reshape(box, [1, 1, 4]))
+            overlaps = tf.reshape(overlaps, [-1])
+
+            # Strictly greater, so on ties the first box is kept
+            # like argmax does
+            better = tf.greater(overlaps, tf.gather(max_overlaps, indices))
+            indices = tf.expand_dims(tf.boolean_mask(indices, better), -1)
+            overlaps = tf.boolean_mask(overlaps, better)
+
+            max_overlaps = tf.tensor_scatter_nd_update(
+                max_overlaps, indices, overlaps)
+            argmax_overlaps = tf.tensor_scatter_nd_update(
+                argmax_overlaps, indices,
+                tf.fill(tf.shape(overlaps), i))
+            return max_overlaps, argmax_overlaps
+
+        def body(i, max_overlaps, argmax_overlaps):
+            max_overlaps, argmax_overlaps = tf.cond(
+                is_valid[i],
+                lambda: match_box(i, max_overlaps, argmax_overlaps),
+                lambda: (max_overlaps, argmax_overlaps))
+            return i + 1, max_overlaps, argmax_overlaps
+
+        _, max_overlaps, argmax_overlaps = tf.while_loop(
+            lambda i, *args: i < n_annots, body,
+            loop_vars=[tf.constant(0), max_overlaps, argmax_overlaps])
+
+        return max_overlaps, argmax_overlaps
+
+    def __call__(self,
+                 anchors: tf.Tensor,
+                 annotations: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        return tf.map_fn(lambda a: self._match_single(anchors, a),
+                         annotations,
+                         fn_output_signature=(tf.float32, tf.int32))
+
+
+def build_matcher(method: str = 'dense',
+                  memory_budget: int = 64 * 2 ** 20,
+                  anchors_config: config.AnchorsConfig = None,
+                  im_size: Union[int, Tuple[int, int]] = None) -> IoUMatcher:
+    """
+    Creates an IoU matcher
+
+    Parameters
+    ----------
+    method: str, choice of [dense, chunked, grid], default dense
+        - dense: Returns None, so the overlaps are computed densely
+        - chunked: ChunkedIoUMatcher bounded by `memory_budget`
+        - grid: GridIoUMatcher. Requires `anchors_config` and `im_size`
+    memory_budget: int, default 64MB
+        Peak memory in bytes used by the chunked matcher
+    anchors_config: config.AnchorsConfig, default None
+    im_size: Union[int, Tuple[int, int]], default None
+
+    Returns
+    -------
+    IoUMatcher
+    """
+    if method == 'dense':
+        return None
+    elif method == 'chunked':
+        return ChunkedIoUMatcher(memory_budget)
+    elif method == 'grid':
+        assert anchors_config is not None and im_size is not None, \
+            'Grid matching requires the anchors config and the image size'
+        return GridIoUMatcher(anchors_config, im_size)
+
+    raise ValueError(f'Unexpected matching method {method}')
@@ -46,6 +46,108 @@ class AnchorsTest(unittest.TestCase):
         plt.imshow(im_random)
         plt.show(block=True)
 
+    def test_anchors_cache(self):
+        cache = utils.anchors.AnchorsCache(max_size=2)
+        
+        anchors = cache.get((512, 512), anchors_config)
+        self.assertIs(anchors, cache.get((512, 512), anchors_config))
+        self.assertEqual(cache.hits, 1)
+
+        expected = self.generate_anchors(anchors_config, 512)
+        self.assertTrue(np.allclose(anchors.numpy(), expected.numpy()))
+
+        cache.get((640, 640), anchors_config)
+        cache.get((768, 768), anchors_config)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(anchors, cache.get((512, 512), anchors_config))
+
+    def test_matchers(self):
+        anchors = utils.anchors.generate_anchors(anchors_config, 512)
+
+        xy = tf.random.uniform([2, 5, 2], 0, 400)
+        wh = tf.random.uniform([2, 5, 2], 4, 256)
+        boxes = tf.concat([xy, xy + wh], axis=-1)
+        # Second image only has 2 boxes, the other ones are padding
+        boxes = tf.concat([boxes[:1], 
+                           tf.concat([boxes[1:, :2], 
+                                      -tf.ones([1, 3, 4])], axis=1)], axis=0)
+        
+        expected = utils.anchors.compute_gt_annotations(anchors, boxes)
+        matchers = [utils.matching.ChunkedIoUMatcher(memory_budget=2 ** 20),
+                    utils.matching.GridIoUMatcher(anchors_config, 512)]
+
+        for matcher in matchers:
+            result = utils.anchors.compute_gt_annotations(
+                anchors, boxes, matcher=matcher)
+            for r, e in zip(result, expected):
+                self.assertTrue(np.all(r.numpy() == e.numpy()))
+
+    def test_compact_targets(self):
+        anchors = utils.anchors.generate_anchors(anchors_config, 512)
+        images = tf.zeros([2, 512, 512, 3])
+        boxes = tf.constant([[[10., 10., 200., 200.], [300., 50., 400., 90.]],
+                             [[0., 0., 510., 510.], [-1., -1., -1., -1.]]])
+        labels = tf.constant([[3, 1], [0, -1]])
+        
+        expected = utils.anchors.compute_anchor_targets(
+            anchors, images, boxes, labels, 20)
+        regression, classes = utils.anchors.compute_anchor_targets(
+            anchors, images, boxes, labels, 20, compact=True)
+        
+        self.assertEqual(classes[0].dtype, tf.int16)
+        self.assertEqual(classes[1].dtype, tf.int8)
+        
+        result = utils.anchors.expand_compact_targets(regression, classes, 20)
+        for r, e in zip(result, expected):
+            self.assertTrue(np.allclose(r.numpy(), e.numpy()))
+
+    def test_ragged_targets(self):
+        anchors = utils.anchors.generate_anchors(anchors_config, 512)
+        images = tf.zeros([3, 512, 512, 3])
+        boxes = tf.ragged.constant([[[10., 10., 200., 200.], 
+                                     [300., 50., 400., 90.]],
+                                    [[0., 0., 510., 510.]],
+                                    []], ragged_rank=1, inner_shape=(4,))
+        labels = tf.ragged.constant([[3, 1], [0], []])
+        
+        expected = utils.anchors.anchor_targets_bbox(
+            anchors, images, boxes.to_tensor(-1.), labels.to_tensor(-1), 20)
+        result = utils.anchors.ragged_anchor_targets_bbox(
+            anchors, images, boxes, labels, 20)
+
+        for r, e in zip(result, expected):
+            self.assertTrue(np.allclose(r.numpy(), e.numpy()))
+
+    def test_padding_mid_row(self):
+        anchors = utils.anchors.generate_anchors(anchors_config, 512)
+        images = tf.zeros([2, 512, 512, 3])
+        padding = [-1., -1., -1., -1.]
+        # Padding before, between and after the valid boxes
+        boxes = tf.constant([[padding, [10., 10., 200., 200.], 
+                              padding, [300., 50., 400., 90.]],
+                             [padding, padding, padding, padding]])
+        labels = tf.constant([[-1, 3, -1, 1], [-1, -1, -1, -1]])
+        
+        expected = utils.anchors.compute_anchor_targets(
+            anchors, images, 
+            tf.gather(boxes, [1, 3, 0, 2], axis=1),
+            tf.gather(labels, [1, 3, 0, 2], axis=1), 20)
+
+        matchers = [None,
+                    utils.matching.ChunkedIoUMatcher(memory_budget=2 ** 20),
+                    utils.matching.GridIoUMatcher(anchors_config, 512)]
+
+        for matcher in matchers:
+            _, _, indices = utils.anchors.compute_gt_annotations(
+                anchors, boxes, matcher=matcher)
+            indices = tf.reshape(indices, [2, -1, 2])
+            self.assertTrue(np.all(np.isin(indices[0, :, 1], [1, 3])))
+
+            result = utils.anchors.compute_anchor_targets(
+                anchors, images, boxes, labels, 20, matcher=matcher)
+            for r, e in zip(result, expected):
+                self.assertTrue(np.allclose(r.numpy(), e.numpy()))
+
     def test_compute_gt(self):
         level = 3
         ds = voc.build_dataset('test/data/VOC2007',
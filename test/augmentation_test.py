@@ -1,6 +1,7 @@
 import unittest
 
 import matplotlib.pyplot as plt
+import numpy as np
 import tensorflow as tf
 
 from efficientdet import data
@@ -54,6 +55,68 @@ class AugmentationTest(unittest.TestCase):
     def test_crop(self):
         self.plot_single(aug_fn=data.preprocess.crop)
 
+    def test_augment_uint8(self):
+        ds = data.labelme.build_dataset('test/data/pokemon',
+                                        'test/data/pokemon',
+                                        self.class2idx,
+                                        im_input_size=(512, 512),
+                                        image_dtype=tf.uint8)
+        image, annots = next(iter(ds.take(1)))
+
+        for aug_fn in (data.preprocess.horizontal_flip, 
+                       data.preprocess.crop,
+                       data.preprocess.augment):
+            aug_image, _ = aug_fn(image, annots)
+            self.assertEqual(aug_image.dtype, tf.uint8)
+            self.assertEqual(aug_image.shape, image.shape)
+
+    def _padded_batch(self, image_dtype=tf.float32):
+        ds = data.labelme.build_dataset('test/data/pokemon',
+                                        'test/data/pokemon',
+                                        self.class2idx,
+                                        im_input_size=(256, 256),
+                                        shuffle=False,
+                                        image_dtype=image_dtype)
+        ds = ds.padded_batch(4, padding_values=(tf.constant(0, image_dtype),
+                                                (-1, -1.)))
+        return next(iter(ds))
+
+    def test_augment_batch_flip(self):
+        images, (labels, boxes) = self._padded_batch()
+        aug_images, (aug_labels, aug_boxes) = data.preprocess.augment_batch(
+            images, (labels, boxes), flip_prob=1., crop_prob=0.)
+
+        self.assertTrue(np.allclose(aug_images, 
+                                    tf.image.flip_left_right(images),
+                                    atol=1e-5))
+        self.assertTrue(np.array_equal(aug_labels, labels))
+
+        is_valid = labels.numpy() >= 0
+        x1, y1, x2, y2 = np.moveaxis(boxes.numpy(), -1, 0)
+        expected = np.stack([255 - x2, y1, 255 - x1, y2], axis=-1)
+        # Boxes are clipped to the image
+        expected = np.clip(expected, 0, 255)
+        self.assertTrue(np.allclose(aug_boxes.numpy()[is_valid], 
+                                    expected[is_valid], atol=1e-3))
+        self.assertTrue(np.all(aug_boxes.numpy()[~is_valid] == -1))
+
+    def test_augment_batch_crop(self):
+        images, (labels, boxes) = self._padded_batch(tf.uint8)
+        aug_images, (aug_labels, aug_boxes) = data.preprocess.augment_batch(
+            images, (labels, boxes), flip_prob=0., crop_prob=1.)
+
+        self.assertEqual(aug_images.dtype, tf.uint8)
+        self.assertEqual(aug_images.shape, images.shape)
+        self.assertEqual(aug_boxes.shape, boxes.shape)
+
+        # Removed boxes are padding
+        aug_boxes = aug_boxes.numpy()
+        is_valid = aug_labels.numpy() >= 0
+        self.assertTrue(np.all(aug_boxes[~is_valid] == -1))
+        self.assertTrue(np.all(aug_boxes[is_valid] >= 0))
+        self.assertTrue(np.all(aug_boxes[is_valid] <= 255))
+        self.assertTrue(np.all(labels.numpy()[is_valid] >= 0))
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
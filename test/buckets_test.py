@@ -0,0 +1,125 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet
+import efficientdet.utils.io as io_utils
+from efficientdet.data import buckets
+
+
+class BucketsTest(unittest.TestCase):
+
+    def test_bucket_shapes(self):
+        shapes = buckets.bucket_shapes(512)
+
+        self.assertIn((512, 512), shapes)
+        for h, w in shapes:
+            self.assertEqual(h % 128, 0)
+            self.assertEqual(w % 128, 0)
+            # Area close to the square input
+            self.assertLess(abs(h * w / 512 ** 2 - 1), .3)
+
+        self.assertEqual(int(buckets.bucket_index([90, 160], shapes)),
+                         shapes.index((384, 640)))
+        self.assertEqual(int(buckets.bucket_index([100, 100], shapes)),
+                         shapes.index((512, 512)))
+
+    def test_letterbox(self):
+        shapes = buckets.bucket_shapes(512)
+        im_bytes = tf.io.encode_png(tf.fill([100, 400, 3], 
+                                            tf.constant(255, tf.uint8)))
+
+        image, size = io_utils.decode_letterboxed_image(
+            im_bytes, shapes, dtype=tf.uint8)
+
+        self.assertEqual(image.shape, [256, 1024, 3])
+        self.assertEqual(size.numpy().tolist(), [256, 1024])
+
+        im_bytes = tf.io.encode_png(tf.fill([100, 300, 3],
+                                            tf.constant(255, tf.uint8)))
+        image, size = io_utils.decode_letterboxed_image(
+            im_bytes, shapes, dtype=tf.uint8)
+
+        # Resized keeping the aspect ratio and padded at the bottom
+        self.assertEqual(image.shape, [256, 1024, 3])
+        self.assertEqual(size.numpy().tolist(), [256, 768])
+        self.assertTrue(np.all(image[:, :768].numpy() == 255))
+        self.assertTrue(np.all(image[:, 768:].numpy() == 0))
+
+    def test_build_ds(self):
+        shapes = buckets.bucket_shapes(256)
+        anchors_config = efficientdet.config.AnchorsConfig()
+        anchors = {s: efficientdet.utils.anchors.generate_anchors(
+                        anchors_config, s)
+                   for s in shapes}
+
+        ds, _ = efficientdet.data.build_ds(
+            format='VOC',
+            annots_path='test/data/VOC2007',
+            images_path=None,
+            im_size=(256, 256),
+            batch_size=2,
+            data_augmentation=True,
+            buckets=shapes)
+
+        n_batches = 0
+        for images, (labels, boxes) in ds:
+            self.assertIn(tuple(images.shape[1:3]), shapes)
+            self.assertEqual(labels.shape[:2], boxes.shape[:2])
+            n_batches += 1
+        self.assertEqual(n_batches, int(ds.cardinality()))
+
+        # Anchors targets follow the bucket shape
+        ds, _ = efficientdet.data.build_ds(
+            format='VOC',
+            annots_path='test/data/VOC2007',
+            images_path=None,
+            im_size=(256, 256),
+            batch_size=2,
+            data_augmentation=False,
+            anchors=anchors,
+            buckets=shapes)
+
+        for images, (reg_targets, clf_targets) in ds:
+            shape = tuple(images.shape[1:3])
+            self.assertEqual(reg_targets.shape[1], anchors[shape].shape[0])
+
+    def test_bucket_from_recorded_size(self):
+        shapes = buckets.bucket_shapes(256)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ds_path = Path(tmp_dir) / 'VOC2007'
+            shutil.copytree('test/data/VOC2007', ds_path,
+                            ignore=shutil.ignore_patterns(
+                                'manifest.json', '.annotations_cache'))
+
+            # The annotation records a portrait size for a landscape image
+            annot = ds_path / 'Annotations' / '000003.xml'
+            annot.write_text(annot.read_text()
+                             .replace('<width>500</width>', 
+                                      '<width>353</width>')
+                             .replace('<height>375</height>', 
+                                      '<height>500</height>'))
+
+            ds, _ = efficientdet.data.build_ds(
+                format='VOC',
+                annots_path=ds_path,
+                images_path=None,
+                im_size=(256, 256),
+                batch_size=3,
+                data_augmentation=False,
+                buckets=shapes)
+
+            # The three images go to the bucket of the recorded sizes
+            batches = list(ds)
+            self.assertEqual(len(batches), int(ds.cardinality()))
+            self.assertEqual(batches[0][0].shape[0], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet.utils.io as io_utils
+from efficientdet.data import labelme
+from efficientdet.data.cache import ImageCache
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        image = np.zeros((10, 10, 3), dtype=np.uint8)
+        cache = ImageCache(max_bytes=2 * image.nbytes)
+
+        cache.put('a', image)
+        cache.put('b', image)
+        # Makes 'a' the most recently used, so 'b' is evicted
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', image)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.nbytes, 2 * image.nbytes)
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.stats['hit_rate'], 2 / 3)
+
+        # Larger than the budget, it is not cached
+        cache.put('d', np.zeros((20, 20, 3), dtype=np.uint8))
+        self.assertEqual(len(cache), 2)
+
+    def test_load_image(self):
+        cache = ImageCache(max_bytes=2 ** 20)
+        im_size = (64, 64)
+
+        im = cache.load_image(tf.constant('imgs/cat-dog.jpg'), im_size,
+                              dtype=tf.uint8)
+        expected = io_utils.load_image('imgs/cat-dog.jpg', im_size,
+                                       dtype=tf.uint8)
+        self.assertTrue(np.array_equal(im, expected))
+
+        cache.load_image(tf.constant('imgs/cat-dog.jpg'), im_size)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_same_pixels_on_hit(self):
+        cache = ImageCache(max_bytes=2 ** 20)
+        load = tf.function(lambda p: cache.load_image(p, (64, 64),
+                                                      normalize_image=True))
+
+        miss = load(tf.constant('imgs/cat-dog.jpg'))
+        hit = load(tf.constant('imgs/cat-dog.jpg'))
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertTrue(np.array_equal(miss, hit))
+
+    def test_build_dataset(self):
+        classes = ['treecko', 'psyduck', 'greninja', 'solgaleo', 'mewtwo']
+        class2idx = {c: i for i, c in enumerate(classes)}
+        cache = ImageCache(max_bytes=2 ** 30)
+
+        ds = labelme.build_dataset('test/data/pokemon',
+                                   'test/data/pokemon',
+                                   class2idx,
+                                   im_input_size=(128, 128),
+                                   data_augmentation=True,
+                                   image_cache=cache)
+        n_images = len(list(ds))
+        self.assertEqual(cache.stats['misses'], n_images)
+
+        for image, _ in ds:
+            self.assertEqual(image.shape, [128, 128, 3])
+            self.assertEqual(image.dtype, tf.float32)
+
+        self.assertEqual(cache.stats['hits'], n_images)
+
+
+if __name__ == "__main__":
+    unittest.main()
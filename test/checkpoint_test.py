@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+import tensorflow as tf
+
+import efficientdet
+from efficientdet.utils import checkpoint
+
+
+class _Blob(object):
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.downloads = 0
+
+    def download_to_filename(self, fname: str):
+        self.downloads += 1
+        Path(fname).write_bytes(self.data)
+
+
+class _Bucket(object):
+
+    def __init__(self, blobs: Sequence[_Blob]):
+        self.blobs = blobs
+
+    def list_blobs(self, prefix: str) -> Sequence[_Blob]:
+        return [b for b in self.blobs if b.name.startswith(prefix)]
+
+
+class AsyncCheckpointManagerTest(unittest.TestCase):
+
+    def _model(self) -> tf.keras.Model:
+        model = tf.keras.Sequential([tf.keras.layers.Dense(4)])
+        model(tf.zeros([1, 2]))
+        return model
+
+    def test_rotation(self):
+        model = self._model()
+
+        with tempfile.TemporaryDirectory() as save_dir, \
+                tempfile.TemporaryDirectory() as remote_dir:
+            store = checkpoint.LocalDirectoryStore(remote_dir)
+            manager = checkpoint.AsyncCheckpointManager(
+                save_dir, dict(n_classes=4), keep_last=2, keep_best=1,
+                store=store)
+
+            metrics = [.1, .5, .2, .3, None]
+            for i, metric in enumerate(metrics):
+                manager.save(model, f'epoch_{i}', metric=metric)
+            manager.close()
+
+            # The two last ones and the best one
+            expected = ['epoch_1', 'epoch_3', 'epoch_4']
+            self.assertEqual(store.list(), expected)
+            local = sorted(p.name for p in Path(save_dir).iterdir() 
+                           if p.is_dir())
+            self.assertEqual(local, expected)
+
+            # The rotation continues after a restart
+            with checkpoint.AsyncCheckpointManager(
+                    save_dir, dict(n_classes=4), keep_last=2, keep_best=1,
+                    store=store) as manager:
+                manager.save(model, 'epoch_5', metric=.6)
+            self.assertEqual(store.list(), ['epoch_4', 'epoch_5'])
+
+    def test_snapshot_is_taken_on_save(self):
+        model = self._model()
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            with checkpoint.AsyncCheckpointManager(save_dir, {}) as manager:
+                expected = [w.numpy() for w in model.weights]
+                manager.save(model, 'ckpt')
+                # Updating the weights while the checkpoint is written 
+                # does not change it
+                for w in model.weights:
+                    w.assign(w + 1.)
+
+            with np.load(str(Path(save_dir) / 'ckpt' / 
+                             checkpoint.WEIGHTS_FILE)) as f:
+                for i, w in enumerate(expected):
+                    np.testing.assert_array_equal(f[f'arr_{i}'], w)
+
+    def test_load(self):
+        hp = dict(n_classes=20, efficientdet=0, bidirectional=True)
+        model = efficientdet.models.EfficientDet(num_classes=20,
+                                                 D=0,
+                                                 weights=None)
+        input_size = model.config.input_size
+        images = tf.random.uniform([1, input_size, input_size, 3])
+        model(images, training=False)
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            with checkpoint.AsyncCheckpointManager(save_dir, hp) as manager:
+                manager.save(model, 'D0')
+
+            loaded, loaded_hp = checkpoint.load(Path(save_dir) / 'D0')
+
+        self.assertEqual(loaded_hp, hp)
+        for w, loaded_w in zip(model.weights, loaded.weights):
+            np.testing.assert_array_equal(w.numpy(), loaded_w.numpy())
+
+    def test_download(self):
+        hp = _Blob('models/D0/hp.json', b'{}')
+        weights = _Blob('models/D0/model.npz', b'weights')
+        other = _Blob('models/D0_other/model.tf.index', b'index')
+        bucket = _Bucket([hp, weights, other])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_dir = Path(cache_dir)
+            # Stale file of a previous version of the checkpoint
+            (cache_dir / 'model.tf.index').write_bytes(b'stale')
+
+            files = checkpoint._download(bucket, 'models/D0/', cache_dir)
+            self.assertEqual(sorted(f.name for f in files),
+                             ['hp.json', 'model.npz'])
+            self.assertEqual(sorted(f.name for f in cache_dir.iterdir()),
+                             ['hp.json', 'model.npz'])
+
+            # Unchanged files are not downloaded again
+            weights.data = b'new weights'
+            weights.md5_hash = _Blob('', weights.data).md5_hash
+            checkpoint._download(bucket, 'models/D0/', cache_dir)
+            self.assertEqual(hp.downloads, 1)
+            self.assertEqual(weights.downloads, 2)
+            self.assertEqual((cache_dir / 'model.npz').read_bytes(),
+                             b'new weights')
+
+
+if __name__ == "__main__":
+    unittest.main()
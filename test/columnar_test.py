@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+import efficientdet.utils.bndbox as bb_utils
+from efficientdet.data import columnar, labelme
+
+
+# Files generated next to the test datasets by other tests
+GENERATED_FILES = ('manifest.json', '.annotations_cache')
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ds_path = Path(self.tmp_dir) / 'pokemon'
+        shutil.copytree('test/data/pokemon', self.ds_path,
+                        ignore=shutil.ignore_patterns(*GENERATED_FILES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compile_annotations(self):
+        columns = columnar.load_annotations('labelme', self.ds_path)
+        self.assertTrue(
+            (columnar.columns_path(self.ds_path) / 'meta.json').exists())
+
+        # Once compiled, the columns are memory mapped
+        columns = columnar.load_annotations('labelme', self.ds_path)
+        self.assertIsInstance(columns.boxes, np.memmap)
+        self.assertEqual(len(columns), 4)
+
+        # Compiling again publishes a new directory and removes the old
+        # one, which stays readable while it is mapped
+        boxes = np.array(columns.boxes)
+        columnar.compile_annotations('labelme', self.ds_path)
+        dirs = list(columnar.columns_path(self.ds_path).glob('columns-*'))
+        self.assertEqual(len(dirs), 1)
+        self.assertTrue(np.array_equal(columns.boxes, boxes))
+
+        class2idx = {l: i for i, l in enumerate(columns.label_names)}
+        ds = columnar.build_annotations_dataset(
+            columns, self.ds_path, class2idx)
+
+        files = sorted(self.ds_path.glob('*.json'))
+        for f, (im_path, (labels, boxes)) in zip(files, ds):
+            record = labelme.read_annotation(f)
+            expected_boxes = bb_utils.normalize_bndboxes(
+                np.array(record['boxes'], dtype='float32'),
+                (record['height'], record['width']))
+
+            self.assertEqual(im_path.numpy().decode(),
+                             str(self.ds_path / record['image']))
+            self.assertEqual(labels.numpy().tolist(),
+                             [class2idx[l] for l in record['labels']])
+            self.assertTrue(np.allclose(boxes, expected_boxes))
+
+
+if __name__ == "__main__":
+    unittest.main()
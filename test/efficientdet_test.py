@@ -4,6 +4,7 @@ import tensorflow as tf
 
 import efficientdet.data.voc as voc
 import efficientdet.models as models
+from efficientdet.models.layers import ImageNormalization
 
 
 class EfficientDetTest(unittest.TestCase):
@@ -48,10 +49,44 @@ class EfficientDetTest(unittest.TestCase):
         images, annotations = next(iter(ds.take(1)))
         boxes, labels, scores = model(tf.expand_dims(images, 0), training=False)
         
-        # TODO: migrate to tensors when output is padded
-        for i in range(len(boxes)):
-            self._compare_shapes(boxes[i].shape, [None, 4])
-            self._compare_shapes(labels[i].shape, [None])
+        max_detections = model.max_detections
+        self._compare_shapes(boxes.shape, [1, max_detections, 4])
+        self._compare_shapes(labels.shape, [1, max_detections])
+        self._compare_shapes(scores.shape, [1, max_detections])
+
+    def test_unknown_input_size(self):
+        model = models.EfficientDet(num_classes=2, D=0, weights=None)
+        self.assertEqual(model.anchors_for((256, 384)).shape[0],
+                         sum(model.anchors_per_level((256, 384))))
+
+        # Anchors are never generated for a guessed input size
+        with self.assertRaises(ValueError):
+            model.anchors_for((None, 512))
+
+        predict = tf.function(
+            lambda images: model(images, training=False),
+            input_signature=[tf.TensorSpec([None, None, None, 3])])
+        with self.assertRaises(ValueError):
+            predict.get_concrete_function()
+
+    def test_uint8_inputs(self):
+        im_size = (128, 128)
+        ds = voc.build_dataset('test/data/VOC2007', im_input_size=im_size,
+                               shuffle=False)
+        uint8_ds = voc.build_dataset('test/data/VOC2007', 
+                                     im_input_size=im_size,
+                                     shuffle=False, 
+                                     image_dtype=tf.uint8)
+        
+        normalize = ImageNormalization()
+        for (image, _), (uint8_image, _) in zip(ds, uint8_ds):
+            self.assertEqual(uint8_image.dtype, tf.uint8)
+            # Float images are already normalized
+            self.assertIs(normalize(image), image)
+
+            # Up to the rounding error of the uint8 conversion
+            error = tf.abs(normalize(uint8_image) - image)
+            self.assertLess(float(tf.reduce_max(error)), .51 / 255. / .224)
 
         
 if __name__ == "__main__":
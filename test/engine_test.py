@@ -0,0 +1,185 @@
+import tempfile
+import unittest
+
+import tensorflow as tf
+
+import efficientdet
+import efficientdet.utils as utils
+from efficientdet import engine
+from efficientdet.train import loss_fn, progressive_schedule
+
+
+class TrainerTest(unittest.TestCase):
+
+    def test_trainer_does_not_retrace(self):
+        model = efficientdet.models.EfficientDet(num_classes=20,
+                                                 D=0,
+                                                 weights=None)
+        input_size = model.config.input_size
+        anchors = utils.anchors.generate_anchors(model.anchors_config,
+                                                 input_size)
+
+        ds, _ = efficientdet.data.build_ds(
+            format='VOC',
+            annots_path='test/data/VOC2007',
+            images_path=None,
+            im_size=(input_size,) * 2,
+            batch_size=2,
+            data_augmentation=False,
+            anchors=anchors,
+            compact_targets=True)
+        ds = ds.take(1)
+
+        trainer = engine.Trainer(model=model,
+                                 optimizer=tf.optimizers.SGD(1e-3),
+                                 loss_fn=loss_fn,
+                                 num_classes=20)
+
+        trainer.train_epoch(ds)
+        traces = trainer.trace_counts['train_step']
+        self.assertGreater(traces, 0)
+
+        losses = trainer.train_epoch(ds)
+        self.assertEqual(trainer.trace_counts['train_step'], traces)
+        self.assertEqual(trainer.epoch, 2)
+        self.assertTrue(tf.math.is_finite(losses['loss']))
+
+    def test_trainer_augments_batches(self):
+        model = efficientdet.models.EfficientDet(num_classes=20,
+                                                 D=0,
+                                                 weights=None)
+        input_size = model.config.input_size
+        anchors = utils.anchors.generate_anchors(model.anchors_config,
+                                                 input_size)
+
+        # The targets are computed after augmenting the padded batches
+        ds, _ = efficientdet.data.build_ds(
+            format='VOC',
+            annots_path='test/data/VOC2007',
+            images_path=None,
+            im_size=(input_size,) * 2,
+            batch_size=2,
+            data_augmentation=False,
+            image_dtype=tf.uint8)
+
+        trainer = engine.Trainer(
+            model=model,
+            optimizer=tf.optimizers.SGD(1e-3),
+            loss_fn=loss_fn,
+            num_classes=20,
+            anchors=anchors,
+            augment_fn=efficientdet.data.preprocess.augment_batch)
+
+        losses = trainer.train_epoch(ds.take(1))
+        self.assertTrue(tf.math.is_finite(losses['loss']))
+
+    def test_trainer_caches_traces_per_input_size(self):
+        model = efficientdet.models.EfficientDet(num_classes=20,
+                                                 D=0,
+                                                 weights=None)
+
+        def build_ds(input_size):
+            anchors = utils.anchors.generate_anchors(model.anchors_config,
+                                                     input_size)
+            ds, _ = efficientdet.data.build_ds(
+                format='VOC',
+                annots_path='test/data/VOC2007',
+                images_path=None,
+                im_size=(input_size,) * 2,
+                batch_size=2,
+                data_augmentation=False,
+                anchors=anchors,
+                compact_targets=True)
+            return ds.take(1)
+
+        small_ds = build_ds(256)
+        ds = build_ds(model.config.input_size)
+
+        trainer = engine.Trainer(model=model,
+                                 optimizer=tf.optimizers.SGD(1e-3),
+                                 loss_fn=loss_fn,
+                                 num_classes=20)
+
+        trainer.fit(small_ds, epochs=1)
+        trainer.fit(ds, epochs=1)
+        traces = trainer.trace_counts['train_step']
+
+        # Going back to a previous size reuses its trace
+        losses = trainer.train_epoch(small_ds)
+        self.assertEqual(trainer.trace_counts['train_step'], traces)
+        self.assertEqual(trainer.epoch, 3)
+        self.assertTrue(tf.math.is_finite(losses['loss']))
+
+    def test_trainer_resumes_mid_epoch(self):
+        input_size = 256
+        ds = None
+
+        def build_trainer(checkpoint_dir):
+            nonlocal ds
+            model = efficientdet.models.EfficientDet(num_classes=20,
+                                                     D=0,
+                                                     weights=None)
+            anchors = utils.anchors.generate_anchors(model.anchors_config,
+                                                     input_size)
+            ds, _ = efficientdet.data.build_ds(
+                format='VOC',
+                annots_path='test/data/VOC2007',
+                images_path=None,
+                im_size=(input_size,) * 2,
+                batch_size=1,
+                data_augmentation=False,
+                anchors=anchors,
+                compact_targets=True)
+            return engine.Trainer(model=model,
+                                  optimizer=tf.optimizers.SGD(1e-3, 
+                                                              momentum=.9),
+                                  loss_fn=loss_fn,
+                                  num_classes=20,
+                                  grad_accum_steps=2,
+                                  checkpoint_dir=checkpoint_dir,
+                                  checkpoint_every=1)
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            trainer = build_trainer(checkpoint_dir)
+            self.assertFalse(trainer.restore())
+
+            # Interrupted after the first step, with pending accumulated
+            # gradients
+            iterator = iter(ds)
+            trainer._train_steps(iterator)
+            trainer.save_state(iterator, step=1)
+            while int(trainer._train_steps(iterator)) > 0:
+                pass
+            trainer.accumulator.flush(trainer.model.trainable_variables)
+
+            resumed = build_trainer(checkpoint_dir)
+            self.assertTrue(resumed.restore())
+            self.assertEqual(resumed.epoch, 0)
+
+            # Only the remaining batches of the epoch are trained
+            resumed.train_epoch(ds)
+            self.assertEqual(resumed.epoch, 1)
+            self.assertEqual(int(resumed.optimizer.iterations),
+                             int(trainer.optimizer.iterations))
+            for w, resumed_w in zip(trainer.model.weights, 
+                                    resumed.model.weights):
+                self.assertTrue(tf.reduce_all(
+                    tf.abs(w - resumed_w) < 1e-5), w.name)
+
+    def test_progressive_schedule(self):
+        stages = progressive_schedule([256, 384], 512, epochs=10)
+        self.assertEqual(stages, [(256, 3), (384, 3), (512, 4)])
+
+        # The model input size is always the last stage
+        self.assertEqual(progressive_schedule([], 512, epochs=5), [(512, 5)])
+        self.assertEqual(progressive_schedule([256, 512], 512, epochs=4),
+                         [(256, 2), (512, 2)])
+
+        with self.assertRaises(AssertionError):
+            progressive_schedule([384, 256], 512, epochs=10)
+        with self.assertRaises(AssertionError):
+            progressive_schedule([300], 512, epochs=10)
+
+
+if __name__ == "__main__":
+    unittest.main()
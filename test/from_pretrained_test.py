@@ -24,11 +24,14 @@ class PretrainedTest(unittest.TestCase):
         classes = voc.IDX_2_LABEL
 
         boxes, labels, scores = model(n_image, training=False)
-        labels = [classes[l] for l in labels[0]]
+        valid_mask = labels[0] != -1
+        boxes = tf.boolean_mask(boxes[0], valid_mask)
+        scores = tf.boolean_mask(scores[0], valid_mask)
+        labels = [classes[l] for l in tf.boolean_mask(labels[0], valid_mask)]
 
         colors = visualizer.colors_per_labels(labels)
         im = visualizer.draw_boxes(
-            image, boxes[0], labels, scores[0], colors=colors)
+            image, boxes, labels, scores, colors=colors)
          
         plt.imshow(im)
         plt.axis('off')
@@ -0,0 +1,71 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from efficientdet.data import index, labelme, manifest
+
+
+# Files generated next to the test datasets by other tests
+GENERATED_FILES = ('manifest.json', '.annotations_cache')
+
+
+class AnnotationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ds_path = Path(self.tmp_dir) / 'pokemon'
+        shutil.copytree('test/data/pokemon', self.ds_path,
+                        ignore=shutil.ignore_patterns(*GENERATED_FILES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _update(self, **kwargs):
+        annots_index = index.AnnotationIndex(index.index_path(self.ds_path))
+        files = manifest.annotation_files('labelme', self.ds_path)
+        records = annots_index.update(files, labelme.read_annotation, 
+                                      **kwargs)
+        return records, annots_index.stats
+
+    def test_incremental_update(self):
+        files = manifest.annotation_files('labelme', self.ds_path)
+
+        # Cold start parses every file, using a pool of processes
+        with mock.patch.object(index, '_MIN_FILES_PER_POOL', 0):
+            records, stats = self._update(processes=2)
+        self.assertEqual(stats['parsed'], len(files))
+        self.assertEqual(records, [labelme.read_annotation(f) 
+                                   for f in files])
+
+        records, stats = self._update()
+        self.assertEqual(stats['parsed'], 0)
+
+        # Touching a file without changing its content does not parse it
+        os.utime(files[0])
+        records, stats = self._update()
+        self.assertEqual(stats['parsed'], 0)
+
+        # Modified files are parsed again
+        with files[1].open() as f:
+            annot = json.load(f)
+        annot['shapes'] = annot['shapes'][:1]
+        with files[1].open('w') as f:
+            json.dump(annot, f)
+
+        records, stats = self._update()
+        self.assertEqual(stats['parsed'], 1)
+        self.assertEqual(len(records[1]['boxes']), 1)
+
+        # Deleted files are dropped
+        files[2].unlink()
+        records, stats = self._update()
+        self.assertEqual(stats['removed'], 1)
+        self.assertEqual(len(records), len(files) - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import tensorflow as tf
+
+import efficientdet.utils.io as io_utils
+
+
+class IOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.im_bytes = tf.io.read_file('imgs/cat-dog.jpg')
+        self.image = tf.image.decode_jpeg(self.im_bytes, channels=3)
+
+    def _reference(self, im_size):
+        # Full resolution decoding
+        im = tf.image.convert_image_dtype(self.image, tf.float32)
+        return tf.image.resize(im, im_size, antialias=True)
+
+    def test_decode_full_resolution(self):
+        # The image is smaller than twice the target size, so it is
+        # decoded at full resolution
+        im = io_utils.decode_image(self.im_bytes, (512, 512))
+        expected = tf.image.resize(
+            tf.image.convert_image_dtype(self.image, tf.float32), (512, 512))
+
+        self.assertEqual(im.shape, [512, 512, 3])
+        self.assertLess(float(tf.reduce_max(tf.abs(im - expected))), 1e-5)
+
+    def test_decode_reduced_resolution(self):
+        im = io_utils.decode_image(self.im_bytes, (128, 128))
+
+        self.assertEqual(im.shape, [128, 128, 3])
+        mean_error = tf.reduce_mean(tf.abs(im - self._reference((128, 128))))
+        self.assertLess(float(mean_error), 0.02)
+
+    def test_decode_png(self):
+        png_bytes = tf.io.encode_png(self.image)
+        im = io_utils.decode_image(png_bytes, (512, 512),
+                                   normalize_image=True)
+        expected = io_utils.decode_image(self.im_bytes, (512, 512),
+                                         normalize_image=True)
+        self.assertLess(float(tf.reduce_max(tf.abs(im - expected))), 1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,7 @@ import unittest
 import tensorflow as tf
 
 from efficientdet import losses
+from efficientdet.train import loss_fn
 
 
 class FocalLossTest(unittest.TestCase):
@@ -17,6 +18,52 @@ class FocalLossTest(unittest.TestCase):
 
         print(loss)
     
+    def test_sparse_focal_loss(self):
+        y_clf_true = tf.random.uniform(shape=(32,), minval=-1, maxval=4, 
+                                       dtype=tf.int32)
+        y_clf_pred = tf.random.uniform(shape=(32, 4))
+
+        sparse_loss = losses.focal_loss(tf.cast(y_clf_true, tf.int16), 
+                                        y_clf_pred)
+        loss = losses.focal_loss(tf.one_hot(y_clf_true, 4), y_clf_pred)
+
+        self.assertAlmostEqual(float(sparse_loss), float(loss), places=3)
+
+    def test_sigmoid_focal_loss(self):
+        y_clf_true = tf.random.uniform(shape=(32,), minval=-1, maxval=4, 
+                                       dtype=tf.int32)
+        logits = tf.random.normal(shape=(32, 4))
+        weights = tf.random.uniform(shape=(32,), maxval=2, dtype=tf.int32)
+
+        loss = losses.sigmoid_focal_loss(y_clf_true, logits, weights=weights)
+
+        # Same loss as gathering the non masked elements
+        mask = tf.cast(weights, tf.bool)
+        expected = losses.focal_loss(tf.boolean_mask(y_clf_true, mask),
+                                     tf.boolean_mask(logits, mask),
+                                     from_logits=True)
+
+        self.assertAlmostEqual(float(loss), float(expected), places=3)
+
+    def test_jit_compiled_loss(self):
+        labels = tf.random.uniform(shape=(2, 100), minval=-1, maxval=4, 
+                                   dtype=tf.int32)
+        states = tf.random.uniform(shape=(2, 100), minval=-1, maxval=2, 
+                                   dtype=tf.int32)
+        logits = tf.random.normal(shape=(2, 100, 4))
+        y_reg_true = tf.random.uniform(shape=(2, 100, 4))
+        y_reg_pred = tf.random.uniform(shape=(2, 100, 4))
+
+        y_clf_true = (tf.cast(labels, tf.int16), tf.cast(states, tf.int8))
+        compiled_loss_fn = tf.function(loss_fn, jit_compile=True)
+
+        expected = loss_fn(y_clf_true, logits, y_reg_true, y_reg_pred)
+        compiled = compiled_loss_fn(y_clf_true, logits, 
+                                    y_reg_true, y_reg_pred)
+
+        for l1, l2 in zip(expected, compiled):
+            self.assertAlmostEqual(float(l1), float(l2), places=3)
+
     def test_huber_loss(self):
         y_reg_true = tf.random.uniform(shape=(32, 10, 4))
         y_reg_pred = tf.random.uniform(shape=(32, 10, 4))
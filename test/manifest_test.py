@@ -0,0 +1,74 @@
+import os
+import math
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import tensorflow as tf
+
+import efficientdet
+from efficientdet.data import manifest
+
+
+# Files generated next to the test datasets by other tests
+GENERATED_FILES = ('manifest.json', '.annotations_cache')
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.voc_path = Path(self.tmp_dir) / 'VOC2007'
+        shutil.copytree('test/data/VOC2007', self.voc_path,
+                        ignore=shutil.ignore_patterns(*GENERATED_FILES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_manifest(self):
+        ds_manifest = manifest.load_manifest('VOC', self.voc_path)
+
+        self.assertTrue(manifest.manifest_path(self.voc_path).exists())
+        self.assertEqual(ds_manifest['num_examples'], 3)
+        self.assertEqual(
+            sum(ds_manifest['class_histogram'].values()),
+            sum(e['n_boxes'] for e in ds_manifest['examples']))
+
+        # Removing an annotation invalidates the manifest
+        (self.voc_path / 'Annotations' / '000003.xml').unlink()
+        ds_manifest = manifest.load_manifest('VOC', self.voc_path)
+        self.assertEqual(ds_manifest['num_examples'], 2)
+
+    def test_replaced_with_older_file(self):
+        manifest.load_manifest('VOC', self.voc_path)
+
+        # Replace an annotation by another one with an older mtime
+        annots = self.voc_path / 'Annotations'
+        old = annots / '000001.xml'
+        shutil.copy(annots / '000002.xml', old)
+        os.utime(old, (0, 0))
+
+        ds_manifest = manifest.load_manifest('VOC', self.voc_path)
+        expected = manifest.build_manifest('VOC', self.voc_path)
+        self.assertEqual(ds_manifest['examples'], expected['examples'])
+        self.assertEqual(ds_manifest['examples'][0]['image'],
+                         ds_manifest['examples'][1]['image'])
+
+    def test_cardinality(self):
+        batch_size = 2
+        ds, _ = efficientdet.data.build_ds(
+            format='VOC',
+            annots_path=self.voc_path,
+            images_path=None,
+            im_size=(128, 128),
+            batch_size=batch_size,
+            data_augmentation=False)
+
+        steps = int(ds.cardinality())
+        self.assertEqual(steps, math.ceil(3 / batch_size))
+        self.assertEqual(steps, sum(1 for _ in ds))
+
+
+if __name__ == "__main__":
+    unittest.main()
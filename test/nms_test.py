@@ -1,5 +1,6 @@
 import unittest 
 
+import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
@@ -64,6 +65,41 @@ class NMSTest(unittest.TestCase):
         plt.axis('off')
         plt.show(block=True)
 
+    def test_batched_nms(self):
+        boxes = tf.constant([[[0., 0., 10., 10.],
+                              [1., 1., 10., 10.],
+                              [50., 50., 60., 60.]]] * 2)
+        class_scores = tf.constant([[[.9, 0.], [.8, 0.], [0., .7]],
+                                    [[.1, 0.], [.2, 0.], [0., .3]]])
+
+        boxes, labels, scores, num_valid = bb_utils.batched_nms(
+            boxes, class_scores, score_threshold=.5, max_detections=4)
+
+        self.assertEqual(boxes.shape, [2, 4, 4])
+        self.assertEqual(num_valid.numpy().tolist(), [2, 0])
+        self.assertEqual(labels.numpy().tolist(), [[0, 1, -1, -1], 
+                                                   [-1, -1, -1, -1]])
+        self.assertEqual(boxes[0, 1].numpy().tolist(), [50., 50., 60., 60.])
+
+    def test_top_k_per_level(self):
+        anchors = tf.random.uniform([7, 4])
+        regressors = tf.random.uniform([2, 7, 4])
+        class_scores = tf.constant([[[.1], [.9], [.5], [.4], [.3], [.2], [.8]],
+                                    [[.9], [.1], [.5], [.4], [.3], [.2], [.1]]])
+
+        scores, regressors_k, anchors_k = bb_utils.top_k_per_level(
+            class_scores, regressors, anchors, level_sizes=[3, 4], k=2)
+
+        self.assertEqual(scores.shape, [2, 4, 1])
+        self.assertEqual(anchors_k.shape, [2, 4, 4])
+        self.assertTrue(np.allclose(sorted(scores[0, :, 0].numpy()), 
+                                    [.4, .5, .8, .9]))
+
+        # Anchors must be gathered along with its scores
+        for i in range(4):
+            idx = tf.where(class_scores[0, :, 0] == scores[0, i, 0])[0, 0]
+            self.assertTrue(np.allclose(anchors_k[0, i], anchors[idx]))
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,62 @@
+import unittest
+
+import tensorflow as tf
+
+from efficientdet import optim
+from efficientdet.engine import get_lr
+
+
+class GradientAccumulatorTest(unittest.TestCase):
+
+    def _train(self, accumulator, variables, gradients):
+        @tf.function
+        def step(grads):
+            accumulator(grads, variables)
+
+        for g in gradients:
+            step([g])
+        accumulator.flush(variables)
+
+    def test_accumulate(self):
+        gradients = [tf.constant([1., 2.]), tf.constant([3., 4.]),
+                     tf.constant([5., 6.])]
+
+        # Sum of the first two steps and then the remaining one
+        var = tf.Variable([0., 0.])
+        accumulator = optim.GradientAccumulator(
+            tf.optimizers.SGD(1.), accum_steps=2)
+        self._train(accumulator, [var], gradients)
+        self.assertTrue(tf.reduce_all(tf.equal(var, [-9., -12.])))
+        self.assertEqual(int(accumulator.step), 0)
+
+        # Mean of the accumulated steps
+        var = tf.Variable([0., 0.])
+        accumulator = optim.GradientAccumulator(
+            tf.optimizers.SGD(1.), accum_steps=2, average=True)
+        self._train(accumulator, [var], gradients)
+        self.assertTrue(tf.reduce_all(tf.equal(var, [-7., -9.])))
+
+    def test_scheduler_in_graph(self):
+        scheduler = optim.WarmupCosineDecayLRScheduler(
+            1e-3, warmup_steps=10, decay_steps=100)
+        lr = tf.function(scheduler)(tf.constant(5, dtype=tf.int64))
+        self.assertAlmostEqual(float(lr), 5e-4)
+        self.assertAlmostEqual(float(scheduler(110)), 0.)
+
+    def test_get_lr_after_graph_steps(self):
+        scheduler = optim.WarmupCosineDecayLRScheduler(
+            1e-3, warmup_steps=10, decay_steps=100)
+        optimizer = tf.optimizers.SGD(scheduler)
+        var = tf.Variable([0., 0.])
+
+        @tf.function
+        def step():
+            optimizer.apply_gradients([(tf.constant([1., 1.]), var)])
+
+        for _ in range(5):
+            step()
+        self.assertAlmostEqual(get_lr(optimizer), 5e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
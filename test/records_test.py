@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+import efficientdet
+from efficientdet.data import records, voc
+
+
+# Files generated next to the test datasets by other tests
+GENERATED_FILES = ('manifest.json', '.annotations_cache')
+
+
+class RecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.ds_path = self.tmp_dir / 'VOC2007'
+        self.records_path = self.tmp_dir / 'records'
+        shutil.copytree('test/data/VOC2007', self.ds_path,
+                        ignore=shutil.ignore_patterns(*GENERATED_FILES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_export_tfrecords(self):
+        metadata = records.export_tfrecords('VOC', self.ds_path,
+                                            self.records_path,
+                                            num_shards=3)
+        shards = sorted(self.records_path.glob(records.SHARD_PATTERN))
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(metadata, records.load_metadata(self.records_path))
+        self.assertEqual(metadata['class_names'], voc.IDX_2_LABEL)
+
+        # Shards are written round robin, so reading them in order with
+        # an interleave restores the examples order
+        im_size = (128, 128)
+        ds = records.build_dataset(self.records_path, im_size, shuffle=False)
+        expected_ds = voc.build_dataset(self.ds_path, im_size, shuffle=False)
+
+        n_examples = 0
+        for (im, (labels, boxes)), (exp_im, (exp_labels, exp_boxes)) in \
+                zip(ds, expected_ds):
+            self.assertTrue(np.allclose(im, exp_im))
+            self.assertEqual(labels.numpy().tolist(),
+                             exp_labels.numpy().tolist())
+            self.assertTrue(np.allclose(boxes, exp_boxes, atol=1e-3))
+            n_examples += 1
+
+        self.assertEqual(n_examples, metadata['num_examples'])
+
+    def test_export_again_with_fewer_shards(self):
+        records.export_tfrecords('VOC', self.ds_path, self.records_path,
+                                 num_shards=3)
+        metadata = records.export_tfrecords('VOC', self.ds_path,
+                                            self.records_path,
+                                            num_shards=2)
+
+        # The shards of the first export are removed and never read
+        shards = sorted(p.name for p in 
+                        self.records_path.glob(records.SHARD_PATTERN))
+        self.assertEqual(shards, metadata['shards'])
+
+        ds = records.build_dataset(self.records_path, (64, 64))
+        self.assertEqual(len(list(ds)), metadata['num_examples'])
+
+    def test_build_ds(self):
+        records.export_tfrecords('VOC', self.ds_path, self.records_path,
+                                 num_shards=2)
+        ds, class2idx = efficientdet.data.build_ds(
+            format='tfrecord',
+            annots_path=str(self.records_path),
+            images_path='',
+            im_size=(128, 128),
+            batch_size=2,
+            data_augmentation=False)
+
+        self.assertEqual(class2idx, voc.LABEL_2_IDX)
+        n_batches = int(ds.cardinality())
+        self.assertEqual(n_batches, len(list(ds)))
+
+
+if __name__ == "__main__":
+    unittest.main()
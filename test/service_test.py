@@ -0,0 +1,56 @@
+import unittest
+
+import tensorflow as tf
+
+import efficientdet
+from efficientdet.data import service
+
+
+class DataServiceTest(unittest.TestCase):
+
+    def test_parse_cpus(self):
+        self.assertEqual(service.parse_cpus('0-3,8,10-11'),
+                         [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(service.parse_cpus(''), [])
+
+    def test_distributed_dataset(self):
+        kwargs = dict(format='VOC',
+                      annots_path='test/data/VOC2007',
+                      images_path=None,
+                      im_size=(256, 256),
+                      batch_size=2,
+                      data_augmentation=True,
+                      image_dtype=tf.uint8)
+        local_ds, _ = efficientdet.data.build_ds(**kwargs)
+
+        with service.LocalService(num_workers=2) as local_service:
+            ds, _ = efficientdet.data.build_ds(
+                data_service=local_service.target, **kwargs)
+
+            # The number of batches is the same as with the local pipeline
+            self.assertEqual(int(ds.cardinality()),
+                             int(local_ds.cardinality()))
+            for _ in range(2):
+                batches = list(ds)
+                self.assertEqual(len(batches), int(ds.cardinality()))
+                # Every example is received once
+                self.assertEqual(sum(int(b[0].shape[0]) for b in batches), 3)
+
+            images, (labels, boxes) = batches[0]
+            self.assertEqual(images.dtype, tf.uint8)
+            self.assertEqual(images.shape[1:], (256, 256, 3))
+            self.assertEqual(labels.shape[:2], boxes.shape[:2])
+
+        self.assertEqual(local_service.workers, [])
+
+    def test_examples_are_not_dropped(self):
+        with service.LocalService(num_workers=2) as local_service:
+            ds = service.distribute(tf.data.Dataset.range(7), 
+                                    local_service.target)
+            examples = [int(e) for batch in ds.batch(2)
+                        for e in batch.numpy()]
+        self.assertEqual(sorted(examples), list(range(7)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+import tensorflow as tf
+
+from efficientdet.data import store, voc
+
+
+# Files generated next to the test datasets by other tests
+GENERATED_FILES = ('manifest.json', '.annotations_cache')
+
+
+class ImageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ds_path = Path(self.tmp_dir) / 'VOC2007'
+        shutil.copytree('test/data/VOC2007', self.ds_path,
+                        ignore=shutil.ignore_patterns(*GENERATED_FILES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_image_store(self):
+        image_store = store.load_image_store('VOC', self.ds_path, (64, 64))
+        path = store.store_path(self.ds_path, (64, 64))
+        mtime = path.stat().st_mtime
+
+        # Once packed, the images are memory mapped
+        image_store = store.load_image_store('VOC', self.ds_path, (64, 64))
+        self.assertIsInstance(image_store.images, np.memmap)
+        self.assertEqual(path.stat().st_mtime, mtime)
+        self.assertEqual(len(image_store), 3)
+
+        # Stores of different sizes live side by side
+        store.load_image_store('VOC', self.ds_path, (32, 48))
+        self.assertTrue(path.exists())
+        self.assertTrue(store.store_path(self.ds_path, (32, 48)).exists())
+
+    def test_repack(self):
+        image_store = store.load_image_store('VOC', self.ds_path, (64, 64))
+        old_images = np.array(image_store.images)
+
+        # The metadata names the images of the new generation, and the
+        # previous ones are removed
+        path = store.pack_images('VOC', self.ds_path, (64, 64))
+        files = list(path.parent.glob('images_64x64.*'))
+        self.assertEqual(sorted(files),
+                         sorted([path, store.store_path(self.ds_path,
+                                                        (64, 64))]))
+
+        # Mapped images are still readable
+        self.assertTrue(np.array_equal(image_store.images, old_images))
+
+    def test_build_dataset(self):
+        im_size = (64, 64)
+        image_store = store.load_image_store('VOC', self.ds_path, im_size)
+
+        ds = voc.build_dataset(self.ds_path, im_size, shuffle=False,
+                               image_dtype=tf.uint8,
+                               image_store=image_store)
+        expected_ds = voc.build_dataset(self.ds_path, im_size,
+                                        shuffle=False,
+                                        image_dtype=tf.uint8)
+
+        for (im, (labels, _)), (exp_im, (exp_labels, _)) in \
+                zip(ds, expected_ds):
+            self.assertTrue(np.array_equal(im, exp_im))
+            self.assertTrue(np.array_equal(labels, exp_labels))
+
+
+if __name__ == "__main__":
+    unittest.main()